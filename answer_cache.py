@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+import threading
+import itertools
+import config
+
+
+"""
+Semantic Answer Cache:
+1. Answers are keyed by the embedding of the standalone question
+2. Entries are scoped by model and corpus version, so uploads and deletes make older answers unreachable,
+   they are purged once when a request first sees a new corpus version, not on every lookup
+3. A lookup returns the closest entry in its scope if the cosine similarity reaches the threshold
+4. Least recently used entries are evicted past max_entries
+"""
+
+class SemanticAnswerCache:
+  def __init__(self, max_entries: int, threshold: float):
+    self.max_entries = max_entries
+    self.threshold = threshold
+
+    self._entries = OrderedDict()
+    self._scopes = {}
+    self._matrices = {}
+    self._ids = itertools.count()
+    self._corpus_version = None
+    self._lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.saved_ms = 0.0
+
+  @staticmethod
+  def normalise(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+  # Stacked embeddings of a scope, rebuilt only after the scope changes
+  def _scope_matrix(self, scope):
+    if scope not in self._matrices:
+      entry_ids = list(self._scopes.get(scope, ()))
+      matrix = np.vstack([self._entries[entry_id]["embedding"] for entry_id in entry_ids]) if entry_ids else None
+      self._matrices[scope] = (entry_ids, matrix)
+
+    return self._matrices[scope]
+
+  def _remove(self, entry_id):
+    entry = self._entries.pop(entry_id)
+    self._scopes[entry["scope"]].discard(entry_id)
+    self._matrices.pop(entry["scope"], None)
+
+    if not self._scopes[entry["scope"]]:
+      del self._scopes[entry["scope"]]
+
+  def lookup(self, scope: tuple, embedding: List[float]) -> Optional[dict]:
+    query = self.normalise(embedding)
+
+    with self._lock:
+      entry_ids, matrix = self._scope_matrix(scope)
+
+      if matrix is not None:
+        similarities = matrix @ query
+        best = int(np.argmax(similarities))
+
+        if similarities[best] >= self.threshold:
+          entry_id = entry_ids[best]
+          self._entries.move_to_end(entry_id)
+          entry = self._entries[entry_id]
+
+          self.hits += 1
+          self.saved_ms += entry["latency_ms"]
+          return entry
+
+      self.misses += 1
+      return None
+
+  def store(self, scope: tuple, embedding: List[float], answer: str, sources: List[dict], latency_ms: float):
+    with self._lock:
+      # Answered from a corpus version that is no longer current, nothing could look it up
+      if self._corpus_version is not None and scope[-1] != self._corpus_version:
+        return
+
+      entry_id = next(self._ids)
+      self._entries[entry_id] = {
+        "scope": scope,
+        "embedding": self.normalise(embedding),
+        "answer": answer,
+        "sources": sources,
+        "latency_ms": latency_ms
+      }
+      self._scopes.setdefault(scope, set()).add(entry_id)
+      self._matrices.pop(scope, None)
+
+      while len(self._entries) > self.max_entries:
+        self._remove(next(iter(self._entries)))
+
+  # Drop entries of other corpus versions when the corpus version changes, scopes end with the corpus version
+  def purge_stale(self, corpus_version: int):
+    if corpus_version == self._corpus_version:
+      return
+
+    with self._lock:
+      if corpus_version == self._corpus_version:
+        return
+
+      self._corpus_version = corpus_version
+      for scope in [scope for scope in self._scopes if scope[-1] != corpus_version]:
+        for entry_id in list(self._scopes.get(scope, ())):
+          self._remove(entry_id)
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self._entries),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+      "saved_llm_calls": self.hits,
+      "saved_ms": round(self.saved_ms, 1)
+    }
+
+answer_cache = SemanticAnswerCache(max_entries=config.ANSWER_CACHE_MAX_ENTRIES, threshold=config.ANSWER_CACHE_THRESHOLD)
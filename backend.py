@@ -1,24 +1,62 @@
 import os
+import json
+import time
 import uuid
 import shutil
-from fastapi import FastAPI, File, UploadFile, HTTPException, APIRouter
-from pydantic_utils import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest
-from database  import get_chat_history, insert_chat_logs, insert_document_record, delete_document_record, get_all_documents
-from langchain_utils import get_rag_chain
-from chroma_utils import index_documents_to_chroma, delete_document
+import config
+from typing import Optional
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, APIRouter, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic_utils import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest, DeleteFilesRequest, SourceDocument, JobStatus
+from database  import aget_chat_history, ainsert_chat_logs, insert_document_record, delete_document_record, delete_document_records, document_index, get_job_record, get_document_record, chat_log_writer
+from langchain_utils import get_rag_chain, chain_registry, aembed_query
+from rewrite_utils import arewrite_question, get_rewrite_stats
+from routing_utils import model_router
+from chroma_utils import delete_document, delete_documents, get_corpus_version, bm25_index, vector_index, use_vector_index
+from answer_cache import answer_cache
+from ingestion_utils import submit_upload_job, submit_update_job
+from cache_utils import session_cache
+from history_utils import compact_chat_history, schedule_summary_update, compaction_stats
+from context_utils import context_stats
+from reconcile_utils import reconcile_documents, reconcile_stats
+from document_index import InvalidCursor
+from metrics import start_timings, use_timings, timed, record_stage, answer_tokens, history_tokens, answer_cache_results, time_to_first_token
+from token_utils import count_tokens
 
 """"
 API EndPoints
 
-/chat: Chat with llm and get back answer. Takes question, session id and model to use.
+/chat: Chat with llm and get back answer. Takes question, session id, model to use and optionally the file ids to search.
 Returns answer, session id and model name for database storage
 If no session id server should return a session id for the new chat
+Near identical standalone questions against the same corpus version are answered from the answer cache
+The Server-Timing header gives the time spent in each stage: history, rewrite, embed, cache_lookup, retrieval and its steps, generation, log_write
 
-/upload_doc: Uploads and indexes document into vector db. Return id
+/chat/stream: Same as /chat but streams server sent events. Sends session, then retrieved sources,
+then answer tokens as they are generated and finally a done event with time to first token and the time spent in each stage
 
-/list_doc: List all documents in vector db. Return id, filename, and timestamp of upload
+
+/upload_doc: Queues document for indexing into vector db. Return file id and job id
+
+/update_doc: Queues re-indexing of an existing document with a new version of the file,
+only changed chunks are embedded and stale chunks are removed. Return file id and job id
+
+/jobs/{job_id}: Status and progress of an indexing job
+
+/list_doc: List documents in vector db newest first, a page of limit documents after the cursor given in after.
+Return id, filename, and timestamp of upload, the cursor of the next page in the X-Next-Cursor header
+and an ETag, a request whose If-None-Match still matches gets 304 Not Modified
 
 /delete_doc: Delete document from vector db
+
+/delete_docs: Delete many documents, chunks by metadata filter in one pass and records in batched writes
+
+/reconcile: Remove chunks without a document record and records without chunks, reporting only with dry_run
+
+/stats: Cache and registry counters
+
+/metrics (main.py): Stage latency, token and chunk histograms in the Prometheus text format
 """
 
 router = APIRouter(
@@ -26,92 +64,359 @@ router = APIRouter(
   tags=["chatbot"]
 )
 
+# Streamed answers and their summed time to first token, reported in /stats
+stream_stats = {
+  "streams": 0,
+  "time_to_first_token_ms": 0.0
+}
+
+# Serialise retrieved documents for responses and the answer cache
+def format_sources(docs) -> list:
+  return [
+    SourceDocument(
+      file_id=doc.metadata.get("file_id"),
+      source=doc.metadata.get("source"),
+      page=doc.metadata.get("page"),
+      content=doc.page_content
+    ).model_dump()
+    for doc in docs
+  ]
+
+
+# Rewrite the question into a standalone question when it depends on history, embed it once and look it up in the answer cache
+async def prepare_rag_inputs(query: QueryInput, chat_history: list):
+  with timed("rewrite"):
+    standalone_question = await arewrite_question(query.model.value, query.question, chat_history)
+  with timed("embed"):
+    query_embedding = await aembed_query(standalone_question)
+  
+  # Answers are only shared between questions with the same document scope, the corpus version stays last
+  file_ids = sorted(set(query.file_ids)) if query.file_ids else None
+  corpus_version = get_corpus_version()
+  answer_cache.purge_stale(corpus_version)
+  cache_scope = (query.model.value, tuple(file_ids) if file_ids else None, corpus_version)
+  
+  inputs = {
+    "input": query.question,
+    "chat_history": chat_history,
+    "standalone_question": standalone_question,
+    "query_embedding": query_embedding,
+    "file_ids": file_ids,
+    "model": query.model.value
+  }
+  
+  with timed("cache_lookup"):
+    cached = answer_cache.lookup(cache_scope, query_embedding)
+  answer_cache_results.inc("hit" if cached else "miss")
+  
+  return inputs, cache_scope, cached
+
+
 # /chat
 @router.post("/chat")
 async def get_llm_response(query: QueryInput):
   """
   1. If no session_id, create one
-  2. Get chat history from db using session id
-  3. Get rag_chain and invoke using question and chathistory
-  4. Store into chat history db
-  5. return the session_id, answer and model  
+  2. Get chat history from db using session id and compact it to the summary plus recent turns
+  3. Rewrite the question into a standalone question and check the answer cache
+  4. On a miss, get rag_chain and invoke using question and chathistory, then cache the answer
+  5. Store into chat history db and fold turns that left the history window into the summary
+  6. return the session_id, answer and model  
+  
+  Every step is awaited so a slow llm call or firebase round trip does not block other requests,
+  and timed into the Server-Timing header and the rag_stage_seconds histogram
   """
   
+  timings = start_timings("chat")
+  
   if not query.session_id:
     session_id = str(uuid.uuid4())
   else:
     session_id = query.session_id
 
-  chat_history = get_chat_history(session_id=session_id)
+  with timed("history"):
+    chat_history = await aget_chat_history(session_id=session_id)
+    chat_history, compaction = await compact_chat_history(session_id, chat_history)
+  history_tokens.observe(compaction["history_tokens_after"], query.model.value)
   
-  rag_chain = get_rag_chain(model=query.model.value)
+  inputs, cache_scope, cached = await prepare_rag_inputs(query, chat_history)
   
-  answer = rag_chain.invoke({"input": query.question, "chat_history": chat_history})["answer"]
+  if cached:
+    answer = cached["answer"]
+    
+  else:
+    rag_chain = get_rag_chain(model=query.model.value)
+    
+    generation_start = time.perf_counter()
+    result = await rag_chain.ainvoke(inputs)
+    answer = result["answer"]
+    chain_seconds = time.perf_counter() - generation_start
+    
+    # Retrieval runs inside the chain and records its own stage, the rest is the llm call
+    record_stage("generation", chain_seconds - timings.total("retrieval"))
+    answer_tokens.observe(count_tokens(answer), query.model.value)
+    
+    answer_cache.store(
+      cache_scope,
+      inputs["query_embedding"],
+      answer,
+      format_sources(result["context"]),
+      latency_ms=chain_seconds * 1000
+    )
   
-  insert_chat_logs(
-    session_id=session_id,
-    user_query=query.question,
-    llm_response=answer,
-    model=query.model.value
-  )
+  with timed("log_write"):
+    await ainsert_chat_logs(
+      session_id=session_id,
+      user_query=query.question,
+      llm_response=answer,
+      model=query.model.value
+    )
+  
+  schedule_summary_update(session_id, query.model.value, compaction)
   
-  return QueryResponse(
+  response = QueryResponse(
     answer=answer,
     session_id=session_id,
     model=query.model
   )
+  
+  server_timing = timings.server_timing()
+  timings.finish()
+  
+  return JSONResponse(content=response.model_dump(mode="json"), headers={"Server-Timing": server_timing})
 
 
-# /upload_doc 
-@router.post("/upload-doc")
-async def upload_and_index_document(file: UploadFile = File(...)):
+# Format a server sent event
+def format_sse(event: str, data) -> str:
+  return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# /chat/stream
+@router.post("/chat/stream")
+async def stream_llm_response(query: QueryInput):
   """
-  1. Check if doc type is allowed
-  2. Save incoming file stream into temp file
-  3. Index and save to Vector Db
-  4. Remove temp file and return saved file id
+  1. If no session_id, create one
+  2. Get chat history from db using session id and compact it
+  3. Rewrite the question and check the answer cache, a hit is sent as sources and a single answer delta
+  4. On a miss, stream rag_chain output: sources once retrieval is done, then answer deltas
+  5. Store full answer and time to first token into chat history db once the stream ends
+  
+  Headers are sent before the answer is generated, so the Server-Timing header only covers loading the history,
+  the done event carries every stage
   """
   
+  timings = start_timings("chat_stream")
+  request_start = timings.start
+  
+  if not query.session_id:
+    session_id = str(uuid.uuid4())
+  else:
+    session_id = query.session_id
+
+  with timed("history"):
+    chat_history = await aget_chat_history(session_id=session_id)
+    chat_history, compaction = await compact_chat_history(session_id, chat_history)
+  history_tokens.observe(compaction["history_tokens_after"], query.model.value)
+  
+  rag_chain = get_rag_chain(model=query.model.value)
+  
+  async def event_stream():
+    # The response body is iterated outside the context of this endpoint
+    use_timings(timings)
+    yield format_sse("session", {"session_id": session_id, "model": query.model.value})
+    
+    answer_parts = []
+    sources = []
+    time_to_first_token_ms = None
+    
+    try:
+      inputs, cache_scope, cached = await prepare_rag_inputs(query, chat_history)
+      
+      if cached:
+        time_to_first_token_ms = (time.perf_counter() - request_start) * 1000
+        answer_parts.append(cached["answer"])
+        
+        yield format_sse("sources", cached["sources"])
+        yield format_sse("token", {"delta": cached["answer"]})
+        
+      else:
+        generation_start = time.perf_counter()
+        
+        async for chunk in rag_chain.astream(inputs):
+          # Retrieved documents arrive once, before any answer token
+          if "context" in chunk:
+            sources = format_sources(chunk["context"])
+            yield format_sse("sources", sources)
+            
+          if chunk.get("answer"):
+            if time_to_first_token_ms is None:
+              time_to_first_token_ms = (time.perf_counter() - request_start) * 1000
+              
+            answer_parts.append(chunk["answer"])
+            yield format_sse("token", {"delta": chunk["answer"]})
+        
+        chain_seconds = time.perf_counter() - generation_start
+        record_stage("generation", chain_seconds - timings.total("retrieval"))
+        answer_tokens.observe(count_tokens("".join(answer_parts)), query.model.value)
+            
+        answer_cache.store(
+          cache_scope,
+          inputs["query_embedding"],
+          "".join(answer_parts),
+          sources,
+          latency_ms=chain_seconds * 1000
+        )
+          
+    except Exception as e:
+      print(f"Error streaming response for session {session_id}: {e}")
+      yield format_sse("error", {"detail": "Failed to generate a response."})
+      timings.finish()
+      return
+    
+    answer = "".join(answer_parts)
+    
+    if time_to_first_token_ms is not None:
+      time_to_first_token.observe(time_to_first_token_ms / 1000, query.model.value)
+      stream_stats["streams"] += 1
+      stream_stats["time_to_first_token_ms"] += time_to_first_token_ms
+    
+    with timed("log_write"):
+      await ainsert_chat_logs(
+        session_id=session_id,
+        user_query=query.question,
+        llm_response=answer,
+        model=query.model.value,
+        time_to_first_token_ms=time_to_first_token_ms
+      )
+    
+    schedule_summary_update(session_id, query.model.value, compaction)
+    
+    stages_ms = timings.as_dict()
+    timings.finish()
+    
+    yield format_sse("done", {"session_id": session_id, "time_to_first_token_ms": time_to_first_token_ms, "stages_ms": stages_ms})
+    
+  return StreamingResponse(
+    event_stream(),
+    media_type="text/event-stream",
+    headers={"Server-Timing": timings.server_timing(include_total=False)}
+  )
+
+
+# Check doc type is allowed and save incoming file stream into a uniquely named temp file
+def save_upload_to_temp_file(file: UploadFile) -> str:
   allowed_extensions = ['.pdf', '.docx', '.html']
   file_extension = os.path.splitext(file.filename)[1].lower()
   
   if file_extension not in allowed_extensions:
     raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(allowed_extensions)}")
   
-  temp_file_path = f"temp_{file.filename}"
+  temp_file_path = os.path.abspath(f"temp_{uuid.uuid4().hex}_{os.path.basename(file.filename)}")
   
-  try:
-    with open(temp_file_path, 'wb') as f:
-      shutil.copyfileobj(file.file, f)
-      
-    file_id = insert_document_record(file.filename)
-    success = index_documents_to_chroma(temp_file_path, file_id)
+  with open(temp_file_path, 'wb') as f:
+    shutil.copyfileobj(file.file, f)
     
-    if success:
-      return {"message": f"File {file.filename} has been successfully uploaded and indexed.", "file_id": file_id}
-    else:
-      delete_document_record(file_id)
-      raise HTTPException(status_code=500, detail=f"Failed to index {file.filename}.")
+  return temp_file_path
+
+
+# /upload_doc 
+@router.post("/upload-doc", status_code=202)
+async def upload_and_index_document(file: UploadFile = File(...)):
+  """
+  1. Check if doc type is allowed
+  2. Save incoming file stream into temp file
+  3. Queue indexing job, the job removes the temp file when done
+  4. Return saved file id and job id
+  """
+  
+  temp_file_path = save_upload_to_temp_file(file)
+  filename = os.path.basename(file.filename)
+    
+  file_id = await run_in_threadpool(insert_document_record, filename)
+  job_id = await run_in_threadpool(submit_upload_job, temp_file_path, filename, file_id) if file_id else None
+  
+  if job_id is None:
+    if file_id:
+      await run_in_threadpool(delete_document_record, file_id)
+    os.remove(temp_file_path)
+    raise HTTPException(status_code=500, detail=f"Failed to queue {filename} for indexing.")
+  
+  return {"message": f"File {filename} has been queued for indexing.", "file_id": file_id, "job_id": job_id}
+
+
+# /update_doc
+@router.put("/update-doc", status_code=202)
+async def update_and_reindex_document(file_id: str = Form(...), file: UploadFile = File(...)):
+  """
+  1. Check the document exists
+  2. Save incoming file stream into temp file
+  3. Queue update job that embeds only new chunks and deletes stale ones
+  4. Return file id and job id
+  """
+  
+  if await run_in_threadpool(get_document_record, file_id) is None:
+    raise HTTPException(status_code=404, detail=f"Document with file_id {file_id} not found.")
+  
+  temp_file_path = save_upload_to_temp_file(file)
+  filename = os.path.basename(file.filename)
+  
+  job_id = await run_in_threadpool(submit_update_job, temp_file_path, filename, file_id)
   
-  finally:
-    if os.path.exists(temp_file_path):
-      os.remove(temp_file_path)
+  if job_id is None:
+    os.remove(temp_file_path)
+    raise HTTPException(status_code=500, detail=f"Failed to queue {filename} for re-indexing.")
+  
+  return {"message": f"File {filename} has been queued for re-indexing.", "file_id": file_id, "job_id": job_id}
+
+
+# /jobs/{job_id}
+@router.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job_status(job_id: str):
+  job = await run_in_threadpool(get_job_record, job_id)
+  
+  if job is None:
+    raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+  
+  return job
       
       
 # /list-docs
 @router.get("/list-docs", response_model=list[DocumentInfo])
-async def list_documents():
-  return get_all_documents()
+async def list_documents(
+  request: Request,
+  response: Response,
+  limit: int = Query(default=config.LIST_DOCS_DEFAULT_LIMIT, ge=1, le=config.LIST_DOCS_MAX_LIMIT),
+  after: Optional[str] = None
+):
+  try:
+    docs, next_cursor, etag = await run_in_threadpool(document_index.page, limit, after)
+  except InvalidCursor as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  except Exception as e:
+    print(f"Error listing documents: {e}")
+    raise HTTPException(status_code=500, detail="Failed to list documents.")
+  
+  headers = {"ETag": etag, "Cache-Control": "no-cache"}
+  if next_cursor:
+    headers["X-Next-Cursor"] = next_cursor
+  
+  # Weak comparison, the listing is the same whether or not the client kept the W/ prefix
+  if_none_match = [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]
+  if etag.removeprefix("W/") in if_none_match or "*" in if_none_match:
+    return Response(status_code=304, headers=headers)
+  
+  response.headers.update(headers)
+  return docs
 
 # /delete-doc
 @router.delete("/delete-doc")
 async def delete_doc(request: DeleteFileRequest):
   # Delete from Chroma Db
-  chroma_delete = delete_document(request.file_id)
+  chroma_delete = await run_in_threadpool(delete_document, request.file_id)
   
   if chroma_delete:
     # Delete from document store
-    db_delete = delete_document_record(request.file_id)
+    db_delete = await run_in_threadpool(delete_document_record, request.file_id)
     
     if db_delete:
       return {"message": f"Successfully deleted document with file_id {request.file_id} from the system."}
@@ -119,4 +424,47 @@ async def delete_doc(request: DeleteFileRequest):
       return {"error": f"Deleted from Chroma but failed to delete document with file_id {request.file_id} from the database."}
     
   else:
-    return {"error": f"Failed to delete document with file_id {request.file_id} from Chroma."}
\ No newline at end of file
+    return {"error": f"Failed to delete document with file_id {request.file_id} from Chroma."}
+  
+# /delete-docs
+@router.delete("/delete-docs")
+async def delete_docs(request: DeleteFilesRequest):
+  """
+  1. Delete the chunks of every file from Chroma, BM25 and the vector index in one batched pass
+  2. Delete the document records in batched writes, only once the chunks are gone
+  3. Records left behind by a failed second step are removed by the reconciliation job
+  """
+  file_ids = list(dict.fromkeys(request.file_ids))
+  
+  if not await run_in_threadpool(delete_documents, file_ids):
+    raise HTTPException(status_code=500, detail="Failed to delete documents from Chroma, nothing was deleted from the database.")
+  
+  if not await run_in_threadpool(delete_document_records, file_ids):
+    raise HTTPException(status_code=500, detail="Deleted from Chroma but failed to delete the document records, they will be removed by reconciliation.")
+  
+  return {"message": f"Successfully deleted {len(file_ids)} documents from the system.", "file_ids": file_ids}
+
+# /reconcile
+@router.post("/reconcile")
+async def reconcile(dry_run: bool = False):
+  return await run_in_threadpool(reconcile_documents, dry_run)
+
+
+# /stats
+@router.get("/stats")
+async def get_stats():
+  return {
+    "rag_chains": chain_registry.stats(),
+    "session_cache": session_cache.stats(),
+    "chat_stream": stream_stats,
+    "history_compaction": compaction_stats,
+    "chat_log_writer": chat_log_writer.stats(),
+    "answer_cache": answer_cache.stats(),
+    "question_rewrite": get_rewrite_stats(),
+    "bm25_index": bm25_index.stats(),
+    "vector_index": vector_index.stats() if use_vector_index else None,
+    "context_packing": context_stats,
+    "reconcile": reconcile_stats,
+    "document_index": document_index.stats(),
+    "llm_routing": model_router.stats()
+  }
@@ -0,0 +1,134 @@
+"""
+BM25 Benchmark:
+Times BM25Index search over synthetic chunks with Zipf distributed terms, so a few terms are found in most chunks
+and most terms are rare, like words in real documents. Queries mix rare and common terms and run one at a time
+like chat requests, over the whole index and scoped to one file or to a share of the files.
+--removed marks that share of chunks removed without compacting, the state between two compactions.
+
+python -m benchmarks.bm25 --chunks 20000 100000 --queries 200
+"""
+from langchain_core.documents import Document
+import numpy as np
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+VOCABULARY_SIZE = 50000
+CHUNK_WORDS = 150
+CHUNKS_PER_FILE = 100
+
+
+def make_vocabulary(seed: int = 0):
+  rng = np.random.default_rng(seed)
+  words = np.array([f"term{i}" for i in range(VOCABULARY_SIZE)])
+  weights = 1 / np.arange(1, VOCABULARY_SIZE + 1)
+  return rng, words, weights / weights.sum()
+
+def make_chunks(count: int, seed: int = 0):
+  rng, words, probabilities = make_vocabulary(seed)
+  return [
+    Document(id=f"{i:064x}", page_content=" ".join(rng.choice(words, size=CHUNK_WORDS, p=probabilities)), metadata={"file_id": f"file{i // CHUNKS_PER_FILE}"})
+    for i in range(count)
+  ]
+
+# Two rare terms, one mid frequency term and one common term per query
+def make_queries(count: int, seed: int = 1):
+  rng = np.random.default_rng(seed)
+  return [
+    f"term{rng.integers(1000, VOCABULARY_SIZE)} term{rng.integers(1000, VOCABULARY_SIZE)} term{rng.integers(50, 1000)} term{rng.integers(0, 50)}"
+    for _ in range(count)
+  ]
+
+def percentile_ms(samples: list, percentile: float) -> float:
+  return round(float(np.percentile(samples, percentile)) * 1000, 3)
+
+def time_searches(index, queries: list, k: int, scopes: list) -> dict:
+  # Warm the impact caches the way a running worker has them
+  for query, scope in zip(queries, scopes):
+    index.search(query, k, file_ids=scope)
+
+  samples = []
+  for query, scope in zip(queries, scopes):
+    start = time.perf_counter()
+    index.search(query, k, file_ids=scope)
+    samples.append(time.perf_counter() - start)
+
+  return {
+    "p50_ms": percentile_ms(samples, 50),
+    "p95_ms": percentile_ms(samples, 95),
+    "p99_ms": percentile_ms(samples, 99),
+    "queries_per_second": round(len(samples) / sum(samples), 1)
+  }
+
+def run(chunk_count: int, queries: list, k: int, removed: float, rng) -> dict:
+  from bm25_index import BM25Index
+
+  chunks = make_chunks(chunk_count)
+  files = sorted({chunk.metadata["file_id"] for chunk in chunks})
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    index = BM25Index(os.path.join(temp_dir, "bm25_index.pkl"))
+
+    start = time.perf_counter()
+    for offset in range(0, len(chunks), 1000):
+      index.add(chunks[offset:offset + 1000])
+    index_seconds = time.perf_counter() - start
+
+    if removed:
+      index.remove(chunk.id for chunk in chunks[::round(1 / removed)])
+
+    start = time.perf_counter()
+    index.save()
+    save_seconds = time.perf_counter() - start
+
+    scopes = {
+      "all": [None] * len(queries),
+      "one_file": [[files[i]] for i in rng.integers(0, len(files), len(queries))],
+      "tenth_of_files": [list(rng.choice(files, size=max(len(files) // 10, 1), replace=False)) for _ in queries]
+    }
+
+    stats = index.stats()
+    result = {
+      "chunks": chunk_count,
+      "removed_chunks": stats["dead_rows"],
+      "terms": stats["terms"],
+      "index_seconds": round(index_seconds, 2),
+      "save_seconds": round(save_seconds, 2),
+      "search": {name: time_searches(index, queries, k, scope) for name, scope in scopes.items()}
+    }
+
+  print(f"{chunk_count} chunks: " + ", ".join(f"{name} p50 {timing['p50_ms']} ms p95 {timing['p95_ms']} ms" for name, timing in result["search"].items()), file=sys.stderr)
+  return result
+
+def main():
+  parser = argparse.ArgumentParser(description="Time BM25 index search over synthetic chunks")
+  parser.add_argument("--chunks", type=int, nargs="+", default=[20000, 100000])
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--k", type=int, default=20)
+  parser.add_argument("--removed", type=float, default=0.0, help="Share of chunks removed without compacting, below 0.25")
+  parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+  args = parser.parse_args()
+
+  queries = make_queries(args.queries)
+  rng = np.random.default_rng(2)
+  results = [run(chunk_count, queries, args.k, args.removed, rng) for chunk_count in args.chunks]
+
+  output = json.dumps({
+    "benchmark": "bm25",
+    "queries": args.queries,
+    "k": args.k,
+    "results": results
+  }, indent=2)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+
+if __name__ == "__main__":
+  main()
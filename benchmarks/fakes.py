@@ -0,0 +1,121 @@
+"""
+Local stand-ins for the paid and remote services, used by the load benchmark:
+- FakeChatModel answers in place of ChatGroq/ChatOpenAI, streaming one word at a time
+- FakeEmbeddings embeds in place of OpenAIEmbeddings, words hashed into a fixed number of dimensions
+  so texts sharing words land close together and retrieval still has something to rank
+- LatencyStorage wraps a storage backend, e.g. SQLite in a temp directory instead of Firestore
+
+Everything is deterministic, each stand-in waits a configurable simulated latency before answering.
+"""
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from typing import Any, AsyncIterator, List, Optional
+import numpy as np
+import functools
+import hashlib
+import inspect
+import asyncio
+import time
+import re
+
+
+class FakeChatModel(BaseChatModel):
+  # Seconds until the first word, then between words
+  latency: float = 0.5
+  token_latency: float = 0.01
+  answer_words: int = 60
+
+  @property
+  def _llm_type(self) -> str:
+    return "fake-chat"
+
+  # The answer repeats the words of the latest question up to answer_words
+  def answer_words_for(self, messages: List[BaseMessage]) -> List[str]:
+    question = next((message.content for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+    words = question.split() or ["answer"]
+    return [words[i % len(words)] for i in range(self.answer_words)]
+
+  def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+    words = self.answer_words_for(messages)
+    time.sleep(self.latency + self.token_latency * len(words))
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(words)))])
+
+  async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+    words = self.answer_words_for(messages)
+    await asyncio.sleep(self.latency + self.token_latency * len(words))
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(words)))])
+
+  async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+    await asyncio.sleep(self.latency)
+
+    for index, word in enumerate(self.answer_words_for(messages)):
+      if index:
+        await asyncio.sleep(self.token_latency)
+      chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if index == 0 else " " + word))
+      if run_manager:
+        await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+      yield chunk
+
+
+class FakeEmbeddings(Embeddings):
+  def __init__(self, dimensions: int = 1536, latency: float = 0.05):
+    self.dimensions = dimensions
+    self.latency = latency
+
+  # Every word adds a signed unit to one dimension, the vector is normalised like OpenAI embeddings
+  def embed(self, text: str) -> List[float]:
+    vector = np.zeros(self.dimensions, dtype=np.float32)
+
+    for word in re.findall(r"\w+", text.lower()):
+      digest = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+      vector[digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+
+    norm = np.linalg.norm(vector)
+    if not norm:
+      vector[0], norm = 1.0, 1.0
+    return (vector / norm).tolist()
+
+  def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    time.sleep(self.latency)
+    return [self.embed(text) for text in texts]
+
+  def embed_query(self, text: str) -> List[float]:
+    time.sleep(self.latency)
+    return self.embed(text)
+
+  async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    await asyncio.sleep(self.latency)
+    return [self.embed(text) for text in texts]
+
+  async def aembed_query(self, text: str) -> List[float]:
+    await asyncio.sleep(self.latency)
+    return self.embed(text)
+
+
+# Storage backend wrapper adding a simulated round trip before every call
+class LatencyStorage:
+  def __init__(self, backend, latency: float = 0.02):
+    self.backend = backend
+    self.latency = latency
+
+  def __getattr__(self, attr):
+    value = getattr(self.backend, attr)
+
+    if not callable(value) or attr == "stats":
+      return value
+
+    if inspect.iscoroutinefunction(value):
+      @functools.wraps(value)
+      async def delayed_async(*args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await value(*args, **kwargs)
+      return delayed_async
+
+    @functools.wraps(value)
+    def delayed(*args, **kwargs):
+      time.sleep(self.latency)
+      return value(*args, **kwargs)
+    return delayed
@@ -0,0 +1,336 @@
+"""
+Load Benchmark:
+Runs the FastAPI app in process with local stand-ins for the llm, the embeddings and the document store (benchmarks.fakes),
+each with a simulated latency, so throughput and latency regressions can be measured without paying for OpenAI/Groq or Firestore.
+1. Generated PDFs of each size in --pages are sent to /upload-doc and their ingestion jobs polled until done
+2. The chat traffic in --traffic is replayed --repeat times against /chat and /chat/stream at --concurrency requests in flight
+3. Latency percentiles, requests per second, the per stage timings reported by the app and peak memory are written as JSON,
+   with --baseline the run is compared against an earlier result and exits with 1 on a regression
+
+Every line of the traffic file is a JSON object, {"path": "/chatbot/chat", "json": {...}} is sent as is,
+otherwise the question is read from "question", or "title" for backlog style records, with optional "session_id" and "model".
+Lines without their own session are spread over --sessions sessions so chat history builds up like in real conversations.
+
+python -m benchmarks.load --traffic requests.jsonl --concurrency 8 --repeat 3 --pages 5 50 200
+python -m benchmarks.load --output current.json --baseline baseline.json
+"""
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings, LatencyStorage
+from benchmarks.loading import peak_rss_mb
+from benchmarks.pdf_utils import write_text_pdf
+from collections import defaultdict
+from contextlib import redirect_stdout
+from typing import Dict, List
+import numpy as np
+import argparse
+import tempfile
+import asyncio
+import json
+import time
+import sys
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHAT_PATH = "/chatbot/chat"
+STREAM_PATH = "/chatbot/chat/stream"
+
+
+# Point every file the app writes at the temp directory and use SQLite, before the app modules read config
+def configure_environment(temp_dir: str):
+  os.environ.update({
+    "STORAGE_BACKEND": "sqlite",
+    "SQLITE_PATH": os.path.join(temp_dir, "rag_chatbot.db"),
+    "EMBEDDING_CACHE_PATH": os.path.join(temp_dir, "embedding_cache.db"),
+    "CHAT_LOG_SPILL_PATH": os.path.join(temp_dir, "chat_log_spill.jsonl"),
+    "LANGCHAIN_TRACING_V2": "false"
+  })
+  os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+  os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+  # Chroma, the BM25 index and uploaded temp files live under the working directory
+  sys.path.insert(0, REPO_ROOT)
+  os.chdir(temp_dir)
+
+def install_fakes(args):
+  import config
+  import chroma_utils
+  import database
+  import langchain_utils
+  from embedding_cache import EmbeddingCache, CachedEmbeddings
+  from storage_utils import create_storage
+
+  llm = FakeChatModel(latency=args.llm_latency, token_latency=args.llm_token_latency, answer_words=args.answer_words)
+  langchain_utils.get_llm = lambda model, **llm_settings: llm
+
+  embeddings = FakeEmbeddings(dimensions=args.dimensions, latency=args.embedding_latency)
+  embedding_cache = EmbeddingCache(path=config.EMBEDDING_CACHE_PATH, max_entries=config.EMBEDDING_CACHE_MAX_ENTRIES)
+  chroma_utils.embedding_function.override(CachedEmbeddings(embeddings, embedding_cache, model="fake-embedding"))
+
+  database.storage.override(LatencyStorage(create_storage("sqlite"), latency=args.storage_latency))
+
+def load_traffic(path: str) -> List[dict]:
+  requests = []
+
+  with open(path) as f:
+    for line in f:
+      if not line.strip():
+        continue
+      record = json.loads(line)
+
+      if "path" in record:
+        requests.append({"path": record["path"], "json": record.get("json", {})})
+        continue
+
+      question = record.get("question") or record.get("title")
+      if not question:
+        continue
+      body = {"question": question}
+      for key in ("session_id", "model", "file_ids"):
+        if record.get(key):
+          body[key] = record[key]
+      requests.append({"path": None, "json": body})
+
+  return requests
+
+# Repeat the traffic, give every request a session and send stream_fraction of the questions to /chat/stream
+def build_schedule(traffic: List[dict], repeat: int, sessions: int, stream_fraction: float) -> List[dict]:
+  schedule = []
+
+  for round_number in range(repeat):
+    for index, request in enumerate(traffic):
+      count = len(schedule)
+      body = dict(request["json"])
+      body.setdefault("session_id", f"benchmark-session-{index % sessions}")
+
+      path = request["path"]
+      if path is None:
+        path = STREAM_PATH if int((count + 1) * stream_fraction) > int(count * stream_fraction) else CHAT_PATH
+
+      schedule.append({"path": path, "json": body})
+
+  return schedule
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+  stages = {}
+  for entry in header.split(","):
+    name, _, duration = entry.strip().partition(";dur=")
+    if name and duration:
+      stages[name] = float(duration)
+  return stages
+
+async def send_chat(client, request: dict) -> dict:
+  start = time.perf_counter()
+  response = await client.post(request["path"], json=request["json"])
+  result = {"path": request["path"], "latency_ms": (time.perf_counter() - start) * 1000, "ok": response.status_code == 200, "stages": {}}
+
+  if request["path"] == STREAM_PATH:
+    # The done event carries the stages and time to first token, an error event means the answer failed
+    for block in response.text.split("\n\n"):
+      event, _, data = block.partition("\ndata: ")
+      if event == "event: error":
+        result["ok"] = False
+      elif event == "event: done":
+        done = json.loads(data)
+        result["stages"] = done.get("stages_ms", {})
+        result["time_to_first_token_ms"] = done.get("time_to_first_token_ms")
+  else:
+    result["stages"] = parse_server_timing(response.headers.get("server-timing", ""))
+
+  return result
+
+async def upload_pdf(client, file_path: str, pages: int, poll_interval: float) -> dict:
+  start = time.perf_counter()
+  with open(file_path, "rb") as f:
+    response = await client.post("/chatbot/upload-doc", files={"file": (os.path.basename(file_path), f, "application/pdf")})
+  upload_ms = (time.perf_counter() - start) * 1000
+
+  result = {"pages": pages, "file_size_mb": round(os.path.getsize(file_path) / (1024 * 1024), 2), "upload_ms": round(upload_ms, 2)}
+  if response.status_code != 202:
+    return {**result, "status": f"http {response.status_code}"}
+
+  job_id = response.json()["job_id"]
+  while True:
+    job = (await client.get(f"/chatbot/jobs/{job_id}")).json()
+    if job["status"] in ("completed", "failed"):
+      break
+    await asyncio.sleep(poll_interval)
+
+  index_seconds = time.perf_counter() - start
+  return {
+    **result,
+    "status": job["status"],
+    "chunks": job.get("chunks_total"),
+    "index_seconds": round(index_seconds, 3),
+    "pages_per_second": round(pages / index_seconds, 1)
+  }
+
+# Run the coroutines with at most concurrency in flight, returns the results and the wall time
+async def run_bounded(factories: list, concurrency: int):
+  queue = asyncio.Queue()
+  for factory in factories:
+    queue.put_nowait(factory)
+  results = []
+
+  async def worker():
+    while not queue.empty():
+      factory = queue.get_nowait()
+      results.append(await factory())
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  return results, time.perf_counter() - start
+
+def summarize_latencies(latencies: List[float], errors: int, wall_seconds: float) -> dict:
+  values = np.array(latencies) if latencies else np.zeros(1)
+  return {
+    "requests": len(latencies),
+    "errors": errors,
+    "p50_ms": round(float(np.percentile(values, 50)), 2),
+    "p95_ms": round(float(np.percentile(values, 95)), 2),
+    "p99_ms": round(float(np.percentile(values, 99)), 2),
+    "mean_ms": round(float(values.mean()), 2),
+    "max_ms": round(float(values.max()), 2),
+    "requests_per_second": round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0
+  }
+
+def summarize_chats(results: List[dict], wall_seconds: float) -> dict:
+  endpoints = {}
+  for path in sorted({result["path"] for result in results}):
+    path_results = [result for result in results if result["path"] == path]
+    summary = summarize_latencies([result["latency_ms"] for result in path_results], sum(1 for result in path_results if not result["ok"]), wall_seconds)
+
+    first_tokens = [result["time_to_first_token_ms"] for result in path_results if result.get("time_to_first_token_ms") is not None]
+    if first_tokens:
+      summary["time_to_first_token_p50_ms"] = round(float(np.percentile(first_tokens, 50)), 2)
+      summary["time_to_first_token_p95_ms"] = round(float(np.percentile(first_tokens, 95)), 2)
+    endpoints[path] = summary
+
+  stage_values = defaultdict(list)
+  for result in results:
+    for stage, duration in result["stages"].items():
+      stage_values[stage].append(duration)
+
+  stages = {
+    stage: {"count": len(values), "p50_ms": round(float(np.percentile(values, 50)), 2), "p95_ms": round(float(np.percentile(values, 95)), 2)}
+    for stage, values in stage_values.items()
+  }
+
+  overall = summarize_latencies([result["latency_ms"] for result in results], sum(1 for result in results if not result["ok"]), wall_seconds)
+  return {"overall": overall, "endpoints": endpoints, "stages_ms": stages}
+
+# Compare against an earlier run, a regression is a p95 latency up or a throughput down by more than tolerance
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> dict:
+  changes = {}
+  regressions = []
+
+  for endpoint, summary in results["chat"]["endpoints"].items():
+    base = baseline.get("chat", {}).get("endpoints", {}).get(endpoint)
+    if not base:
+      continue
+
+    changes[endpoint] = {
+      key: round(summary[key] / base[key] - 1, 4)
+      for key in ("p50_ms", "p95_ms", "p99_ms", "requests_per_second")
+      if base.get(key)
+    }
+    if changes[endpoint].get("p95_ms", 0) > tolerance or changes[endpoint].get("requests_per_second", 0) < -tolerance:
+      regressions.append(endpoint)
+
+  return {"tolerance": tolerance, "changes": changes, "regressions": regressions}
+
+async def run_benchmark(args, temp_dir: str) -> dict:
+  import httpx
+  import main
+  from answer_cache import answer_cache
+
+  # main switches LangSmith tracing on when imported
+  os.environ["LANGSMITH_TRACING_V2"] = "false"
+  install_fakes(args)
+
+  traffic = load_traffic(args.traffic)
+  schedule = build_schedule(traffic, args.repeat, args.sessions, args.stream_fraction)
+
+  pdf_paths = []
+  for pages in args.pages:
+    for copy in range(args.uploads_per_size):
+      file_path = os.path.join(temp_dir, f"benchmark_{pages}_pages_{copy}.pdf")
+      write_text_pdf(file_path, pages)
+      pdf_paths.append((file_path, pages))
+
+  async with main.app.router.lifespan_context(main.app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark", timeout=None) as client:
+      uploads, upload_seconds = await run_bounded(
+        [lambda file_path=file_path, pages=pages: upload_pdf(client, file_path, pages, args.poll_interval) for file_path, pages in pdf_paths],
+        args.concurrency
+      )
+      print(f"Indexed {len(uploads)} documents in {upload_seconds:.2f}s", file=sys.stderr)
+
+      warmup, schedule = schedule[:args.warmup], schedule[args.warmup:]
+      await run_bounded([lambda request=request: send_chat(client, request) for request in warmup], args.concurrency)
+
+      chats, chat_seconds = await run_bounded([lambda request=request: send_chat(client, request) for request in schedule], args.concurrency)
+      print(f"Replayed {len(chats)} chat requests in {chat_seconds:.2f}s at concurrency {args.concurrency}", file=sys.stderr)
+
+      answer_cache_stats = answer_cache.stats()
+
+  return {
+    "uploads": sorted(uploads, key=lambda upload: upload["pages"]),
+    "chat": {**summarize_chats(chats, chat_seconds), "wall_seconds": round(chat_seconds, 3), "answer_cache": answer_cache_stats},
+    # Of the app process, PDF parsing workers are not included
+    "peak_rss_mb": round(peak_rss_mb(), 1)
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay chat traffic and uploads against the app with local stand-ins for the llm, embeddings and store")
+  parser.add_argument("--traffic", default=os.path.join(REPO_ROOT, "requests.jsonl"), help="JSONL file of chat requests to replay")
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--sessions", type=int, default=20)
+  parser.add_argument("--stream-fraction", type=float, default=0.25, help="Share of questions sent to /chat/stream")
+  parser.add_argument("--warmup", type=int, default=5, help="Requests sent before measuring")
+  parser.add_argument("--pages", type=int, nargs="*", default=[5, 50, 200], help="Page counts of the generated PDFs uploaded first")
+  parser.add_argument("--uploads-per-size", type=int, default=1)
+  parser.add_argument("--poll-interval", type=float, default=0.05)
+  parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds to the first answer token")
+  parser.add_argument("--llm-token-latency", type=float, default=0.01, help="Seconds between answer tokens")
+  parser.add_argument("--answer-words", type=int, default=60)
+  parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds per embedding call")
+  parser.add_argument("--dimensions", type=int, default=1536)
+  parser.add_argument("--storage-latency", type=float, default=0.02, help="Seconds per document store call")
+  parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+  parser.add_argument("--baseline", help="Earlier JSON result to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change in p95 latency or throughput counted as a regression")
+  args = parser.parse_args()
+
+  args.traffic = os.path.abspath(args.traffic)
+  output_path = os.path.abspath(args.output) if args.output else None
+  baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+  settings = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    configure_environment(temp_dir)
+    # The app logs with print, kept off stdout so the JSON result can be piped
+    with redirect_stdout(sys.stderr):
+      results = {"benchmark": "load", "settings": settings, **asyncio.run(run_benchmark(args, temp_dir))}
+    os.chdir(REPO_ROOT)
+
+  regressed = False
+  if baseline_path:
+    with open(baseline_path) as f:
+      results["comparison"] = compare_with_baseline(results, json.load(f), args.tolerance)
+    regressed = bool(results["comparison"]["regressions"])
+    print(f"Regressions against {baseline_path}: {results['comparison']['regressions'] or 'none'}", file=sys.stderr)
+
+  output = json.dumps(results, indent=2)
+  if output_path:
+    with open(output_path, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+  if regressed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
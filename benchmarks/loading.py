@@ -0,0 +1,90 @@
+"""
+Loading Benchmark:
+Compares the in-memory loader path (PyPDFLoader.load then split) against the streaming loader,
+both in process and with page ranges parsed across a process pool.
+Each run happens in a fresh process so peak RSS is measured per path.
+
+python -m benchmarks.loading --pages 50 500 2000 --processes 4
+"""
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.pdf_utils import write_text_pdf
+import multiprocessing
+import argparse
+import tempfile
+import resource
+import json
+import time
+import sys
+import os
+
+PATHS = ["load", "streaming", "parallel"]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+  # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+  scale = 1 if sys.platform == "darwin" else 1024
+  return resource.getrusage(who).ru_maxrss * scale / (1024 * 1024)
+
+def run_path(path: str, file_path: str, processes: int) -> dict:
+  from langchain_community.document_loaders import PyPDFLoader
+  from document_utils import iter_chunks, text_splitter
+
+  baseline_rss = peak_rss_mb()
+  start = time.perf_counter()
+  chunk_count = 0
+
+  if path == "load":
+    chunks = text_splitter.split_documents(PyPDFLoader(file_path).load())
+    chunk_count = len(chunks)
+
+  elif path == "streaming":
+    for _ in iter_chunks(file_path):
+      chunk_count += 1
+
+  else:
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+      for _ in iter_chunks(file_path, executor=executor, max_in_flight=processes * 2):
+        chunk_count += 1
+
+  return {
+    "path": path,
+    "chunks": chunk_count,
+    "wall_seconds": round(time.perf_counter() - start, 3),
+    "peak_rss_mb": round(peak_rss_mb(), 1),
+    "peak_rss_growth_mb": round(peak_rss_mb() - baseline_rss, 1),
+    "worker_peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description="Compare memory and wall time of document loading paths")
+  parser.add_argument("--pages", type=int, nargs="+", default=[50, 500, 2000])
+  parser.add_argument("--processes", type=int, default=os.cpu_count() or 2)
+  parser.add_argument("--paths", nargs="+", choices=PATHS, default=PATHS)
+  parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+  args = parser.parse_args()
+
+  results = []
+  with tempfile.TemporaryDirectory() as temp_dir:
+    for pages in args.pages:
+      file_path = os.path.join(temp_dir, f"benchmark_{pages}.pdf")
+      write_text_pdf(file_path, pages)
+
+      for path in args.paths:
+        # Fresh process per run so peak RSS is not carried over between paths
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as runner:
+          result = runner.submit(run_path, path, file_path, args.processes).result()
+
+        result.update(pages=pages, file_size_mb=round(os.path.getsize(file_path) / (1024 * 1024), 2))
+        print(f"{pages} pages, {path}: {result['wall_seconds']}s, peak RSS {result['peak_rss_mb']} MB", file=sys.stderr)
+        results.append(result)
+
+  output = json.dumps({"benchmark": "loading", "processes": args.processes, "results": results}, indent=2)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,41 @@
+from typing import List
+
+
+# Escape text for a PDF string literal
+def escape_pdf_text(text: str) -> str:
+  return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+# Write a plain text PDF with the given number of pages, without any PDF library
+def write_text_pdf(path: str, pages: int, lines_per_page: int = 45):
+  page_ids = [3 + 2 * i for i in range(pages)]
+  font_id = 3 + 2 * pages
+  offsets = {}
+
+  with open(path, "wb") as f:
+    def write_object(object_id: int, body: bytes):
+      offsets[object_id] = f.tell()
+      f.write(f"{object_id} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    f.write(b"%PDF-1.4\n")
+    write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+
+    # Pages are written one at a time so large files do not build up in memory
+    for page_number, page_id in enumerate(page_ids):
+      lines: List[str] = [
+        escape_pdf_text(f"Page {page_number} line {line}: section {page_number * lines_per_page + line} covers topic {(page_number + line) % 97} in detail.")
+        for line in range(lines_per_page)
+      ]
+      content = ("BT /F1 10 Tf 40 800 Td 14 TL " + " ".join(f"({line}) '" for line in lines) + " ET").encode()
+
+      write_object(page_id, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Contents {page_id + 1} 0 R /Resources << /Font << /F1 {font_id} 0 R >> >> >>".encode())
+      write_object(page_id + 1, f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream")
+
+    write_object(font_id, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    xref_offset = f.tell()
+    f.write(f"xref\n0 {font_id + 1}\n0000000000 65535 f \n".encode())
+    for object_id in range(1, font_id + 1):
+      f.write(f"{offsets[object_id]:010d} 00000 n \n".encode())
+    f.write(f"trailer << /Size {font_id + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
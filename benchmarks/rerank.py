@@ -0,0 +1,96 @@
+"""
+Re-rank Benchmark:
+Times the re-ranking stage (dedupe, maximal marginal relevance, merging overlapping neighbours)
+over synthetic retrieved candidates, next to the maximal_marginal_relevance helper shipped with langchain_core.
+Candidates come from a few pages split with the app text splitter, so neighbours overlap like real chunks.
+k=50 re-ranks every candidate, the cost of the selection loop at its largest.
+
+python -m benchmarks.rerank --candidates 50 --k 2 8 50 --dimensions 1536
+"""
+from langchain_core.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+import numpy as np
+import argparse
+import json
+import time
+import sys
+
+
+def make_candidates(count: int, dimensions: int, seed: int = 0):
+  from document_utils import text_splitter
+
+  rng = np.random.default_rng(seed)
+  vocabulary = [f"term{i}" for i in range(2000)]
+
+  docs = []
+  page = 0
+  while len(docs) < count:
+    text = " ".join(rng.choice(vocabulary, size=900))
+    docs.extend(text_splitter.split_documents([Document(page_content=text, metadata={"file_id": "bench", "page": page})]))
+    page += 1
+  docs = docs[:count]
+
+  # Neighbouring chunks share text, so their embeddings are close
+  base = rng.normal(size=(count, dimensions)).astype(np.float32)
+  embeddings = base + 0.8 * np.roll(base, 1, axis=0)
+  query = embeddings[: count // 5].mean(axis=0) + rng.normal(size=dimensions).astype(np.float32)
+
+  # Chroma returns stored embeddings as a numpy matrix
+  return query.tolist(), docs, embeddings
+
+def time_runs(run, repeat: int) -> float:
+  run()
+  start = time.perf_counter()
+  for _ in range(repeat):
+    run()
+  return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+  from rerank_utils import rerank_chunks, mmr_select
+
+  parser = argparse.ArgumentParser(description="Time the re-ranking stage over retrieved candidates")
+  parser.add_argument("--candidates", type=int, default=50)
+  parser.add_argument("--k", type=int, nargs="+", default=[2, 8, 50])
+  parser.add_argument("--dimensions", type=int, default=1536)
+  parser.add_argument("--repeat", type=int, default=200)
+  parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+  args = parser.parse_args()
+
+  query, docs, embeddings = make_candidates(args.candidates, args.dimensions)
+  context_chars = sum(len(doc.page_content) for doc in docs)
+
+  results = []
+  for k in args.k:
+    reranked = rerank_chunks(query, docs, embeddings, k=k)
+    top_k_chars = sum(len(doc.page_content) for doc in docs[:k])
+    reranked_chars = sum(len(doc.page_content) for doc in reranked)
+
+    result = {
+      "k": k,
+      "rerank_ms": round(time_runs(lambda: rerank_chunks(query, docs, embeddings, k=k), args.repeat), 3),
+      "mmr_ms": round(time_runs(lambda: mmr_select(query, embeddings, k=k), args.repeat), 3),
+      "langchain_mmr_ms": round(time_runs(lambda: maximal_marginal_relevance(np.array(query), embeddings, k=k, lambda_mult=0.7), args.repeat), 3),
+      "chunks_out": len(reranked),
+      "top_k_chars": top_k_chars,
+      "reranked_chars": reranked_chars
+    }
+    print(f"k={k}: rerank {result['rerank_ms']} ms, langchain mmr {result['langchain_mmr_ms']} ms", file=sys.stderr)
+    results.append(result)
+
+  output = json.dumps({
+    "benchmark": "rerank",
+    "candidates": args.candidates,
+    "dimensions": args.dimensions,
+    "candidate_chars": context_chars,
+    "results": results
+  }, indent=2)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+"""
+Vector Index Benchmark:
+Compares vector search in Chroma against the memory-mapped index (int8, float16 and int8 with IVF lists)
+over synthetic clustered embeddings, the way real chunks cluster around the topics of their documents.
+Recall@k is measured against exact float32 search, queries run one at a time like chat requests.
+
+python -m benchmarks.vector_index --chunks 20000 --dimensions 1536 --queries 200
+"""
+import numpy as np
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+ENGINES = ["chroma", "int8", "float16", "int8-ivf"]
+
+
+def make_embeddings(count: int, dimensions: int, clusters: int, seed: int = 0):
+  rng = np.random.default_rng(seed)
+  centres = rng.normal(size=(clusters, dimensions)).astype(np.float32)
+  embeddings = centres[rng.integers(0, clusters, count)] + 0.6 * rng.normal(size=(count, dimensions)).astype(np.float32)
+
+  # OpenAI embeddings are unit length
+  return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def make_queries(embeddings: np.ndarray, count: int, seed: int = 1):
+  rng = np.random.default_rng(seed)
+  queries = embeddings[rng.integers(0, len(embeddings), count)] + 0.5 * rng.normal(size=(count, embeddings.shape[1])).astype(np.float32) / np.sqrt(embeddings.shape[1])
+  return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def directory_size_mb(directory: str) -> float:
+  total = 0
+  for root, _, files in os.walk(directory):
+    total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+  return round(total / (1024 * 1024), 2)
+
+def build_chroma(directory: str, ids, embeddings, metadatas):
+  import chromadb
+
+  collection = chromadb.PersistentClient(path=directory).get_or_create_collection("benchmark")
+  for start in range(0, len(ids), 1000):
+    collection.add(ids=ids[start:start + 1000], embeddings=embeddings[start:start + 1000], metadatas=metadatas[start:start + 1000])
+
+  return lambda query, k: collection.query(query_embeddings=[query.tolist()], n_results=k, include=["distances"])["ids"][0]
+
+def build_mmap(directory: str, engine: str, ids, embeddings, metadatas):
+  from vector_index import MmapVectorIndex
+
+  index = MmapVectorIndex(directory, dtype=engine.split("-")[0], ivf=engine.endswith("ivf"))
+  for start in range(0, len(ids), 1000):
+    index.add(ids[start:start + 1000], embeddings[start:start + 1000], metadatas[start:start + 1000])
+  index.maintain()
+
+  return lambda query, k: [chunk_id for chunk_id, _ in index.search(query, k)]
+
+def main():
+  parser = argparse.ArgumentParser(description="Compare recall and queries per second of vector search engines")
+  parser.add_argument("--chunks", type=int, default=20000)
+  parser.add_argument("--dimensions", type=int, default=1536)
+  parser.add_argument("--clusters", type=int, default=200)
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--k", type=int, default=20)
+  parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+  parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+  args = parser.parse_args()
+
+  embeddings = make_embeddings(args.chunks, args.dimensions, args.clusters)
+  queries = make_queries(embeddings, args.queries)
+  ids = [f"{i:064x}" for i in range(args.chunks)]
+  metadatas = [{"file_id": f"file{i // 100}", "page": i % 10} for i in range(args.chunks)]
+
+  # Exact float32 neighbours are the ground truth
+  truth = [set(np.argsort(-(embeddings @ query))[:args.k].tolist()) for query in queries]
+
+  results = []
+  with tempfile.TemporaryDirectory() as temp_dir:
+    for engine in args.engines:
+      directory = os.path.join(temp_dir, engine)
+
+      start = time.perf_counter()
+      if engine == "chroma":
+        search = build_chroma(directory, ids, embeddings, metadatas)
+      else:
+        search = build_mmap(directory, engine, ids, embeddings, metadatas)
+      build_seconds = time.perf_counter() - start
+
+      search(queries[0], args.k)
+      start = time.perf_counter()
+      found = [search(query, args.k) for query in queries]
+      search_seconds = time.perf_counter() - start
+
+      recall = np.mean([len(expected & {int(chunk_id, 16) for chunk_id in ranked}) / args.k for expected, ranked in zip(truth, found)])
+
+      result = {
+        "engine": engine,
+        "recall_at_k": round(float(recall), 4),
+        "queries_per_second": round(args.queries / search_seconds, 1),
+        "mean_query_ms": round(search_seconds / args.queries * 1000, 3),
+        "build_seconds": round(build_seconds, 2),
+        "size_mb": directory_size_mb(directory)
+      }
+      print(f"{engine}: recall@{args.k} {result['recall_at_k']}, {result['queries_per_second']} queries/s, {result['size_mb']} MB", file=sys.stderr)
+      results.append(result)
+
+  output = json.dumps({
+    "benchmark": "vector_index",
+    "chunks": args.chunks,
+    "dimensions": args.dimensions,
+    "k": args.k,
+    "results": results
+  }, indent=2)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,562 @@
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import threading
+import pickle
+import struct
+import math
+import re
+import os
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Identifiers such as ERR-4021 or v1.2.3 are kept whole as well as split into their parts
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*")
+PART_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = {
+  "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it",
+  "of", "on", "or", "that", "the", "this", "to", "was", "were", "will", "with"
+}
+
+# Rebuild postings once this share of indexed chunks has been removed
+COMPACT_DEAD_RATIO = 0.25
+
+# Terms found in more than this share of chunks only rescore the chunks matched by rarer query terms
+MAX_TERM_DF_RATIO = 0.05
+
+# Per posting scores are cached for terms with at least this many postings
+IMPACT_CACHE_MIN_POSTINGS = 10000
+
+# Common terms keep a score for every row so rescoring is a lookup, this bounds how many are kept
+DENSE_IMPACT_CACHE_TERMS = 32
+
+# Fold the change log into a new snapshot once it passes this share of the snapshot size, and at least this many bytes
+COMPACT_LOG_RATIO = 0.5
+COMPACT_LOG_MIN_BYTES = 1 << 20
+
+# Every change log record is prefixed with its length
+FRAME_HEADER = struct.Struct("<Q")
+
+
+def tokenize(text: str) -> List[str]:
+  tokens = TOKEN_PATTERN.findall(text.lower())
+
+  # Split compound tokens into their parts as well
+  compounds = [token for token in tokens if not token.isalnum()]
+  if compounds:
+    tokens.extend(PART_PATTERN.findall(" ".join(compounds)))
+
+  return [token for token in tokens if token not in STOP_WORDS]
+
+
+"""
+BM25 Index:
+1. Each chunk gets a row number, postings map a term to the rows containing it and the term counts
+2. Postings are stdlib arrays so adding chunks appends in place and queries read them as numpy arrays without copying
+3. Removed chunks are only marked dead, postings are rebuilt once dead rows pass COMPACT_DEAD_RATIO
+4. A query scores the rows in the postings of its rarer terms with vectorised BM25 and keeps the top k,
+   terms found in more than MAX_TERM_DF_RATIO of chunks only add their score to those rows
+5. Per posting scores of long posting lists are cached until the list or the average chunk length changes,
+   common terms cache them per row so rescoring a candidate is an array lookup
+6. Changes are saved as records appended to a change log next to a snapshot of the index,
+   a writer takes a file lock, replays the records other workers appended, then appends its own
+7. Readers replay only the records appended since their last read, a snapshot change means a full reload
+8. Once the log passes COMPACT_LOG_RATIO of the snapshot a new snapshot generation is written from a copy of the index,
+   so searches never wait while the snapshot is serialised
+
+Only chunk ids are kept, the text and metadata of a hit are read back from the vector store.
+file_rows is the file to chunk index, a search scoped to a few files scores only their rows.
+"""
+
+class BM25Index:
+  def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+    self.path = path
+    self.k1 = k1
+    self.b = b
+    self.lock_path = f"{os.path.splitext(path)[0]}.lock"
+    self._lock = threading.RLock()
+    self._write_lock = threading.Lock()
+    self._pending = []
+    self._generation = 0
+    self._snapshot_id = None
+    self._snapshot_size = 0
+    self._log_offset = 0
+    self._reset()
+
+  def _reset(self):
+    self.postings: Dict[str, Tuple[array, array]] = {}
+    self.chunk_ids: List[str] = []
+    self.rows: Dict[str, int] = {}
+    self.file_rows: Dict[str, List[int]] = {}
+    self.lengths = array("I")
+    self.alive = bytearray()
+    self.alive_count = 0
+    self.alive_length = 0
+    self._impacts = {}
+    self._dense_impacts = OrderedDict()
+
+  def __len__(self):
+    return self.alive_count
+
+  # Index chunks that carry ids, a chunk indexed before is replaced
+  def add(self, chunks: Iterable):
+    with self._lock:
+      entries = []
+      for chunk in chunks:
+        tokens = tokenize(chunk.page_content)
+        entry = (chunk.id, chunk.metadata.get("file_id"), Counter(tokens), len(tokens))
+        self._add_entry(*entry)
+        entries.append(entry)
+
+      self._pending.append(("add", entries))
+
+  def _add_entry(self, chunk_id: str, file_id, counts: Counter, length: int):
+    self._remove_row(self.rows.get(chunk_id))
+    row = len(self.chunk_ids)
+
+    for term, count in counts.items():
+      posting = self.postings.get(term)
+      if posting is None:
+        posting = self.postings[term] = (array("i"), array("H"))
+
+      posting[0].append(row)
+      posting[1].append(min(count, 65535))
+
+    self.chunk_ids.append(chunk_id)
+    self.rows[chunk_id] = row
+    self.file_rows.setdefault(file_id, []).append(row)
+    self.lengths.append(length)
+    self.alive.append(1)
+    self.alive_count += 1
+    self.alive_length += length
+
+  def _remove_row(self, row):
+    if row is None or not self.alive[row]:
+      return
+
+    self.alive[row] = 0
+    self.alive_count -= 1
+    self.alive_length -= self.lengths[row]
+    del self.rows[self.chunk_ids[row]]
+
+  def remove(self, chunk_ids: Iterable[str]):
+    with self._lock:
+      chunk_ids = list(chunk_ids)
+      for chunk_id in chunk_ids:
+        self._remove_row(self.rows.get(chunk_id))
+      self._compact_if_needed()
+
+      self._pending.append(("remove", chunk_ids))
+
+  # Remove every chunk of the files, compacting at most once
+  def remove_files(self, file_ids: Iterable[str]) -> int:
+    with self._lock:
+      file_ids = list(file_ids)
+      removed = self._remove_files(file_ids)
+      self._compact_if_needed()
+
+      self._pending.append(("remove_files", file_ids))
+      return removed
+
+  def _remove_files(self, file_ids: List[str]) -> int:
+    removed = 0
+    for file_id in file_ids:
+      rows = self.file_rows.pop(file_id, [])
+      for row in rows:
+        self._remove_row(row)
+      removed += len(rows)
+
+    return removed
+
+  # Apply change log records, written by this or another worker process
+  def _replay(self, records: List[tuple]):
+    for kind, items in records:
+      if kind == "add":
+        for entry in items:
+          self._add_entry(*entry)
+      elif kind == "remove":
+        for chunk_id in items:
+          self._remove_row(self.rows.get(chunk_id))
+      else:
+        self._remove_files(items)
+
+    self._compact_if_needed()
+
+  def _compact_if_needed(self):
+    dead = len(self.chunk_ids) - self.alive_count
+    if dead and dead >= COMPACT_DEAD_RATIO * len(self.chunk_ids):
+      self.compact()
+
+  # Drop dead rows from every posting list and renumber the live ones
+  def compact(self):
+    with self._lock:
+      alive = np.frombuffer(bytes(self.alive), dtype=np.uint8).astype(bool)
+      new_rows = np.cumsum(alive, dtype=np.int64) - 1
+
+      postings = {}
+      for term, (rows, term_counts) in self.postings.items():
+        rows = np.frombuffer(rows, dtype=np.int32)
+        keep = alive[rows]
+        if keep.any():
+          postings[term] = (
+            array("i", new_rows[rows[keep]].astype(np.int32).tobytes()),
+            array("H", np.frombuffer(term_counts, dtype=np.uint16)[keep].tobytes())
+          )
+
+      chunk_ids = [chunk_id for chunk_id, is_alive in zip(self.chunk_ids, alive) if is_alive]
+      file_rows = {}
+      for file_id, rows in self.file_rows.items():
+        live_rows = [int(new_rows[row]) for row in rows if alive[row]]
+        if live_rows:
+          file_rows[file_id] = live_rows
+
+      self.postings = postings
+      self.chunk_ids = chunk_ids
+      self.rows = {chunk_id: row for row, chunk_id in enumerate(chunk_ids)}
+      self.file_rows = file_rows
+      self.lengths = array("I", np.frombuffer(self.lengths, dtype=np.uint32)[alive].tobytes())
+      self.alive = bytearray(b"\x01" * len(chunk_ids))
+      self._impacts = {}
+      self._dense_impacts = OrderedDict()
+
+  # Returns (chunk_id, score) pairs for the k best matching chunks, only chunks of file_ids when given
+  def search(self, query: str, k: int, file_ids: Optional[List[str]] = None) -> List[Tuple[str, float]]:
+    with self._lock:
+      terms = [term for term in set(tokenize(query)) if term in self.postings]
+      if not terms or not self.alive_count:
+        return []
+
+      total_rows = len(self.chunk_ids)
+      avg_length = self.alive_length / self.alive_count
+      lengths = np.frombuffer(self.lengths, dtype=np.uint32)
+      alive = np.frombuffer(bytes(self.alive), dtype=np.uint8) if self.alive_count < total_rows else None
+      frequencies = self._document_frequencies(terms, alive)
+      scope = None
+
+      if file_ids is not None:
+        scope = self.file_rows_array(file_ids)
+        if not len(scope):
+          return []
+
+      # A small scope is scored on its own rows, so the cost follows the scope rather than the index
+      if scope is not None and len(scope) * 8 < total_rows:
+        candidates = scope
+        scores = self._score_rows(terms, frequencies, scope, lengths, avg_length)
+      else:
+        candidates, scores = self._score_postings(terms, frequencies, total_rows, lengths, avg_length)
+
+        if scope is not None:
+          in_scope = np.zeros(total_rows, dtype=bool)
+          in_scope[scope] = True
+          scores = scores * (in_scope if candidates is None else in_scope[candidates])
+
+        if alive is not None:
+          scores = scores * (alive if candidates is None else alive[candidates])
+
+      k = min(k, len(scores))
+      top = np.argpartition(-scores, k - 1)[:k]
+      top = top[np.argsort(-scores[top])]
+      top_rows = top if candidates is None else candidates[top]
+
+      return [(self.chunk_ids[row], float(scores[i])) for row, i in zip(top_rows, top) if scores[i] > 0]
+
+  # Number of live chunks containing each term, removed rows stay in the postings until the next compaction
+  def _document_frequencies(self, terms: List[str], alive: Optional[np.ndarray]) -> Dict[str, int]:
+    if alive is None:
+      return {term: len(self.postings[term][0]) for term in terms}
+
+    return {term: int(np.count_nonzero(alive[np.frombuffer(self.postings[term][0], dtype=np.int32)])) for term in terms}
+
+  # Scores rows found in the postings of the query terms, candidates is None when every row was scored
+  def _score_postings(self, terms: List[str], frequencies: Dict[str, int], total_rows: int, lengths: np.ndarray, avg_length: float):
+    # Common terms only rescore the chunks matched by rarer terms
+    rare_terms = [term for term in terms if frequencies[term] <= MAX_TERM_DF_RATIO * self.alive_count]
+    common_terms = [term for term in terms if term not in rare_terms]
+
+    if not rare_terms:
+      # Only common terms, every row is a candidate
+      scores = np.zeros(total_rows, dtype=np.float32)
+      for term in common_terms:
+        scores += np.float32(self._idf(frequencies[term])) * self._term_row_impacts(term, lengths, avg_length)
+
+      return None, scores
+
+    candidate_rows = []
+    candidate_scores = []
+    for term in rare_terms:
+      rows, impacts = self._term_postings(term, lengths, avg_length)
+      candidate_rows.append(rows)
+      candidate_scores.append(self._idf(frequencies[term]) * impacts)
+
+    rows = np.concatenate(candidate_rows)
+    term_scores = np.concatenate(candidate_scores)
+
+    # Sum per row sparsely when the postings are short, densely when they cover much of the index
+    if len(rows) * 8 < total_rows:
+      candidates, inverse = np.unique(rows, return_inverse=True)
+      scores = np.bincount(inverse, weights=term_scores)
+    else:
+      scores = np.bincount(rows, weights=term_scores, minlength=total_rows)
+      candidates = np.flatnonzero(scores)
+      scores = scores[candidates]
+
+    for term in common_terms:
+      scores += self._idf(frequencies[term]) * self._term_row_impacts(term, lengths, avg_length)[candidates]
+
+    return candidates, scores
+
+  # Scores the given sorted rows only, postings are sorted by row so membership is a binary search
+  def _score_rows(self, terms: List[str], frequencies: Dict[str, int], scope: np.ndarray, lengths: np.ndarray, avg_length: float) -> np.ndarray:
+    scores = np.zeros(len(scope), dtype=np.float64)
+
+    for term in terms:
+      rows, impacts = self._term_postings(term, lengths, avg_length)
+      positions = np.minimum(np.searchsorted(rows, scope), len(rows) - 1)
+      found = rows[positions] == scope
+      scores[found] += self._idf(frequencies[term]) * impacts[positions[found]]
+
+    return scores
+
+  # Sorted live rows of the files, from the file to chunk index
+  def file_rows_array(self, file_ids: List[str]) -> np.ndarray:
+    with self._lock:
+      rows = [row for file_id in set(file_ids) for row in self.file_rows.get(file_id, ()) if self.alive[row]]
+      return np.array(sorted(rows), dtype=np.int64)
+
+  def file_chunk_count(self, file_ids: List[str]) -> int:
+    return len(self.file_rows_array(file_ids))
+
+  def _idf(self, document_frequency: int) -> float:
+    return math.log(1 + (self.alive_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+  # Rows of a term and the term frequency part of its BM25 score for each of them
+  def _term_postings(self, term: str, lengths: np.ndarray, avg_length: float) -> Tuple[np.ndarray, np.ndarray]:
+    rows = np.frombuffer(self.postings[term][0], dtype=np.int32)
+
+    cached = self._impacts.get(term)
+    if cached is not None and cached[0] == len(rows) and abs(cached[1] - avg_length) <= 0.01 * avg_length:
+      return rows, cached[2]
+
+    term_counts = np.frombuffer(self.postings[term][1], dtype=np.uint16).astype(np.float32)
+    norm = self.k1 * (1 - self.b + self.b * lengths[rows] / np.float32(avg_length))
+    impacts = term_counts * (self.k1 + 1) / (term_counts + norm)
+
+    if len(rows) >= IMPACT_CACHE_MIN_POSTINGS:
+      self._impacts[term] = (len(rows), avg_length, impacts)
+
+    return rows, impacts
+
+  # Term frequency part of the BM25 score of a term for every row, zero where the term is missing
+  def _term_row_impacts(self, term: str, lengths: np.ndarray, avg_length: float) -> np.ndarray:
+    rows, impacts = self._term_postings(term, lengths, avg_length)
+    key = (len(rows), len(lengths), avg_length)
+
+    cached = self._dense_impacts.get(term)
+    if cached is not None and cached[0] == key:
+      self._dense_impacts.move_to_end(term)
+      return cached[1]
+
+    row_impacts = np.zeros(len(lengths), dtype=np.float32)
+    row_impacts[rows] = impacts
+
+    self._dense_impacts[term] = (key, row_impacts)
+    while len(self._dense_impacts) > DENSE_IMPACT_CACHE_TERMS:
+      self._dense_impacts.popitem(last=False)
+
+    return row_impacts
+
+  def _log_path(self, generation: int) -> str:
+    return f"{os.path.splitext(self.path)[0]}.{generation}.log"
+
+  # Inode and mtime of the snapshot, a new snapshot is renamed into place so either changes
+  def _file_id(self):
+    try:
+      stat = os.stat(self.path)
+    except FileNotFoundError:
+      return None
+    return stat.st_ino, stat.st_mtime_ns
+
+  # Complete records of the log from offset on, a record still being written is left for the next read
+  def _read_log(self, generation: int, offset: int) -> Tuple[List[tuple], int]:
+    try:
+      with open(self._log_path(generation), "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    except FileNotFoundError:
+      return [], offset
+
+    records = []
+    position = 0
+    while position + FRAME_HEADER.size <= len(data):
+      (size,) = FRAME_HEADER.unpack_from(data, position)
+      end = position + FRAME_HEADER.size + size
+      if end > len(data):
+        break
+
+      records.append(pickle.loads(data[position + FRAME_HEADER.size:end]))
+      position = end
+
+    return records, offset + position
+
+  # Returns False if there is no saved index
+  def load(self) -> bool:
+    # Read outside the index lock, retrying if a new snapshot replaced the one read
+    while True:
+      snapshot_id = self._file_id()
+      state = None
+      snapshot_size = 0
+      if snapshot_id is not None:
+        try:
+          with open(self.path, "rb") as f:
+            snapshot_size = os.fstat(f.fileno()).st_size
+            state = pickle.load(f)
+        except FileNotFoundError:
+          continue
+
+      generation = state.get("generation", 0) if state else 0
+      records, offset = self._read_log(generation, 0)
+      if self._file_id() == snapshot_id:
+        break
+
+    with self._lock:
+      self._reset()
+      if state:
+        self.postings = state["postings"]
+        self.chunk_ids = state["chunk_ids"]
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(self.chunk_ids)}
+        self.file_rows = state["file_rows"]
+        self.lengths = state["lengths"]
+        self.alive = bytearray(b"\x01" * len(self.chunk_ids))
+        self.alive_count = len(self.chunk_ids)
+        self.alive_length = state["alive_length"]
+
+      self._generation = generation
+      self._snapshot_id = snapshot_id
+      self._snapshot_size = snapshot_size
+      self._log_offset = offset
+      self._replay(records)
+
+      # Changes of this worker that are not saved yet stay on top of the loaded index
+      self._replay(self._pending)
+
+      return state is not None or bool(records)
+
+  # Pick up changes saved by another worker process, only the records appended since the last read are replayed
+  def reload_if_changed(self):
+    if self._file_id() != self._snapshot_id:
+      self.load()
+      return
+
+    generation, offset = self._generation, self._log_offset
+    try:
+      if os.path.getsize(self._log_path(generation)) <= offset:
+        return
+    except FileNotFoundError:
+      return
+
+    records, new_offset = self._read_log(generation, offset)
+    with self._lock:
+      # Another thread replayed them first
+      if (self._generation, self._log_offset) != (generation, offset):
+        return
+
+      self._replay(records)
+      self._log_offset = new_offset
+
+      # Changes of this worker that are not saved yet come after the replayed ones, like in the log once saved
+      if records:
+        self._replay(self._pending)
+
+  # One writer at a time across threads and worker processes, working on the latest saved index
+  @contextmanager
+  def _writing(self):
+    with self._write_lock:
+      os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+      with open(self.lock_path, "w") as lock_file:
+        if fcntl:
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+          self.reload_if_changed()
+          yield
+        finally:
+          if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  # Append the changes made since the last save to the log, folding the log into a new snapshot when it grew large
+  def save(self):
+    with self._writing():
+      with self._lock:
+        records, self._pending = self._pending, []
+
+      if records:
+        data = b"".join(FRAME_HEADER.pack(len(record)) + record for record in (
+          pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL) for record in records
+        ))
+
+        with open(self._log_path(self._generation), "ab") as f:
+          # Drop the end of a record left by a writer that crashed
+          f.truncate(self._log_offset)
+          f.write(data)
+        self._log_offset += len(data)
+
+      if self._log_offset > max(COMPACT_LOG_MIN_BYTES, COMPACT_LOG_RATIO * self._snapshot_size):
+        self._write_snapshot()
+
+  # Write then rename so readers never see a partial file. Searches only wait while the arrays are copied,
+  # the copy is compacted and serialised outside the lock. Changes of this worker that are not saved yet
+  # end up in the snapshot too, replaying them from the log once they are saved changes nothing
+  def _write_snapshot(self):
+    saved = BM25Index(self.path, self.k1, self.b)
+    with self._lock:
+      saved.postings = {term: (rows[:], term_counts[:]) for term, (rows, term_counts) in self.postings.items()}
+      saved.chunk_ids = self.chunk_ids[:]
+      saved.file_rows = {file_id: rows[:] for file_id, rows in self.file_rows.items()}
+      saved.lengths = self.lengths[:]
+      saved.alive = self.alive[:]
+      saved.alive_count = self.alive_count
+      saved.alive_length = self.alive_length
+
+    saved.compact()
+
+    generation = self._generation + 1
+    state = {
+      "generation": generation,
+      "postings": saved.postings,
+      "chunk_ids": saved.chunk_ids,
+      "file_rows": saved.file_rows,
+      "lengths": saved.lengths,
+      "alive_length": saved.alive_length
+    }
+
+    temp_path = f"{self.path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+      pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, self.path)
+
+    try:
+      os.remove(self._log_path(generation - 1))
+    except FileNotFoundError:
+      pass
+
+    # This index holds every change in the snapshot, it only moves on to the new log
+    with self._lock:
+      self._generation = generation
+      self._snapshot_id = self._file_id()
+      self._snapshot_size = os.path.getsize(self.path)
+      self._log_offset = 0
+
+  def stats(self):
+    return {
+      "chunks": self.alive_count,
+      "terms": len(self.postings),
+      "dead_rows": len(self.chunk_ids) - self.alive_count,
+      "log_bytes": self._log_offset
+    }
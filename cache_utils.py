@@ -0,0 +1,203 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional
+import threading
+import asyncio
+import json
+import time
+import config
+
+
+"""
+Session History Cache:
+1. First read of a session loads its history from the database and stores it in the cache
+2. Every chat log written is appended to the cached history of its session
+3. Later turns read history from the cache only
+
+The backend is pluggable: the local backend is an in-process LRU with TTL eviction,
+the redis backend shares the cache across workers
+
+The local backend is for a single worker process. With several workers a session cached by one worker
+misses the turns another worker answered until its entry expires, so the default backend is redis
+when WEB_CONCURRENCY is above 1, and choosing local there logs a warning
+"""
+
+# In-process LRU cache where entries also expire after ttl_seconds
+class LRUTTLCache:
+  def __init__(self, max_entries: int, ttl_seconds: float):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+
+      if entry is None:
+        return None
+
+      expires_at, value = entry
+      if expires_at < time.monotonic():
+        del self._entries[key]
+        return None
+
+      self._entries.move_to_end(key)
+      return value
+
+  def set(self, key, value):
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+      self._entries.move_to_end(key)
+
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def delete(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class SessionCacheBackend(ABC):
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+
+  @abstractmethod
+  def get(self, session_id: str) -> Optional[List[dict]]:
+    ...
+
+  @abstractmethod
+  def set(self, session_id: str, messages: List[dict]):
+    ...
+
+  # Append to a cached session, sessions that are not cached are left to be loaded on next read
+  @abstractmethod
+  def append(self, session_id: str, messages: List[dict]):
+    ...
+
+  @abstractmethod
+  def delete(self, session_id: str):
+    ...
+
+  async def aget(self, session_id: str) -> Optional[List[dict]]:
+    return self.get(session_id)
+
+  async def aset(self, session_id: str, messages: List[dict]):
+    self.set(session_id, messages)
+
+  async def aappend(self, session_id: str, messages: List[dict]):
+    self.append(session_id, messages)
+
+  def record(self, messages):
+    if messages is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return messages
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses}
+
+
+# Sessions cached in this process
+class LocalSessionCacheBackend(SessionCacheBackend):
+  def __init__(self, max_sessions: int, ttl_seconds: float):
+    super().__init__()
+    self.cache = LRUTTLCache(max_entries=max_sessions, ttl_seconds=ttl_seconds)
+    self._lock = threading.Lock()
+
+  def get(self, session_id):
+    messages = self.cache.get(session_id)
+    return self.record(list(messages) if messages is not None else None)
+
+  def set(self, session_id, messages):
+    self.cache.set(session_id, list(messages))
+
+  def append(self, session_id, messages):
+    with self._lock:
+      cached = self.cache.get(session_id)
+      if cached is not None:
+        self.cache.set(session_id, cached + list(messages))
+
+  def delete(self, session_id):
+    self.cache.delete(session_id)
+
+  def stats(self):
+    return {**super().stats(), "backend": "local", "sessions": len(self.cache)}
+
+
+# Sessions cached in redis so every worker shares them
+class RedisSessionCacheBackend(SessionCacheBackend):
+  # First list element marks a cached session, so sessions with no history are cached too
+  MARKER = "__session__"
+
+  def __init__(self, url: str, ttl_seconds: float, prefix: str = "session_history:"):
+    super().__init__()
+    try:
+      import redis
+    except ImportError:
+      raise ImportError("redis package not found, install it with `pip install redis` to use the redis session cache")
+
+    self.client = redis.Redis.from_url(url)
+    self.ttl_seconds = int(ttl_seconds)
+    self.prefix = prefix
+
+  def get(self, session_id):
+    key = self.prefix + session_id
+    pipeline = self.client.pipeline()
+    pipeline.lrange(key, 0, -1)
+    pipeline.expire(key, self.ttl_seconds)
+    items = pipeline.execute()[0]
+
+    if not items:
+      return self.record(None)
+
+    return self.record([json.loads(item) for item in items[1:]])
+
+  def set(self, session_id, messages):
+    key = self.prefix + session_id
+    pipeline = self.client.pipeline()
+    pipeline.delete(key)
+    pipeline.rpush(key, self.MARKER, *[json.dumps(message) for message in messages])
+    pipeline.expire(key, self.ttl_seconds)
+    pipeline.execute()
+
+  def append(self, session_id, messages):
+    # rpushx only appends when the session is already cached
+    key = self.prefix + session_id
+    self.client.rpushx(key, *[json.dumps(message) for message in messages])
+
+  def delete(self, session_id):
+    self.client.delete(self.prefix + session_id)
+
+  async def aget(self, session_id):
+    return await asyncio.to_thread(self.get, session_id)
+
+  async def aset(self, session_id, messages):
+    await asyncio.to_thread(self.set, session_id, messages)
+
+  async def aappend(self, session_id, messages):
+    await asyncio.to_thread(self.append, session_id, messages)
+
+  def stats(self):
+    return {**super().stats(), "backend": "redis"}
+
+
+def create_session_cache(backend: str) -> SessionCacheBackend:
+  if backend == "redis":
+    return RedisSessionCacheBackend(url=config.SESSION_CACHE_REDIS_URL, ttl_seconds=config.SESSION_CACHE_TTL_SECONDS)
+
+  if config.WEB_CONCURRENCY > 1:
+    print(f"Local session cache with {config.WEB_CONCURRENCY} workers, each worker only sees the turns it answered, use the redis backend")
+
+  return LocalSessionCacheBackend(max_sessions=config.SESSION_CACHE_MAX_SESSIONS, ttl_seconds=config.SESSION_CACHE_TTL_SECONDS)
+
+session_cache = create_session_cache(config.SESSION_CACHE_BACKEND)
@@ -1,89 +1,433 @@
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredHTMLLoader
-from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from typing import List
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from lazy_utils import LazySingleton
+from metrics import timed, record_stage, request_seconds, indexed_chunks
+from bm25_index import BM25Index
+from vector_index import MmapVectorIndex
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from collections import defaultdict
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional
+import threading
+import hashlib
+import json
 import os
+import time
+import config
 from dotenv import load_dotenv
 
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# Initialise Text Splitter
-text_splitter = RecursiveCharacterTextSplitter(
-  chunk_size=1000,
-  chunk_overlap=200,
-  length_function=len
+# Initialise Embedding Function behind the persistent embedding cache, on first use
+def init_embedding_function():
+  from langchain_openai import OpenAIEmbeddings
+  
+  openai_embeddings = OpenAIEmbeddings()
+  embedding_cache = EmbeddingCache(path=config.EMBEDDING_CACHE_PATH, max_entries=config.EMBEDDING_CACHE_MAX_ENTRIES)
+  return CachedEmbeddings(openai_embeddings, embedding_cache, model=openai_embeddings.model)
+
+embedding_function = LazySingleton("embeddings", init_embedding_function)
+
+# Intialiase Chroma Vector Db, on first use
+CHROMA_PERSIST_DIRECTORY = "./chroma_db"
+
+def init_vector_store():
+  from langchain_chroma import Chroma
+  
+  return Chroma(persist_directory=CHROMA_PERSIST_DIRECTORY, embedding_function=embedding_function)
+
+vector_store = LazySingleton("chroma", init_vector_store)
+
+# Corpus version is bumped whenever chunks are added or removed, kept on disk so every worker sees it
+CORPUS_VERSION_PATH = os.path.join(CHROMA_PERSIST_DIRECTORY, "corpus_version")
+corpus_version_lock = threading.Lock()
+
+def get_corpus_version() -> int:
+  try:
+    with open(CORPUS_VERSION_PATH) as f:
+      return int(f.read().strip() or 0)
+  except FileNotFoundError:
+    return 0
+
+def bump_corpus_version() -> int:
+  with corpus_version_lock:
+    version = get_corpus_version() + 1
+    
+    # Write then rename so readers never see a partial file
+    temp_path = f"{CORPUS_VERSION_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+      f.write(str(version))
+    os.replace(temp_path, CORPUS_VERSION_PATH)
+    
+    return version
+
+# Chroma rejects requests larger than its max batch size
+CHROMA_BATCH_SIZE = 1000
+
+# BM25 index over the same chunks, kept next to the Chroma files
+BM25_INDEX_PATH = os.path.join(CHROMA_PERSIST_DIRECTORY, "bm25_index.pkl")
+bm25_index = BM25Index(path=BM25_INDEX_PATH)
+
+# Rebuild the lexical index from the chunks already in Chroma, for stores indexed before it existed
+def rebuild_bm25_index():
+  offset = 0
+  while True:
+    page = vector_store._collection.get(include=["documents", "metadatas"], limit=CHROMA_BATCH_SIZE, offset=offset)
+    if not page["ids"]:
+      break
+    
+    bm25_index.add(
+      Document(id=chunk_id, page_content=content, metadata=metadata or {})
+      for chunk_id, content, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+    )
+    offset += len(page["ids"])
+    
+  bm25_index.save()
+  print(f"Built BM25 index over {len(bm25_index)} chunks")
+
+# Memory-mapped vector index over the same embeddings, only maintained when it answers vector search
+VECTOR_INDEX_DIRECTORY = os.path.join(CHROMA_PERSIST_DIRECTORY, "vector_index")
+vector_index = MmapVectorIndex(
+  directory=VECTOR_INDEX_DIRECTORY,
+  dtype=config.VECTOR_INDEX_DTYPE,
+  ivf=config.VECTOR_INDEX_IVF,
+  ivf_lists=config.VECTOR_INDEX_IVF_LISTS,
+  ivf_probe=config.VECTOR_INDEX_IVF_PROBE
 )
+use_vector_index = config.VECTOR_ENGINE == "mmap"
 
-# Initialise Embedding Function
-embedding_function = OpenAIEmbeddings()
+# Rebuild the vector index from the embeddings stored in Chroma
+def rebuild_vector_index():
+  vector_index.clear()
+  
+  offset = 0
+  while True:
+    page = vector_store._collection.get(include=["embeddings", "metadatas"], limit=CHROMA_BATCH_SIZE, offset=offset)
+    if not page["ids"]:
+      break
+    
+    vector_index.add(page["ids"], page["embeddings"], page["metadatas"])
+    offset += len(page["ids"])
+  
+  vector_index.maintain(get_corpus_version())
+  print(f"Built vector index over {len(vector_index)} chunks")
+
+# Bump the corpus version, compacting the vector index and recording the version it reflects
+def publish_changes():
+  version = bump_corpus_version()
+  if use_vector_index:
+    vector_index.maintain(version)
 
-# Intialiase Chroma Vector Db
-vector_store = Chroma(persist_directory="./chroma_db", embedding_function=embedding_function)
+# Load the BM25 and vector indexes, rebuilding them from Chroma when they are missing or out of date
+def load_search_indexes():
+  if not bm25_index.load() and vector_store._collection.count():
+    rebuild_bm25_index()
+  
+  # An index left behind by a crashed write, or by a run on the chroma engine, no longer matches the corpus
+  if use_vector_index:
+    if not vector_index.load() or not vector_index.matches_dtype() or vector_index.manifest["corpus_version"] != get_corpus_version():
+      rebuild_vector_index()
+  
+  return True
+
+search_indexes = LazySingleton("search_indexes", load_search_indexes)
+
+# Every path reading or writing the indexes loads them first, so a write never lands on an index that was not loaded
+def ensure_search_indexes():
+  search_indexes.get()
 
 
 """
 Indexing Documents: 
-1. Load documents using document loaders
-2. Split documents into chunks using text splitters
-3. Embed and store chunks into vector store
+1. Load documents page by page using document loaders
+2. Split pages into chunks using text splitters as they are loaded
+3. Embed chunks in batches with bounded parallel requests, reusing cached embeddings for chunks seen before
+4. Store each batch into vector store as soon as it is embedded, while later batches are still embedding
+5. Add each stored batch to the BM25 index, which is saved once the file is done
+6. Embedding, storing and saving are timed into rag_stage_seconds under the index operation,
+   with the chunks split by whether their embedding came from the cache
+
+Chunk ids are derived from the file id, the chunk content and which occurrence of that content it is in the file,
+so re-indexing a file yields the same ids for unchanged chunks and updates only embed what changed
 """
 
-def load_and_split_documents(file_path: str) -> List[Document]:
-  # Choose respective loader
-  if file_path.endswith('.pdf'):
-    document_loader = PyPDFLoader(file_path)
+# Metadata that differs between two uploads of the same content, left out of the update diff.
+# job_id marks the chunks an update job added, so an interrupted update can be rolled back
+VOLATILE_METADATA_FIELDS = ("creationdate", "moddate", "job_id")
+
+def stable_metadata(metadata: dict) -> dict:
+  return {key: value for key, value in metadata.items() if key not in VOLATILE_METADATA_FIELDS}
+
+# Give each chunk a stable id from its file, content and occurrence of that content in the file
+# source replaces the path of the temp file the upload was parsed from with the uploaded filename
+def with_chunk_ids(chunks: Iterable[Document], file_id: str, source: Optional[str] = None) -> Iterator[Document]:
+  occurrences = defaultdict(int)
   
-  elif file_path.endswith('.docx'):
-    document_loader = Docx2txtLoader(file_path)
+  for chunk in chunks:
+    content_hash = hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()
+    occurrence = occurrences[content_hash]
+    occurrences[content_hash] += 1
+    
+    chunk.id = hashlib.sha256(f"{file_id}:{content_hash}:{occurrence}".encode("utf-8")).hexdigest()
+    chunk.metadata['file_id'] = file_id
+    if source is not None:
+      chunk.metadata['source'] = source
     
-  elif file_path.endswith('.html'):
-    document_loader = UnstructuredHTMLLoader(file_path)
+    yield chunk
 
-  else:
-    raise ValueError(f"Unsupported File Type: {file_path}")
+# Embed one batch, retrying only this batch on failure
+def embed_batch_with_retry(texts: List[str]):
+  for attempt in range(config.EMBEDDING_MAX_RETRIES + 1):
+    try:
+      start = time.perf_counter()
+      result = embedding_function.embed_documents_with_stats(texts)
+      record_stage("embed", time.perf_counter() - start, "index")
+      return result
+    
+    except Exception as e:
+      if attempt == config.EMBEDDING_MAX_RETRIES:
+        raise
+      
+      delay = config.EMBEDDING_RETRY_BACKOFF * 2 ** attempt
+      print(f"Embedding batch of {len(texts)} chunks failed ({e}), retrying in {delay}s")
+      time.sleep(delay)
+
+# Group chunks from an iterable into lists of batch_size without materialising the rest
+def iter_batches(chunks: Iterable[Document], batch_size: int) -> Iterator[List[Document]]:
+  chunks = iter(chunks)
+  while batch := list(islice(chunks, batch_size)):
+    yield batch
+
+# Embed and upsert chunks that already carry ids as they are produced, reporting progress counters through on_progress
+def store_chunks(chunks: Iterable[Document], file_id: str, on_progress: Optional[Callable[[dict], None]] = None) -> dict:
+  ensure_search_indexes()
+  start = time.perf_counter()
+  progress = {"chunks_embedded": 0, "chunks_stored": 0}
+  total_chunks = 0
+  cache_hits = 0
   
-  # Load documents
-  documents = document_loader.load()
+  # Bound the batches waiting on embeddings so memory stays flat for large files
+  max_in_flight = config.EMBEDDING_MAX_CONCURRENCY * 2
+  embed_pool = ThreadPoolExecutor(max_workers=config.EMBEDDING_MAX_CONCURRENCY, thread_name_prefix="embedding")
+  pending = {}
   
-  # Split documents into chunks
-  chunks = text_splitter.split_documents(documents)
+  # Store each batch as soon as its embeddings arrive
+  def store_completed(futures):
+    nonlocal cache_hits
+    
+    for future in futures:
+      batch = pending.pop(future)
+      embeddings, batch_stats = future.result()
+      
+      cache_hits += batch_stats["cache_hits"]
+      progress["chunks_embedded"] += len(batch)
+      if on_progress:
+        on_progress(dict(progress))
+      
+      with timed("store", "index"):
+        vector_store._collection.upsert(
+          ids=[chunk.id for chunk in batch],
+          embeddings=embeddings,
+          documents=[chunk.page_content for chunk in batch],
+          metadatas=[chunk.metadata for chunk in batch]
+        )
+      with timed("bm25_add", "index"):
+        bm25_index.add(batch)
+      if use_vector_index:
+        with timed("vector_index_add", "index"):
+          vector_index.add([chunk.id for chunk in batch], embeddings, [chunk.metadata for chunk in batch])
+      
+      progress["chunks_stored"] += len(batch)
+      if on_progress:
+        on_progress(dict(progress))
   
-  return chunks
-
-def index_documents_to_chroma(file_path: str, file_id: int) -> bool:
   try:
-    chunks = load_and_split_documents(file_path)
+    for batch in iter_batches(chunks, config.EMBEDDING_BATCH_SIZE):
+      total_chunks += len(batch)
+      pending[embed_pool.submit(embed_batch_with_retry, [chunk.page_content for chunk in batch])] = batch
+      
+      if len(pending) >= max_in_flight:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        store_completed(done)
+        
+    store_completed(as_completed(list(pending)))
+        
+  finally:
+    # Stop pending batches if a batch failed for good
+    embed_pool.shutdown(wait=True, cancel_futures=True)
     
-    # Add file_id to the metadata for each chunk
-    for chunk in chunks:
-      chunk.metadata['file_id'] = file_id
+  elapsed = time.perf_counter() - start
+  request_seconds.observe(elapsed, "index")
+  indexed_chunks.inc("cached", amount=cache_hits)
+  indexed_chunks.inc("embedded", amount=total_chunks - cache_hits)
+  print(f"Indexed {total_chunks} chunks for file_id {file_id} in {elapsed:.2f}s ({total_chunks / elapsed if elapsed else 0:.1f} chunks/sec), {cache_hits} served from embedding cache")
+  
+  return {
+    "chunks": total_chunks,
+    "cache_hits": cache_hits,
+    "cache_misses": total_chunks - cache_hits,
+    "hit_rate": round(cache_hits / total_chunks, 4) if total_chunks else 0.0
+  }
+
+# Embed and store chunks for a new file
+def index_chunks_to_chroma(chunks: Iterable[Document], file_id: str, on_progress: Optional[Callable[[dict], None]] = None, source: Optional[str] = None) -> dict:
+  try:
+    index_stats = store_chunks(with_chunk_ids(chunks, file_id, source), file_id, on_progress)
+  finally:
+    with timed("bm25_save", "index"):
+      bm25_index.save()
+  publish_changes()
+  
+  return index_stats
+
+# Delete chunks by id from Chroma, the BM25 index and the vector index
+def remove_chunks(chunk_ids: List[str]):
+  for start in range(0, len(chunk_ids), CHROMA_BATCH_SIZE):
+    vector_store._collection.delete(ids=chunk_ids[start:start + CHROMA_BATCH_SIZE])
+  bm25_index.remove(chunk_ids)
+  with timed("bm25_save", "index"):
+    bm25_index.save()
+  if use_vector_index:
+    vector_index.remove(chunk_ids)
+
+# Stale chunk ids of an update job deleting the previous version, kept until they are all gone
+UPDATE_JOURNAL_DIRECTORY = os.path.join(CHROMA_PERSIST_DIRECTORY, "update_journal")
+
+def update_journal_path(job_id: str) -> str:
+  return os.path.join(UPDATE_JOURNAL_DIRECTORY, f"{job_id}.json")
+
+"""
+Updating Documents:
+1. Chunks whose id is already stored for the file are unchanged, only their metadata is refreshed
+2. New chunks are embedded and stored tagged with the id of the update job
+3. Once every new chunk is stored, the stale chunk ids are written to the update journal and then deleted
+4. A failed or interrupted update with no journal is rolled back by deleting the chunks tagged with its job id,
+   with a journal the new version is complete and the update is finished by deleting the stale chunks
+"""
+
+# Re-index a file: embed and upsert only new chunks, refresh metadata of unchanged ones and delete stale ones
+def update_chunks_in_chroma(chunks: Iterable[Document], file_id: str, on_progress: Optional[Callable[[dict], None]] = None, source: Optional[str] = None, job_id: Optional[str] = None) -> dict:
+  # Ids and metadata only, embeddings and documents stay in Chroma
+  existing = vector_store._collection.get(where={'file_id': file_id}, include=["metadatas"])
+  existing_metadata = dict(zip(existing["ids"], existing["metadatas"]))
+  
+  unchanged_ids = set()
+  added_ids = []
+  metadata_updates = {}
+  
+  def new_chunks():
+    for chunk in with_chunk_ids(chunks, file_id, source):
+      if chunk.id in existing_metadata:
+        unchanged_ids.add(chunk.id)
+        
+        if stable_metadata(existing_metadata[chunk.id] or {}) != stable_metadata(chunk.metadata):
+          metadata_updates[chunk.id] = chunk.metadata
+      
+      else:
+        if job_id is not None:
+          chunk.metadata['job_id'] = job_id
+        added_ids.append(chunk.id)
+        yield chunk
+        
+  try:
+    index_stats = store_chunks(new_chunks(), file_id, on_progress)
     
-    # Add chunks to vector store
-    vector_store.add_documents(chunks)    
+  except Exception:
+    # Roll back to the previous version of the file
+    remove_chunks(added_ids)
+    raise
+  
+  updated_ids = list(metadata_updates)
+  for start in range(0, len(updated_ids), CHROMA_BATCH_SIZE):
+    batch_ids = updated_ids[start:start + CHROMA_BATCH_SIZE]
+    vector_store._collection.update(ids=batch_ids, metadatas=[metadata_updates[chunk_id] for chunk_id in batch_ids])
+  
+  stale_ids = [chunk_id for chunk_id in existing_metadata if chunk_id not in unchanged_ids]
+  if job_id is not None:
+    write_update_journal(job_id, stale_ids)
+  remove_chunks(stale_ids)
     
-    return True
+  print(f"Updated file_id {file_id}: {len(added_ids)} new, {len(unchanged_ids)} unchanged, {len(stale_ids)} stale chunks")
+  publish_changes()
+  if job_id is not None:
+    os.remove(update_journal_path(job_id))
   
-  except Exception as e:
-    print(f"Error indexing documents: {e}")
-    return False
+  return {**index_stats, "chunks_unchanged": len(unchanged_ids), "chunks_deleted": len(stale_ids)}
+
+# Write then rename so a crash never leaves a partial journal
+def write_update_journal(job_id: str, stale_ids: List[str]):
+  os.makedirs(UPDATE_JOURNAL_DIRECTORY, exist_ok=True)
   
+  temp_path = f"{update_journal_path(job_id)}.{os.getpid()}.tmp"
+  with open(temp_path, "w") as f:
+    json.dump(stale_ids, f)
+  os.replace(temp_path, update_journal_path(job_id))
+
+# Settle an update job that failed or was interrupted, returns True if it was finished and False if it was rolled back
+def recover_update(file_id: str, job_id: str) -> bool:
+  ensure_search_indexes()
+  journal_path = update_journal_path(job_id)
   
-def delete_document(file_id: int):
   try:
-    # Find document using file id
-    docs = vector_store.get(where={'file_id': file_id})
-    print(f"Found {len(docs['ids'])} document chunks for file id {file_id}")
-    
-    # Delete document
-    vector_store._collection.delete(where={'file_id': file_id})
-    print(f"Deleted all documents with file_id {file_id}")
+    with open(journal_path) as f:
+      stale_ids = json.load(f)
+  except FileNotFoundError:
+    stale_ids = None
+  
+  if stale_ids is not None:
+    remove_chunks(stale_ids)
+    print(f"Finished update job {job_id} of file_id {file_id}: {len(stale_ids)} stale chunks deleted")
+  else:
+    added = vector_store._collection.get(where={"$and": [{"file_id": file_id}, {"job_id": job_id}]}, include=[])
+    remove_chunks(added["ids"])
+    print(f"Rolled back update job {job_id} of file_id {file_id}: {len(added['ids'])} new chunks deleted")
+  
+  publish_changes()
+  if stale_ids is not None:
+    os.remove(journal_path)
+  
+  return stale_ids is not None
 
+# Delete every chunk of the files by metadata filter, without reading the chunks back
+def delete_documents(file_ids: List[str]) -> bool:
+  try:
+    ensure_search_indexes()
+    file_ids = list(dict.fromkeys(file_ids))
+    chunk_count = bm25_index.file_chunk_count(file_ids)
+    
+    for start in range(0, len(file_ids), CHROMA_BATCH_SIZE):
+      vector_store._collection.delete(where={'file_id': {'$in': file_ids[start:start + CHROMA_BATCH_SIZE]}})
+    print(f"Deleted {chunk_count} chunks of {len(file_ids)} files")
+    
+    bm25_index.remove_files(file_ids)
+    bm25_index.save()
+    if use_vector_index:
+      vector_index.remove_files(file_ids)
+    publish_changes()
+    
     return True
   
-  except Exception as e: 
-    print(f"Error deleting document with file_id {file_id} from Chroma: {str(e)}")
-    return False
\ No newline at end of file
+  except Exception as e:
+    print(f"Error deleting documents with file_ids {file_ids} from Chroma: {str(e)}")
+    return False
+
+def delete_document(file_id: str) -> bool:
+  return delete_documents([file_id])
+
+# File ids that have chunks in Chroma, read from chunk metadata page by page
+def get_indexed_file_ids() -> set:
+  file_ids = set()
+  offset = 0
+  
+  while True:
+    page = vector_store._collection.get(include=["metadatas"], limit=CHROMA_BATCH_SIZE, offset=offset)
+    if not page["ids"]:
+      break
+    
+    file_ids.update((metadata or {}).get("file_id") for metadata in page["metadatas"])
+    offset += len(page["ids"])
+    
+  file_ids.discard(None)
+  return file_ids
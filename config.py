@@ -8,4 +8,98 @@ load_dotenv()
 # LangSmith configuration
 LANGCHAIN_API_KEY = os.getenv("LANGCHAIN_API_KEY")
 LANGCHAIN_PROJECT = os.getenv("LANGCHAIN_PROJECT", "default")
-LANGCHAIN_TRACING_V2 = os.getenv("LANGCHAIN_TRACING_V2", "true").lower() == "true"
\ No newline at end of file
+LANGCHAIN_TRACING_V2 = os.getenv("LANGCHAIN_TRACING_V2", "true").lower() == "true"
+
+# Embedding cache configuration
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.db")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+# Ingestion queue configuration
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+INGESTION_PARSE_PROCESSES = int(os.getenv("INGESTION_PARSE_PROCESSES", "2"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+
+# Embedding batch configuration
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "3"))
+EMBEDDING_RETRY_BACKOFF = float(os.getenv("EMBEDDING_RETRY_BACKOFF", "1.0"))
+
+# Worker processes serving the app, uvicorn and gunicorn read the same variable
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Session history cache configuration, backend is local or redis
+# The local cache only sees the turns its own worker wrote, so redis is the default with more than one worker
+SESSION_CACHE_BACKEND = os.getenv("SESSION_CACHE_BACKEND", "redis" if WEB_CONCURRENCY > 1 else "local")
+SESSION_CACHE_REDIS_URL = os.getenv("SESSION_CACHE_REDIS_URL", "redis://localhost:6379/0")
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "1800"))
+SESSION_CACHE_MAX_SESSIONS = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "10000"))
+
+# Chat history compaction configuration
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "6"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+
+# Write-behind chat log configuration, durability is memory or spill
+CHAT_LOG_WRITE_BEHIND = os.getenv("CHAT_LOG_WRITE_BEHIND", "true").lower() == "true"
+CHAT_LOG_FLUSH_SIZE = int(os.getenv("CHAT_LOG_FLUSH_SIZE", "50"))
+CHAT_LOG_FLUSH_INTERVAL = float(os.getenv("CHAT_LOG_FLUSH_INTERVAL", "0.5"))
+CHAT_LOG_DURABILITY = os.getenv("CHAT_LOG_DURABILITY", "spill")
+CHAT_LOG_SPILL_PATH = os.getenv("CHAT_LOG_SPILL_PATH", "./chat_log_spill.jsonl")
+
+# Semantic answer cache configuration
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# Memoised question rewrites for follow ups asked again after the same answer
+REWRITE_MEMO_MAX_ENTRIES = int(os.getenv("REWRITE_MEMO_MAX_ENTRIES", "10000"))
+
+# Hybrid retrieval configuration, vector and BM25 candidates are fused with reciprocal rank fusion
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").lower() == "true"
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Re-ranking configuration, fused candidates are narrowed with maximal marginal relevance
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+
+# Context packing configuration, token budgets per model are set on ModelName in pydantic_utils
+MAX_CONTEXT_CHUNKS = int(os.getenv("MAX_CONTEXT_CHUNKS", "12"))
+CONTEXT_MIN_RELEVANCE = float(os.getenv("CONTEXT_MIN_RELEVANCE", "0.8"))
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv("DEFAULT_CONTEXT_TOKEN_BUDGET", "3000"))
+
+# Vector search engine, chroma or mmap for the memory-mapped index in vector_index, Chroma stays the document store
+VECTOR_ENGINE = os.getenv("VECTOR_ENGINE", "chroma")
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "int8")
+VECTOR_INDEX_IVF = os.getenv("VECTOR_INDEX_IVF", "false").lower() == "true"
+VECTOR_INDEX_IVF_LISTS = int(os.getenv("VECTOR_INDEX_IVF_LISTS", "0"))
+VECTOR_INDEX_IVF_PROBE = int(os.getenv("VECTOR_INDEX_IVF_PROBE", "8"))
+
+# Reconciliation of Chroma with the document store, records younger than the grace period are left alone
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("RECONCILE_INTERVAL_SECONDS", "0"))
+RECONCILE_GRACE_SECONDS = float(os.getenv("RECONCILE_GRACE_SECONDS", "3600"))
+
+# Cached /list-docs listing, reloaded after this long so records written by other workers show up
+DOCUMENT_INDEX_TTL_SECONDS = float(os.getenv("DOCUMENT_INDEX_TTL_SECONDS", "60"))
+LIST_DOCS_DEFAULT_LIMIT = int(os.getenv("LIST_DOCS_DEFAULT_LIMIT", "100"))
+LIST_DOCS_MAX_LIMIT = int(os.getenv("LIST_DOCS_MAX_LIMIT", "1000"))
+
+# Storage of chat logs, documents and jobs, backend is firestore or sqlite for single node deployments
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")
+FIREBASE_CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS_PATH", "ragchatbot-62811-firebase-adminsdk-fbsvc-ae41064583.json")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "./rag_chatbot.db")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+
+# Llm routing: deadline per provider call, fallback to the other provider and hedged requests after the provider p95 latency
+LLM_DEADLINE_SECONDS_GROQ = float(os.getenv("LLM_DEADLINE_SECONDS_GROQ", "20"))
+LLM_DEADLINE_SECONDS_OPENAI = float(os.getenv("LLM_DEADLINE_SECONDS_OPENAI", "30"))
+LLM_FALLBACK = os.getenv("LLM_FALLBACK", "true").lower() == "true"
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() == "true"
+LLM_HEDGE_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "2.0"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.25"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_LATENCY_MIN_SAMPLES = int(os.getenv("LLM_LATENCY_MIN_SAMPLES", "20"))
+LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "3"))
+LLM_COOLDOWN_SECONDS = float(os.getenv("LLM_COOLDOWN_SECONDS", "30"))
+
+# Readiness: warmup steps that failed are run again by /health/ready at most this often
+COMPONENT_RETRY_SECONDS = float(os.getenv("COMPONENT_RETRY_SECONDS", "30"))
@@ -0,0 +1,57 @@
+from langchain_core.documents import Document
+from token_utils import count_tokens, truncate_to_tokens
+from typing import List, Tuple
+
+# A chunk cut to fewer tokens than this is dropped instead
+MIN_TRUNCATED_TOKENS = 64
+
+context_stats = {
+  "requests": 0,
+  "tokens_used": 0,
+  "token_budget": 0,
+  "chunks_packed": 0,
+  "chunks_truncated": 0,
+  "chunks_dropped": 0
+}
+
+
+"""
+Context Packing:
+1. Ranked chunks are added in rank order while they fit the token budget of the model
+2. The first chunk that does not fit is cut to the remaining budget, unless less than MIN_TRUNCATED_TOKENS would be left of it
+3. Lower ranked chunks that do not fit are dropped, smaller ones further down may still fill the remaining budget
+4. Tokens used against the budget are added to context_stats for /stats, retrieval records them and the chunk counts in metrics
+"""
+
+def pack_context(docs: List[Document], token_budget: int) -> Tuple[List[Document], dict]:
+  packed = []
+  tokens_used = 0
+  truncated = 0
+
+  for doc in docs:
+    remaining = token_budget - tokens_used
+    tokens = count_tokens(doc.page_content)
+
+    if tokens <= remaining:
+      packed.append(doc)
+      tokens_used += tokens
+
+    elif remaining >= MIN_TRUNCATED_TOKENS and not truncated:
+      content = truncate_to_tokens(doc.page_content, remaining)
+      packed.append(Document(id=doc.id, page_content=content, metadata={**doc.metadata, "truncated": True}))
+      tokens_used += count_tokens(content)
+      truncated += 1
+
+  report = {
+    "tokens_used": tokens_used,
+    "token_budget": token_budget,
+    "chunks_packed": len(packed),
+    "chunks_truncated": truncated,
+    "chunks_dropped": len(docs) - len(packed)
+  }
+
+  context_stats["requests"] += 1
+  for key, value in report.items():
+    context_stats[key] += value
+
+  return packed, report
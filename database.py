@@ -1,17 +1,24 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel, field_validator
 from typing import Optional
+from cache_utils import session_cache
+from log_writer import ChatLogWriter
+from document_index import DocumentIndexCache
+from storage_utils import create_storage, utc_epoch
+from lazy_utils import LazySingleton
+import threading
+import config
 
 
-# Initialise firebase
-cred = credentials.Certificate("ragchatbot-62811-firebase-adminsdk-fbsvc-ae41064583.json")
-firebase_admin.initialize_app(cred)
+"""
+Persistence:
+Chat logs, session summaries, document records and ingestion jobs go through the storage backend chosen by STORAGE_BACKEND,
+Firestore or a local SQLite file (storage_utils). The backend is created on first use,
+so a missing Firebase credential fails the first query instead of the import.
+This module adds the session cache, the write-behind chat log queue and the document index cache on top of it.
+"""
 
-# Initiliase firebase db client
-db = firestore.client()
+storage = LazySingleton("storage", lambda: create_storage(config.STORAGE_BACKEND))
 
 # Define the input log model
 class ChatLog(BaseModel):
@@ -19,6 +26,7 @@ class ChatLog(BaseModel):
   user_query: str
   llm_response: str
   model: str
+  time_to_first_token_ms: Optional[float] = None
   created_at: Optional[datetime] = None
   
   # To allow the use of firebase timestamps
@@ -31,77 +39,186 @@ class ChatLog(BaseModel):
       raise ValueError('session id cannot be empty')
     return v
   
-  # Convert Log from Pydantic Model to dict for saving in firebase
+  # Convert Log from Pydantic Model to dict for saving, the storage backend stamps logs that were not stamped when queued
   def to_dict(self):
-    data = self.model_dump(exclude_none=True)
-    
-    # Add the firebase time stamp
-    data["created_at"] = firestore.SERVER_TIMESTAMP
+    return self.model_dump(exclude_none=True)
+
+
+# Build a validated chat log entry ready for storage
+def build_chat_log_entry(session_id, user_query, llm_response, model, time_to_first_token_ms=None, created_at=None):
+  return ChatLog(
+    session_id=session_id,
+    user_query=user_query,
+    llm_response=llm_response,
+    model=model,
+    time_to_first_token_ms=time_to_first_token_ms,
+    created_at=created_at,
+  ).to_dict()
+
+last_log_timestamp = datetime.min.replace(tzinfo=timezone.utc)
+log_timestamp_lock = threading.Lock()
+
+# Strictly increasing client timestamps, so logs written in one batch keep their order within a session
+# They only increase within this process, logs of one session written by several workers are ordered by their clocks
+def next_log_timestamp():
+  global last_log_timestamp
+  
+  with log_timestamp_lock:
+    last_log_timestamp = max(datetime.now(timezone.utc), last_log_timestamp + timedelta(microseconds=1))
+    return last_log_timestamp
+
+# Write queued chat logs in one batched write
+def write_chat_log_batch(entries):
+  storage.add_chat_logs(entries)
+
+# Queue of chat logs flushed to db collection in the background
+chat_log_writer = ChatLogWriter(
+  write_batch=write_chat_log_batch,
+  flush_size=config.CHAT_LOG_FLUSH_SIZE,
+  flush_interval=config.CHAT_LOG_FLUSH_INTERVAL,
+  durability=config.CHAT_LOG_DURABILITY,
+  spill_path=config.CHAT_LOG_SPILL_PATH
+)
+
+# Convert chat log documents to chat history format Human Message and AI Message
+def format_chat_history(docs):
+  messages = []
+  for data in docs:
+    messages.extend([
+      {"role": "human", "content": data['user_query']},
+      {"role": "ai", "content": data["llm_response"]}
+    ])
     
-    return data
+  return messages
 
+# Chat history messages for one turn
+def format_chat_turn(user_query, llm_response):
+  return format_chat_history([{"user_query": user_query, "llm_response": llm_response}])
 
-# Add the chat history to db collection
-def insert_chat_logs(session_id, user_query, llm_response, model):
+# Add the chat history to db collection, queued for a batched write unless write-behind is off
+def insert_chat_logs(session_id, user_query, llm_response, model, time_to_first_token_ms=None):
   try:
-    log_entry = ChatLog(
-      session_id=session_id,
-      user_query=user_query,
-      llm_response=llm_response,
-      model=model,
-    ).to_dict()
+    if config.CHAT_LOG_WRITE_BEHIND:
+      log_entry = build_chat_log_entry(session_id, user_query, llm_response, model, time_to_first_token_ms, next_log_timestamp())
+      chat_log_writer.enqueue(log_entry)
+      
+    else:
+      log_entry = build_chat_log_entry(session_id, user_query, llm_response, model, time_to_first_token_ms)
+      storage.add_chat_logs([log_entry])
     
-    # reference to chat_logs collection
-    logs_ref = db.collection('chat_logs')
+    # Write through to the session cache
+    session_cache.append(session_id, format_chat_turn(user_query, llm_response))
+    
+  except ValueError as e:
+    print(f"Validation error: {e}")
+    
+# Add the chat history to db collection without blocking the event loop
+async def ainsert_chat_logs(session_id, user_query, llm_response, model, time_to_first_token_ms=None):
+  try:
+    if config.CHAT_LOG_WRITE_BEHIND:
+      log_entry = build_chat_log_entry(session_id, user_query, llm_response, model, time_to_first_token_ms, next_log_timestamp())
+      chat_log_writer.enqueue(log_entry)
+      
+    else:
+      log_entry = build_chat_log_entry(session_id, user_query, llm_response, model, time_to_first_token_ms)
+      await storage.aadd_chat_logs([log_entry])
     
-    # add to collection 'chat_logs
-    logs_ref.add(log_entry)
+    await session_cache.aappend(session_id, format_chat_turn(user_query, llm_response))
     
   except ValueError as e:
     print(f"Validation error: {e}")
     
-# Get chat history from db collection
+# Add the logs of the session still queued for a write-behind flush to the logs read from db collection
+# Queued logs are taken before the read, a log flushed in between is found in both and kept once
+def merge_queued_chat_logs(logs, queued):
+  stored = {log.get("created_at") for log in logs}
+  logs = logs + [entry for entry in queued if entry["created_at"] not in stored]
+  
+  return sorted(logs, key=lambda log: log.get("created_at") or utc_epoch())
+
+# Get chat history from the session cache, falling back to db collection on first read
 def get_chat_history(session_id):
-  # Query the collection by session id in the order of timestamps
-  logs_ref = db.collection('chat_logs')
-  query = logs_ref.where('session_id', '==', session_id).order_by('created_at')
+  messages = session_cache.get(session_id)
+  if messages is not None:
+    return messages
+  
+  # Chat logs of the session in the order of timestamps
+  queued = chat_log_writer.pending_entries(session_id)
+  messages = format_chat_history(merge_queued_chat_logs(storage.get_chat_logs(session_id), queued))
+  session_cache.set(session_id, messages)
   
-  messages = []
-  for doc in query.stream():
-    data = doc.to_dict()
-    
-    # chat history format Human Message and AI Message
-    messages.extend([
-      {"role": "human", "content": data['user_query']},
-      {"role": "ai", "content": data["llm_response"]}
-    ])
-    
   return messages
+
+# Get chat history without blocking the event loop
+async def aget_chat_history(session_id):
+  messages = await session_cache.aget(session_id)
+  if messages is not None:
+    return messages
+  
+  queued = chat_log_writer.pending_entries(session_id)
+  messages = format_chat_history(merge_queued_chat_logs(await storage.aget_chat_logs(session_id), queued))
+  await session_cache.aset(session_id, messages)
+  
+  return messages
+  
+# Get rolling summary of a session without blocking the event loop
+async def aget_session_summary(session_id):
+  try:
+    return await storage.aget_session_summary(session_id)
+  
+  except Exception as e:
+    print(f"Error retrieving summary for session {session_id}: {e}")
+    return None
   
+# Store rolling summary of a session covering its first summarized_messages messages
+async def aupsert_session_summary(session_id, summary, summarized_messages):
+  try:
+    await storage.aset_session_summary(session_id, summary, summarized_messages)
+    
+    return True
+  
+  except Exception as e:
+    print(f"Error storing summary for session {session_id}: {e}")
+    return False
+
 # Add document to db collection
 def insert_document_record(filename):
   try:
-    # Create document with proper structure
-    doc_data = {
-      "filename": filename,
-      "upload_date": firestore.SERVER_TIMESTAMP
-    }
-    
-    # Reference and set data
-    doc_ref = db.collection('document_store').document()
-    doc_ref.set(doc_data)
-    
-    return doc_ref.id
+    file_id = storage.insert_document(filename)
+    document_index.invalidate()
+
+    return file_id
 
   except Exception as e:
     print(f"Error inserting document record: {e}")
     return None
+
+# Get document from db collection
+def get_document_record(file_id):
+  try:
+    return storage.get_document(file_id)
+  
+  except Exception as e:
+    print(f"Error retrieving document {file_id}: {e}")
+    return None
+  
+# Update document filename and upload date after it was re-indexed
+def update_document_record(file_id, filename):
+  try:
+    storage.update_document(file_id, filename)
+    document_index.invalidate()
+    
+    return True
+  
+  except Exception as e:
+    print(f"Error updating document {file_id}: {e}")
+    return False
   
 # Delete document from db collection
 def delete_document_record(file_id):
   try:
-    doc_ref = db.collection('document_store').document(file_id)
-    doc_ref.delete()
+    storage.delete_documents([file_id])
+    document_index.invalidate()
     
     print(f"Document with ID {file_id} successfully deleted")
     return True
@@ -109,30 +226,88 @@ def delete_document_record(file_id):
   except Exception as e:
     print(f"Error deleting document: {e}")
     return False
+
+# Delete many documents from db collection with batched writes
+def delete_document_records(file_ids):
+  try:
+    storage.delete_documents(file_ids)
+    document_index.invalidate()
+    
+    print(f"Deleted {len(file_ids)} document records")
+    return True
+  
+  except Exception as e:
+    print(f"Error deleting document records: {e}")
+    return False
+
+# Upload date of every document in db collection, keyed by document id
+def get_document_upload_dates():
+  return storage.get_document_upload_dates()
+
+# Most recent ingestion job of each file
+def get_latest_job_records(file_ids):
+  return storage.get_latest_jobs(file_ids)
   
+# Read all documents from db collection newest first, errors are raised so a failed read is never cached
+def load_all_documents():
+  return storage.list_documents()
+
 # Get all documents from db collection:
 def get_all_documents():
   try:
-    # Reference to the documents collection
-    docs_ref = db.collection('document_store').order_by('upload_date', direction=firestore.Query.DESCENDING)
-    
-    # Get all documents
-    docs = docs_ref.stream()
-    
-    # Convert to list of dictionaries with specific fields only
-    documents = []
-    for doc in docs:
-        doc_data = doc.to_dict()
-        # Create a dict with just the fields we want, matching SQL version
-        documents.append({
-            'id': doc.id,
-            'filename': doc_data.get('filename'),
-            'upload_timestamp': doc_data.get('upload_date')
-        })
-    
-    return documents
+    return load_all_documents()
           
   except Exception as e:
     print(f"Error retrieving documents: {e}")
     return []
+
+# Cached listing of the document store, invalidated by every document record write
+document_index = DocumentIndexCache(load=load_all_documents, ttl_seconds=config.DOCUMENT_INDEX_TTL_SECONDS)
+
+
+# Add ingestion job to db collection
+def insert_job_record(job_data):
+  try:
+    return storage.insert_job(job_data)
+  
+  except Exception as e:
+    print(f"Error inserting job record: {e}")
+    return None
+  
+# Update progress or status of an ingestion job
+def update_job_record(job_id, **fields):
+  try:
+    storage.update_job(job_id, fields)
+    
+    return True
+  
+  except Exception as e:
+    print(f"Error updating job record {job_id}: {e}")
+    return False
+  
+# Get ingestion job from db collection
+def get_job_record(job_id):
+  try:
+    return storage.get_job(job_id)
   
+  except Exception as e:
+    print(f"Error retrieving job record {job_id}: {e}")
+    return None
+  
+# Get ingestion jobs that are queued or running
+def get_unfinished_job_records():
+  try:
+    return storage.get_unfinished_jobs()
+  
+  except Exception as e:
+    print(f"Error retrieving unfinished jobs: {e}")
+    return []
+  
+# Hand an ingestion job over to a new owner if it is still held by the expected one
+def claim_job_record(job_id, expected_owner, new_owner):
+  try:
+    return storage.claim_job(job_id, expected_owner, new_owner)
+  
+  except Exception as e:
+    print(f"Error claiming job record {job_id}: {e}")
+    return False
@@ -0,0 +1,100 @@
+from bisect import bisect_right
+from typing import Callable, List, Optional, Tuple
+import threading
+import hashlib
+import base64
+import json
+import time
+
+
+"""
+Document Index Cache:
+1. The first listing loads every document record once, sorted newest first, and keeps it in process
+2. Pages are cut from the cached listing with an opaque cursor holding the upload time and id of the last document seen,
+   so a page still starts in the right place when that document was deleted in between
+3. Writes to the document store invalidate the cache, the listing also expires after ttl_seconds
+   so writes made by other worker processes show up
+4. Every page has an ETag derived from the listing content and the page parameters,
+   a listing reloaded with the same content keeps its ETags
+"""
+
+class InvalidCursor(ValueError):
+  pass
+
+class DocumentIndexCache:
+  def __init__(self, load: Callable[[], List[dict]], ttl_seconds: float):
+    self.load = load
+    self.ttl_seconds = ttl_seconds
+    self._lock = threading.Lock()
+    self._generation = 0
+    self._listing = None
+    self._stats = {"loads": 0, "hits": 0, "invalidations": 0}
+
+  def invalidate(self):
+    with self._lock:
+      self._generation += 1
+      self._listing = None
+      self._stats["invalidations"] += 1
+
+  @staticmethod
+  def sort_key(doc: dict) -> Tuple[float, str]:
+    timestamp = doc.get("upload_timestamp")
+    return (-timestamp.timestamp() if timestamp else 0.0, doc["id"])
+
+  # The cached listing, reloaded when it was invalidated or expired
+  def _get_listing(self) -> dict:
+    with self._lock:
+      listing = self._listing
+      generation = self._generation
+
+    if listing is not None and listing["expires_at"] > time.monotonic():
+      self._stats["hits"] += 1
+      return listing
+
+    docs = sorted(self.load(), key=self.sort_key)
+    content = hashlib.sha256()
+    for doc in docs:
+      content.update(f"{doc['id']}\0{doc.get('filename')}\0{self.sort_key(doc)[0]}\n".encode("utf-8"))
+
+    listing = {
+      "docs": docs,
+      "keys": [self.sort_key(doc) for doc in docs],
+      "hash": content.hexdigest(),
+      "expires_at": time.monotonic() + self.ttl_seconds
+    }
+
+    # A write made while loading may be missing from this listing, so it only serves this request
+    with self._lock:
+      if self._generation == generation:
+        self._listing = listing
+      self._stats["loads"] += 1
+
+    return listing
+
+  @staticmethod
+  def encode_cursor(doc: dict) -> str:
+    key = DocumentIndexCache.sort_key(doc)
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+  @staticmethod
+  def decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+      timestamp, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+      return (float(timestamp), str(doc_id))
+    except Exception:
+      raise InvalidCursor(f"Invalid cursor: {cursor}")
+
+  # Returns the documents of the page, the cursor of the next page or None on the last page, and the ETag of the page
+  def page(self, limit: int, after: Optional[str] = None) -> Tuple[List[dict], Optional[str], str]:
+    listing = self._get_listing()
+
+    start = bisect_right(listing["keys"], self.decode_cursor(after)) if after else 0
+    docs = listing["docs"][start:start + limit]
+    next_cursor = self.encode_cursor(docs[-1]) if docs and start + limit < len(listing["docs"]) else None
+
+    etag = hashlib.sha256(f"{listing['hash']}:{limit}:{after or ''}".encode("utf-8")).hexdigest()[:32]
+
+    return docs, next_cursor, f'W/"{etag}"'
+
+  def stats(self):
+    return {**self._stats, "documents": len(self._listing["docs"]) if self._listing else None}
@@ -0,0 +1,133 @@
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredHTMLLoader
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from concurrent.futures import Executor
+from collections import deque
+from typing import Callable, Iterator, List, Optional, Tuple
+from functools import lru_cache
+from pypdf import PdfReader
+import config
+import os
+
+# Initialise Text Splitter, start_index lets overlapping neighbours be merged after retrieval
+text_splitter = RecursiveCharacterTextSplitter(
+  chunk_size=1000,
+  chunk_overlap=200,
+  length_function=len,
+  add_start_index=True
+)
+
+
+"""
+Loading Documents:
+1. Load documents using document loaders
+2. Split documents into chunks using text splitters
+
+Kept free of vector store and api clients so it can run inside parsing worker processes.
+Chunks are produced lazily, page by page, so memory does not grow with the size of the file.
+PDFs are split into page ranges that are parsed in parallel by an executor when one is given.
+"""
+
+def get_document_loader(file_path: str):
+  # Choose respective loader
+  if file_path.endswith('.pdf'):
+    return PyPDFLoader(file_path)
+
+  elif file_path.endswith('.docx'):
+    return Docx2txtLoader(file_path)
+
+  elif file_path.endswith('.html'):
+    return UnstructuredHTMLLoader(file_path)
+
+  else:
+    raise ValueError(f"Unsupported File Type: {file_path}")
+
+# Returns the number of pages parsed and the chunks
+def parse_document(file_path: str) -> Tuple[int, List[Document]]:
+  document_loader = get_document_loader(file_path)
+
+  # Load documents
+  documents = document_loader.load()
+
+  # Split documents into chunks
+  chunks = text_splitter.split_documents(documents)
+
+  return len(documents), chunks
+
+# Opening a PDF reads its whole cross reference table, so each worker process keeps the current file open
+@lru_cache(maxsize=1)
+def open_pdf_reader(file_path: str, modified_ns: int) -> PdfReader:
+  return PdfReader(file_path)
+
+# Parse and split a range of PDF pages, returns the number of pages parsed and the chunks
+def parse_pdf_pages(file_path: str, start: int, stop: int) -> Tuple[int, List[Document]]:
+  reader = open_pdf_reader(file_path, os.stat(file_path).st_mtime_ns)
+  total_pages = len(reader.pages)
+  page_labels = reader.page_labels
+
+  chunks = []
+  for page_number in range(start, stop):
+    page = Document(
+      page_content=reader.pages[page_number].extract_text(extraction_mode="plain").strip(),
+      metadata={
+        "source": file_path,
+        "total_pages": total_pages,
+        "page": page_number,
+        "page_label": page_labels[page_number]
+      }
+    )
+    chunks.extend(text_splitter.split_documents([page]))
+
+  return stop - start, chunks
+
+# Parse PDF page ranges in the executor, keeping a bounded number of ranges in flight and yielding in page order
+def iter_pdf_chunks(file_path: str, executor: Executor, max_in_flight: int) -> Iterator[Tuple[int, List[Document]]]:
+  total_pages = len(PdfReader(file_path).pages)
+  page_ranges = (
+    (start, min(start + config.PDF_PAGES_PER_TASK, total_pages))
+    for start in range(0, total_pages, config.PDF_PAGES_PER_TASK)
+  )
+
+  in_flight = deque()
+  for start, stop in page_ranges:
+    in_flight.append(executor.submit(parse_pdf_pages, file_path, start, stop))
+
+    if len(in_flight) >= max_in_flight:
+      yield in_flight.popleft().result()
+
+  while in_flight:
+    yield in_flight.popleft().result()
+
+# Yield chunks as pages are parsed, on_pages is called with the number of pages parsed so far
+def iter_chunks(
+  file_path: str,
+  executor: Optional[Executor] = None,
+  max_in_flight: int = 4,
+  on_pages: Optional[Callable[[int], None]] = None
+) -> Iterator[Document]:
+  pages_parsed = 0
+
+  if executor is None:
+    # Parse lazily in this process, one page at a time
+    for page in get_document_loader(file_path).lazy_load():
+      pages_parsed += 1
+      if on_pages:
+        on_pages(pages_parsed)
+
+      yield from text_splitter.split_documents([page])
+    return
+
+  if file_path.endswith('.pdf'):
+    parsed_ranges = iter_pdf_chunks(file_path, executor, max_in_flight)
+  else:
+    parsed_ranges = iter([executor.submit(parse_document, file_path).result()])
+
+  for pages, chunks in parsed_ranges:
+    pages_parsed += pages
+    if on_pages:
+      on_pages(pages_parsed)
+
+    yield from chunks
+
+def load_and_split_documents(file_path: str) -> List[Document]:
+  return list(iter_chunks(file_path))
@@ -0,0 +1,128 @@
+from langchain_core.embeddings import Embeddings
+from array import array
+from typing import Dict, List, Tuple
+import hashlib
+import sqlite3
+import threading
+import time
+
+# SQLite limits the number of variables in one statement
+SQLITE_BATCH_SIZE = 500
+
+
+"""
+Embedding Cache:
+1. Key each chunk by a hash of the embedding model and chunk text
+2. Serve cached vectors from a local SQLite file without calling the embedding api
+3. Embed only the misses and store them, evicting least recently used entries past the size limit
+"""
+
+class EmbeddingCache:
+  def __init__(self, path: str, max_entries: int):
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+
+    self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("""
+      CREATE TABLE IF NOT EXISTS embeddings (
+        key TEXT PRIMARY KEY,
+        vector BLOB NOT NULL,
+        last_used REAL NOT NULL
+      )
+    """)
+    self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+    self._conn.commit()
+
+    self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+  @staticmethod
+  def make_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+  def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+    found = {}
+    now = time.time()
+
+    with self._lock:
+      for start in range(0, len(keys), SQLITE_BATCH_SIZE):
+        batch = keys[start:start + SQLITE_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+
+        rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch).fetchall()
+        for key, blob in rows:
+          found[key] = array("f", blob).tolist()
+
+        # Refresh recency so hot entries survive eviction
+        self._conn.execute(f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})", [now, *batch])
+
+      self._conn.commit()
+
+    return found
+
+  def put_many(self, items: Dict[str, List[float]]):
+    now = time.time()
+
+    with self._lock:
+      cursor = self._conn.executemany(
+        "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+        [(key, array("f", vector).tobytes(), now) for key, vector in items.items()]
+      )
+      self._size += max(cursor.rowcount, 0)
+
+      # Evict least recently used entries past the size limit
+      overflow = self._size - self.max_entries
+      if overflow > 0:
+        self._conn.execute(
+          "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+          (overflow,)
+        )
+        self._size -= overflow
+
+      self._conn.commit()
+
+  def __len__(self):
+    return self._size
+
+
+# Embeddings wrapper that serves repeat chunks from the cache
+class CachedEmbeddings(Embeddings):
+  def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str):
+    self.embeddings = embeddings
+    self.cache = cache
+    self.model = model
+
+  def embed_documents_with_stats(self, texts: List[str]) -> Tuple[List[List[float]], dict]:
+    keys = [EmbeddingCache.make_key(self.model, text) for text in texts]
+    cached = self.cache.get_many(list(set(keys)))
+
+    # Embed each distinct missing text once
+    missing = {}
+    for key, text in zip(keys, texts):
+      if key not in cached and key not in missing:
+        missing[key] = text
+
+    if missing:
+      vectors = self.embeddings.embed_documents(list(missing.values()))
+      new_entries = dict(zip(missing.keys(), vectors))
+      self.cache.put_many(new_entries)
+      cached.update(new_entries)
+
+    hits = sum(1 for key in keys if key not in missing)
+    stats = {
+      "chunks": len(texts),
+      "cache_hits": hits,
+      "cache_misses": len(texts) - hits,
+      "hit_rate": round(hits / len(texts), 4) if texts else 0.0
+    }
+
+    return [cached[key] for key in keys], stats
+
+  def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    return self.embed_documents_with_stats(texts)[0]
+
+  def embed_query(self, text: str) -> List[float]:
+    return self.embeddings.embed_query(text)
+
+  async def aembed_query(self, text: str) -> List[float]:
+    return await self.embeddings.aembed_query(text)
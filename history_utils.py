@@ -0,0 +1,136 @@
+from database import aget_session_summary, aupsert_session_summary
+from langchain_utils import get_summary_chain
+from cache_utils import LRUTTLCache
+from token_utils import count_message_tokens, truncate_to_tokens, MESSAGE_OVERHEAD_TOKENS
+from typing import List, Optional
+import asyncio
+import config
+
+# Latest known summary per session, saves a database read on every turn
+summary_cache = LRUTTLCache(max_entries=config.SESSION_CACHE_MAX_SESSIONS, ttl_seconds=config.SESSION_CACHE_TTL_SECONDS)
+
+# Sessions with a summary update running, so overlapping turns do not summarise the same messages twice
+summaries_in_progress = set()
+
+# Keep references to background tasks so they are not garbage collected
+background_tasks = set()
+
+compaction_stats = {
+  "requests": 0,
+  "history_tokens_before": 0,
+  "history_tokens_after": 0,
+  "messages_dropped": 0,
+  "summaries_updated": 0
+}
+
+
+"""
+History Compaction:
+1. The stored summary covers the first summarized_messages messages of the session, it is cut to half of HISTORY_TOKEN_BUDGET
+2. Of the remaining messages, the last turns that fit HISTORY_MAX_TURNS and the rest of the budget are kept verbatim
+3. The prompt history is the summary as a system message followed by the window, so it stays within HISTORY_TOKEN_BUDGET
+4. Messages between the summary and the window are pending: left out of the prompt and folded into the summary after the response
+5. Pending messages beyond what one summary call takes (HISTORY_TOKEN_BUDGET) are dropped oldest first, e.g. after failed summary updates
+"""
+
+async def get_session_summary(session_id: str) -> dict:
+  summary = summary_cache.get(session_id)
+
+  if summary is None:
+    summary = await aget_session_summary(session_id) or {"summary": "", "summarized_messages": 0}
+    summary_cache.set(session_id, summary)
+
+  return summary
+
+# Number of messages at the end of history that fit the token budget, counted in whole turns
+def window_size(messages: List[dict], token_budget: int, max_turns: Optional[int] = None) -> int:
+  kept = 0
+  tokens = 0
+
+  for end in range(len(messages), 1, -2):
+    turn_tokens = count_message_tokens(messages[end - 2:end])
+
+    if (max_turns is not None and kept // 2 >= max_turns) or tokens + turn_tokens > token_budget:
+      break
+
+    kept += 2
+    tokens += turn_tokens
+
+  return kept
+
+async def compact_chat_history(session_id: str, messages: List[dict]):
+  summary = await get_session_summary(session_id)
+  summarized_messages = min(summary["summarized_messages"], len(messages))
+
+  compacted = []
+  if summary["summary"]:
+    summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary['summary']}"}
+    summary_budget = config.HISTORY_TOKEN_BUDGET // 2
+
+    if count_message_tokens([summary_message]) > summary_budget:
+      summary_message["content"] = truncate_to_tokens(summary_message["content"], max(summary_budget - MESSAGE_OVERHEAD_TOKENS, 0))
+
+    compacted.append(summary_message)
+
+  unsummarized = messages[summarized_messages:]
+  window_budget = config.HISTORY_TOKEN_BUDGET - count_message_tokens(compacted)
+  window_start = summarized_messages + max(len(unsummarized) - window_size(unsummarized, window_budget, config.HISTORY_MAX_TURNS), 0)
+  compacted.extend(messages[window_start:])
+
+  # Only the newest pending turns that fit one summary call are summarized, older ones are dropped
+  pending = messages[summarized_messages:window_start]
+  summarized_pending = pending[len(pending) - window_size(pending, config.HISTORY_TOKEN_BUDGET):]
+
+  tokens_before = count_message_tokens(messages)
+  tokens_after = count_message_tokens(compacted)
+
+  compaction_stats["requests"] += 1
+  compaction_stats["history_tokens_before"] += tokens_before
+  compaction_stats["history_tokens_after"] += tokens_after
+  compaction_stats["messages_dropped"] += len(pending) - len(summarized_pending)
+
+  compaction = {
+    "summary": summary["summary"],
+    "summarized_messages": summarized_messages,
+    "window_start": window_start,
+    "pending": summarized_pending,
+    "history_tokens_before": tokens_before,
+    "history_tokens_after": tokens_after
+  }
+
+  return compacted, compaction
+
+# Fold pending messages into the stored summary, the summary then covers every message before the window
+async def update_session_summary(session_id: str, model: str, compaction: dict):
+  if compaction["window_start"] <= compaction["summarized_messages"] or session_id in summaries_in_progress:
+    return
+
+  summaries_in_progress.add(session_id)
+
+  try:
+    summary = compaction["summary"]
+
+    if compaction["pending"]:
+      new_lines = "\n".join(f"{message['role']}: {message['content']}" for message in compaction["pending"])
+      summary = await get_summary_chain(model).ainvoke({"summary": compaction["summary"] or "(none)", "new_lines": new_lines})
+
+    summarized_messages = compaction["window_start"]
+
+    if await aupsert_session_summary(session_id, summary, summarized_messages):
+      summary_cache.set(session_id, {"summary": summary, "summarized_messages": summarized_messages})
+      compaction_stats["summaries_updated"] += 1
+
+  except Exception as e:
+    print(f"Error updating summary for session {session_id}: {e}")
+
+  finally:
+    summaries_in_progress.discard(session_id)
+
+# Update the summary after the response is sent
+def schedule_summary_update(session_id: str, model: str, compaction: dict):
+  if compaction["window_start"] <= compaction["summarized_messages"]:
+    return
+
+  task = asyncio.create_task(update_session_summary(session_id, model, compaction))
+  background_tasks.add(task)
+  task.add_done_callback(background_tasks.discard)
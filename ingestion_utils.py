@@ -0,0 +1,208 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from database import insert_job_record, update_job_record, get_unfinished_job_records, claim_job_record, delete_document_record, update_document_record
+from document_utils import iter_chunks
+from lazy_utils import LazySingleton
+from chroma_utils import index_chunks_to_chroma, update_chunks_in_chroma, recover_update, delete_document
+import multiprocessing
+import socket
+import time
+import os
+import config
+
+# Identifies this process as the owner of the jobs it runs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Bounded pool running indexing jobs, created on first use
+job_pool = LazySingleton("ingestion_jobs", lambda: ThreadPoolExecutor(max_workers=config.INGESTION_WORKERS, thread_name_prefix="ingestion"))
+
+# Process pool for CPU bound parsing, spawned so children do not inherit api clients or open sockets
+parse_pool = LazySingleton("ingestion_parse", lambda: ProcessPoolExecutor(
+  max_workers=config.INGESTION_PARSE_PROCESSES,
+  mp_context=multiprocessing.get_context("spawn")
+))
+
+
+"""
+Ingestion Jobs:
+1. Upload or update saves the file, records a queued job and returns the job id immediately
+2. A job pool thread parses page ranges in the process pool and embeds and stores chunks as they arrive
+3. Progress counters are written to the job record as each stage advances
+4. On startup, jobs left behind by a dead worker are requeued if their file is still on disk, otherwise marked failed.
+   An interrupted update is first rolled back to the previous version, or finished if its new version was fully stored
+
+Upload jobs index a new file. Update jobs re-index an existing file, embedding only chunks that changed.
+Chunk ids are deterministic, so rerunning either kind of job is safe.
+"""
+
+def submit_job(job_type: str, file_path: str, filename: str, file_id: str):
+  job_id = insert_job_record({
+    "job_type": job_type,
+    "status": "queued",
+    "owner": WORKER_ID,
+    "filename": filename,
+    "file_id": file_id,
+    "file_path": file_path,
+    "pages_parsed": 0,
+    "chunks_total": 0,
+    "chunks_embedded": 0,
+    "chunks_stored": 0
+  })
+
+  if job_id is None:
+    return None
+
+  job_pool.submit(run_job, job_id, job_type, file_path, filename, file_id)
+
+  return job_id
+
+def submit_upload_job(file_path: str, filename: str, file_id: str):
+  return submit_job("upload", file_path, filename, file_id)
+
+def submit_update_job(file_path: str, filename: str, file_id: str):
+  return submit_job("update", file_path, filename, file_id)
+
+def run_job(job_id: str, job_type: str, file_path: str, filename: str, file_id: str):
+  update_job_record(job_id, status="running")
+
+  try:
+    report = make_progress_reporter(job_id)
+    parsed = {"pages_parsed": 0}
+    
+    def on_pages(pages_parsed):
+      parsed["pages_parsed"] = pages_parsed
+      report(dict(parsed))
+    
+    # Chunks stream from the parse pool into embedding as pages are parsed
+    chunks = iter_chunks(file_path, executor=parse_pool.get(), max_in_flight=config.INGESTION_PARSE_PROCESSES * 2, on_pages=on_pages)
+    on_progress = lambda progress: report({**parsed, **progress})
+    
+    if job_type == "update":
+      index_stats = update_chunks_in_chroma(chunks, file_id, on_progress=on_progress, source=filename, job_id=job_id)
+      update_document_record(file_id, filename)
+    else:
+      index_stats = index_chunks_to_chroma(chunks, file_id, on_progress=on_progress, source=filename)
+    
+    update_job_record(
+      job_id,
+      status="completed",
+      pages_parsed=parsed["pages_parsed"],
+      chunks_total=index_stats["chunks"] + index_stats.get("chunks_unchanged", 0),
+      chunks_embedded=index_stats["chunks"],
+      chunks_stored=index_stats["chunks"],
+      chunks_unchanged=index_stats.get("chunks_unchanged", 0),
+      chunks_deleted=index_stats.get("chunks_deleted", 0),
+      embedding_cache=index_stats
+    )
+
+  except Exception as e:
+    print(f"Error running {job_type} job {job_id}: {e}")
+
+    # A failed upload leaves nothing behind, a failed update is rolled back to the previous version,
+    # or finished if it failed while deleting the stale chunks of the previous version
+    if job_type == "upload":
+      delete_document(file_id)
+      delete_document_record(file_id)
+      update_job_record(job_id, status="failed", error=str(e))
+    else:
+      settle_update_job(job_id, file_id, filename, error=str(e))
+
+  finally:
+    if os.path.exists(file_path):
+      os.remove(file_path)
+
+# Write progress to the job record at most once per interval
+def make_progress_reporter(job_id: str, min_interval: float = 1.0):
+  last_report = 0.0
+  
+  def report(progress: dict):
+    nonlocal last_report
+    now = time.monotonic()
+    
+    if now - last_report >= min_interval:
+      last_report = now
+      update_job_record(job_id, **progress)
+      
+  return report
+
+# A job owner is dead if it ran on this host and its process is gone
+def is_dead_owner(owner: str) -> bool:
+  host, _, pid = owner.rpartition(":")
+
+  if host != socket.gethostname() or not pid.isdigit():
+    return False
+
+  # Same pid as this process means it belonged to a previous run
+  if int(pid) == os.getpid():
+    return True
+
+  try:
+    os.kill(int(pid), 0)
+  except ProcessLookupError:
+    return True
+  except PermissionError:
+    return False
+
+  return False
+
+# Roll back or finish an update job that did not complete
+def settle_update_job(job_id: str, file_id: str, filename: str, error: str):
+  try:
+    finished = recover_update(file_id, job_id)
+  except Exception as e:
+    print(f"Error recovering update job {job_id}: {e}")
+    update_job_record(job_id, status="failed", error=f"{error}, recovery failed: {e}")
+    return
+
+  if finished:
+    update_document_record(file_id, filename)
+    update_job_record(job_id, status="completed")
+  else:
+    update_job_record(job_id, status="failed", error=f"{error}, rolled back to the previous version")
+
+def recover_interrupted_jobs():
+  for job in get_unfinished_job_records():
+    owner = job.get("owner", "")
+
+    if not is_dead_owner(owner) or not claim_job_record(job["id"], owner, WORKER_ID):
+      continue
+
+    job_type = job.get("job_type", "upload")
+
+    if job_type == "update" and os.path.exists(job["file_path"]):
+      # Start the rerun from the previous version, unless the interrupted run already replaced it
+      try:
+        finished = recover_update(job["file_id"], job["id"])
+      except Exception as e:
+        print(f"Error recovering update job {job['id']}: {e}")
+        continue
+
+      if finished:
+        print(f"Interrupted update job {job['id']} had stored its new version, marking it completed")
+        update_document_record(job["file_id"], job["filename"])
+        update_job_record(job["id"], status="completed")
+        os.remove(job["file_path"])
+        continue
+
+    if os.path.exists(job["file_path"]):
+      # Stable chunk ids make the rerun overwrite whatever the interrupted run stored
+      print(f"Requeueing interrupted {job_type} job {job['id']}")
+      update_job_record(job["id"], status="queued", pages_parsed=0, chunks_total=0, chunks_embedded=0, chunks_stored=0)
+      job_pool.submit(run_job, job["id"], job_type, job["file_path"], job["filename"], job["file_id"])
+
+    elif job_type == "update":
+      print(f"Recovering interrupted update job {job['id']}")
+      settle_update_job(job["id"], job["file_id"], job["filename"], error="Interrupted by a worker restart")
+
+    else:
+      print(f"Marking interrupted {job_type} job {job['id']} as failed")
+      # Drop chunks stored before the interruption
+      delete_document(job["file_id"])
+      delete_document_record(job["file_id"])
+      update_job_record(job["id"], status="failed", error="Interrupted by a worker restart")
+
+# Pools never created are left alone
+def shutdown_ingestion_pools():
+  for pool in (job_pool, parse_pool):
+    executor = pool.built()
+    if executor is not None:
+      executor.shutdown(wait=False, cancel_futures=True)
@@ -1,11 +1,13 @@
-from langchain_openai import ChatOpenAI
-from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.runnables import RunnableLambda
 from typing import List
-from chroma_utils import vector_store
+from chroma_utils import embedding_function
+from retrieval_utils import retrieve_documents
+from routing_utils import model_router, RoutedChatModel
+from lazy_utils import LazySingleton
+import httpx
+import threading
 from pydantic_utils import ModelName
 import os
 import config
@@ -21,9 +23,6 @@ if config.LANGCHAIN_API_KEY:
   os.environ["LANGCHAIN_PROJECT"] = config.LANGCHAIN_PROJECT
   os.environ["LANGCHAIN_TRACING_V2"] = str(config.LANGCHAIN_TRACING_V2).lower()
 
-# Initialise vector store retriever
-retriever = vector_store.as_retriever(search_kwargs={"k":2})
-
 # Initialise Output Parser
 output_parser = StrOutputParser()
 
@@ -48,6 +47,13 @@ qa_prompt = ChatPromptTemplate.from_messages([
     MessagesPlaceholder(variable_name="chat_history"),
     ("human", "{input}")
 ])
+# Rolling summary prompt, folds turns that left the history window into the existing summary
+summarize_prompt = ChatPromptTemplate.from_messages([
+    ("system", "Progressively summarize the conversation. Extend the current summary with the new lines of conversation "
+               "and return the new summary. Keep names, numbers, documents and open questions the user may refer back to."),
+    ("human", "Current summary:\n{summary}\n\nNew lines of conversation:\n{new_lines}\n\nNew summary:")
+])
+
 # Web search system prompt
 web_search_system_prompt = """You are an AI assistant with the ability to search the web for information. When a user asks a question that could benefit from web information, you should:
 
@@ -70,21 +76,126 @@ web_search_prompt = ChatPromptTemplate.from_messages([
     ("human", "{input}")
 ])
 
-# Create RAG Chain
-# User query → Retriever → Documents → create_stuff_documents_chain → Formats prompt with {context} filled → LLM → Response
-def get_rag_chain(model: str):
+# Shared pooled http clients so every llm client reuses connections and TLS sessions, built on first use
+http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+http_client = LazySingleton("http_client", lambda: httpx.Client(limits=http_limits))
+http_async_client = LazySingleton("http_async_client", lambda: httpx.AsyncClient(limits=http_limits))
+
+# Close the shared http clients on app shutdown, clients never built are left alone
+async def aclose_http_clients():
+  client = http_client.built()
+  if client is not None:
+    client.close()
+
+  async_client = http_async_client.built()
+  if async_client is not None:
+    await async_client.aclose()
+
+# Create llm client for the model on the shared http clients
+def get_llm(model: str, **llm_settings):
+  # The llm client libraries are imported on first use, they are slow to import
   if model == "gpt-4o":
-    llm = ChatOpenAI(model=model)
-  else: 
-    llm = ChatGroq(model=model)
-    
-  history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=model, http_client=http_client.get(), http_async_client=http_async_client.get(), **llm_settings)
+  
+  from langchain_groq import ChatGroq
+  return ChatGroq(model=model, http_client=http_client.get(), http_async_client=http_async_client.get(), **llm_settings)
+
+# Llm for the model with the clients of every provider it can be routed to, each with its deadline as request timeout
+def get_chat_model(model: str, **llm_settings):
+  routes = {}
+  
+  for provider in model_router.providers_for(model):
+    try:
+      routes[provider] = get_llm(model_router.model_id(model, provider), timeout=model_router.deadline(provider), **llm_settings)
+    except Exception as e:
+      # Without the alternate the model is still served by its own provider
+      if not routes:
+        raise
+      print(f"Alternate provider {provider} unavailable for {model}: {e}")
+  
+  return RoutedChatModel(model=model, routes=routes)
+
+# Context token budget of the model, models outside ModelName get the default budget
+def get_context_token_budget(model: str) -> int:
+  try:
+    return ModelName(model).context_token_budget
+  except ValueError:
+    return config.DEFAULT_CONTEXT_TOKEN_BUDGET
+
+# Create RAG Chain
+# Standalone question → Hybrid retriever → Documents packed to the model token budget → create_stuff_documents_chain → Formats prompt with {context} filled → LLM → Response
+# The question is rewritten beforehand by the rewrite chain so it can also key the answer cache
+def build_rag_chain(model: str, **llm_settings):
+  # langchain.chains pulls in most of langchain, imported when the first chain is built instead of at import
+  from langchain.chains import create_retrieval_chain
+  from langchain.chains.combine_documents import create_stuff_documents_chain
+
+  llm = get_chat_model(model, **llm_settings)
+  token_budget = get_context_token_budget(model)
   
   question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
   
-  rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+  retriever = RunnableLambda(lambda inputs: retrieve_documents(inputs, token_budget))
+  rag_chain = create_retrieval_chain(retriever, question_answer_chain)
   
   return rag_chain
 
+# Rewrites the latest question into a standalone question using the chat history
+def build_rewrite_chain(model: str, **llm_settings):
+  return contextualize_q_prompt | get_chat_model(model, **llm_settings) | output_parser
+
+# Summarises chat history that falls out of the history window
+def build_summary_chain(model: str, **llm_settings):
+  return summarize_prompt | get_chat_model(model, **llm_settings) | output_parser
+
+# Process wide registry of prebuilt chains keyed by chain builder, model and llm settings
+class ChainRegistry:
+  def __init__(self):
+    self._chains = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    
+  def get(self, model: str, builder=build_rag_chain, **llm_settings):
+    key = (builder.__name__, model, tuple(sorted(llm_settings.items())))
+    
+    with self._lock:
+      chain = self._chains.get(key)
+      
+      if chain is not None:
+        self.hits += 1
+        return chain
+      
+      self.misses += 1
+      chain = builder(model, **llm_settings)
+      self._chains[key] = chain
+      
+      return chain
+    
+  def stats(self):
+    return {"chains": len(self._chains), "hits": self.hits, "misses": self.misses}
+  
+chain_registry = ChainRegistry()
+
+# Get the prebuilt rag chain for the model, building it on first use
+def get_rag_chain(model: str, **llm_settings):
+  return chain_registry.get(model, **llm_settings)
+
+# Get the prebuilt rewrite chain for the model
+def get_rewrite_chain(model: str, **llm_settings):
+  return chain_registry.get(model, builder=build_rewrite_chain, **llm_settings)
+
+# Embed the standalone question once for both the answer cache and retrieval
+async def aembed_query(text: str) -> List[float]:
+  return await embedding_function.aembed_query(text)
 
+# Get the prebuilt summary chain for the model
+def get_summary_chain(model: str, **llm_settings):
+  return chain_registry.get(model, builder=build_summary_chain, **llm_settings)
 
+# Build rag chains up front so the first requests skip construction
+def warmup_rag_chains(models: List[str]):
+  for model in models:
+    get_rag_chain(model)
+    get_rewrite_chain(model)
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict
+import threading
+import time
+
+
+"""
+Lazy Initialisation:
+1. Clients that connect to a service or open files on disk are wrapped in a LazySingleton,
+   importing the module no longer builds them and a missing credential fails only the component that needs it
+2. The object is built on first use, by a request or by the app lifespan warmup, and every attribute access is forwarded to it
+3. Every component records its status, init time and error in component_status, served by /health/ready
+4. The lifespan warms independent components in parallel threads, a component that needs another waits on its lock
+5. /health/ready runs the warmup steps that failed again, at most once every retry interval,
+   so the worker becomes ready once the failing service is back without waiting for a request to use it
+"""
+
+# Status of every component, keyed by name: pending, ready or failed
+component_status: Dict[str, dict] = {}
+component_status_lock = threading.Lock()
+
+def set_component_status(name: str, **fields):
+  with component_status_lock:
+    component_status.setdefault(name, {"status": "pending", "init_ms": None, "error": None}).update(fields)
+
+# Time a component init and record whether it succeeded
+@contextmanager
+def recording_init(name: str):
+  start = time.perf_counter()
+  try:
+    yield
+  except Exception as e:
+    set_component_status(name, status="failed", init_ms=round((time.perf_counter() - start) * 1000, 1), error=str(e))
+    raise
+  set_component_status(name, status="ready", init_ms=round((time.perf_counter() - start) * 1000, 1), error=None)
+
+class LazySingleton:
+  def __init__(self, name: str, factory: Callable[[], object]):
+    object.__setattr__(self, "_name", name)
+    object.__setattr__(self, "_factory", factory)
+    object.__setattr__(self, "_instance", None)
+    object.__setattr__(self, "_lock", threading.Lock())
+    set_component_status(name)
+
+  # Build the object once, a failed build is retried on the next use
+  def get(self):
+    instance = self._instance
+    if instance is not None:
+      return instance
+
+    with self._lock:
+      if self._instance is None:
+        with recording_init(self._name):
+          object.__setattr__(self, "_instance", self._factory())
+
+      return self._instance
+
+  # The object if it was built, otherwise None, so shutdown does not build an object only to close it
+  def built(self):
+    return self._instance
+
+  # Use the given object instead of building one, benchmarks swap in local stand-ins this way
+  def override(self, instance):
+    with self._lock:
+      object.__setattr__(self, "_instance", instance)
+    set_component_status(self._name, status="ready", init_ms=0.0, error=None)
+
+  def __getattr__(self, attr):
+    return getattr(self.get(), attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self.get(), attr, value)
+
+# Run the warmup steps in parallel threads, a step is a LazySingleton to build or a function recorded under its name
+# Failures are recorded and logged instead of stopping startup
+def warmup_components(steps: Dict[str, object]) -> dict:
+  def run(name, step):
+    try:
+      if isinstance(step, LazySingleton):
+        step.get()
+      else:
+        with recording_init(name):
+          step()
+    except Exception as e:
+      print(f"Warmup of {name} failed: {e}")
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix="warmup") as executor:
+    for name, step in steps.items():
+      executor.submit(run, name, step)
+
+  print(f"Warmup finished in {time.perf_counter() - start:.2f}s: " + ", ".join(
+    f"{name} {status['status']} ({status['init_ms']} ms)" for name, status in component_status.items()
+  ))
+  return component_status
+
+# Monotonic time of the last retry of failed warmup steps
+last_retry = {"at": None}
+last_retry_lock = threading.Lock()
+
+# Run the warmup steps whose last run failed again, at most once every retry_seconds so readiness probes do not hammer a failing service
+def retry_failed_components(steps: Dict[str, object], retry_seconds: float) -> dict:
+  failed = {name: step for name, step in steps.items() if component_status.get(name, {}).get("status") == "failed"}
+
+  with last_retry_lock:
+    now = time.monotonic()
+    if not failed or (last_retry["at"] is not None and now - last_retry["at"] < retry_seconds):
+      return component_status
+    last_retry["at"] = now
+
+  return warmup_components(failed)
@@ -0,0 +1,201 @@
+from collections import deque
+from datetime import datetime
+from typing import Callable, List
+import threading
+import json
+import time
+import os
+
+# Firestore accepts at most 500 writes in one batch
+MAX_BATCH_WRITES = 500
+
+
+"""
+Write-Behind Chat Logs:
+1. Chat log entries are queued in memory and the response returns without waiting on the database
+2. A background thread flushes the queue with batched writes once it holds flush_size entries or every flush_interval seconds
+3. Entries are written in the order they were queued, and carry a client timestamp, so every session keeps its order.
+   Timestamps only increase within one process, sessions spread over several workers are ordered by their clocks
+4. If a flush fails, entries go back to the front of the queue, or with spill durability to a local file
+   that is replayed before any newer entry on the next flush
+5. close() flushes whatever is left on shutdown
+6. Entries queued or being written are returned by pending_entries, so a history read from the database misses none of them
+"""
+
+class ChatLogWriter:
+  def __init__(
+    self,
+    write_batch: Callable[[List[dict]], None],
+    flush_size: int,
+    flush_interval: float,
+    durability: str = "memory",
+    spill_path: str = "./chat_log_spill.jsonl"
+  ):
+    self.write_batch = write_batch
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.durability = durability
+    self.spill_path = spill_path
+
+    self._queue = deque()
+    self._in_flight = []
+    self._condition = threading.Condition()
+    self._flush_lock = threading.Lock()
+    self._closed = False
+    self._last_flush_failed = False
+
+    self.entries_written = 0
+    self.entries_spilled = 0
+    self.flushes = 0
+    self.failed_flushes = 0
+    self.last_flush_ms = 0.0
+    self.total_flush_ms = 0.0
+
+    self._thread = threading.Thread(target=self._run, name="chat-log-writer", daemon=True)
+    self._thread.start()
+
+  def enqueue(self, entry: dict):
+    with self._condition:
+      self._queue.append(entry)
+
+      if len(self._queue) >= self.flush_size:
+        self._condition.notify()
+
+  # Entries of the session that are queued or being written, oldest first. Entries in the spill file are not included
+  def pending_entries(self, session_id: str) -> List[dict]:
+    with self._condition:
+      return [entry for entry in [*self._in_flight, *self._queue] if entry.get("session_id") == session_id]
+
+  def _run(self):
+    while True:
+      with self._condition:
+        # Back off after a failed flush instead of retrying straight away
+        if not self._closed and (len(self._queue) < self.flush_size or self._last_flush_failed):
+          self._condition.wait(timeout=self.flush_interval)
+        closed = self._closed
+
+      self.flush()
+
+      if closed:
+        return
+
+  def _write(self, entries: List[dict]) -> int:
+    # Returns how many entries were written before a batch failed
+    written = 0
+
+    try:
+      for start in range(0, len(entries), MAX_BATCH_WRITES):
+        batch = entries[start:start + MAX_BATCH_WRITES]
+        self.write_batch(batch)
+        written += len(batch)
+
+    except Exception as e:
+      print(f"Error flushing chat logs, {len(entries) - written} entries not written: {e}")
+
+    return written
+
+  def flush(self):
+    with self._flush_lock:
+      # Older spilled entries go first so sessions stay in order
+      if not self._replay_spill():
+        with self._condition:
+          entries = list(self._queue)
+          self._queue.clear()
+        self._spill(entries)
+        self._last_flush_failed = True
+        return
+
+      with self._condition:
+        entries = list(self._queue)
+        self._queue.clear()
+        self._in_flight = entries
+
+      if not entries:
+        self._last_flush_failed = False
+        return
+
+      try:
+        start = time.perf_counter()
+        written = self._write(entries)
+
+        self.last_flush_ms = (time.perf_counter() - start) * 1000
+        self.total_flush_ms += self.last_flush_ms
+        self.flushes += 1
+        self.entries_written += written
+        self._last_flush_failed = written < len(entries)
+
+        if written < len(entries):
+          self.failed_flushes += 1
+          unwritten = entries[written:]
+
+          if self.durability == "spill":
+            self._spill(unwritten)
+          else:
+            # Back in the queue and out of flight at once, so pending_entries never returns them twice
+            with self._condition:
+              self._queue.extendleft(reversed(unwritten))
+              self._in_flight = []
+
+      finally:
+        with self._condition:
+          self._in_flight = []
+
+  def _spill(self, entries: List[dict]):
+    if not entries:
+      return
+
+    with open(self.spill_path, "a") as f:
+      for entry in entries:
+        f.write(json.dumps(entry, default=lambda value: value.isoformat()) + "\n")
+
+    self.entries_spilled += len(entries)
+    print(f"Spilled {len(entries)} chat log entries to {self.spill_path}")
+
+  # Write spilled entries back, returns False if some are still waiting in the spill file
+  def _replay_spill(self) -> bool:
+    if not os.path.exists(self.spill_path):
+      return True
+
+    with open(self.spill_path) as f:
+      entries = [json.loads(line) for line in f if line.strip()]
+
+    for entry in entries:
+      if entry.get("created_at"):
+        entry["created_at"] = datetime.fromisoformat(entry["created_at"])
+
+    written = self._write(entries)
+    self.entries_written += written
+
+    if written < len(entries):
+      # Keep only what is still unwritten
+      with open(self.spill_path, "w") as f:
+        for entry in entries[written:]:
+          f.write(json.dumps(entry, default=lambda value: value.isoformat()) + "\n")
+      return False
+
+    os.remove(self.spill_path)
+    return True
+
+  def close(self):
+    with self._condition:
+      self._closed = True
+      self._condition.notify()
+
+    self._thread.join()
+
+    # The backend is still unreachable, keep what is left on disk rather than lose it
+    with self._condition:
+      entries = list(self._queue)
+      self._queue.clear()
+    self._spill(entries)
+
+  def stats(self):
+    return {
+      "queue_depth": len(self._queue),
+      "entries_written": self.entries_written,
+      "entries_spilled": self.entries_spilled,
+      "flushes": self.flushes,
+      "failed_flushes": self.failed_flushes,
+      "last_flush_ms": round(self.last_flush_ms, 2),
+      "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0
+    }
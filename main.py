@@ -1,7 +1,19 @@
 from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from backend import router
+from langchain_utils import warmup_rag_chains, aclose_http_clients, http_client, http_async_client
+from ingestion_utils import recover_interrupted_jobs, shutdown_ingestion_pools, job_pool, parse_pool
+from reconcile_utils import start_reconcile_schedule, stop_reconcile_schedule
+from pydantic_utils import ModelName
+from database import chat_log_writer, storage
+from chroma_utils import embedding_function, vector_store, search_indexes
+from lazy_utils import warmup_components, retry_failed_components, component_status
+from metrics import render_metrics
+from token_utils import get_encoding
 from dotenv import load_dotenv
+import config
 import os
 
 load_dotenv()
@@ -15,78 +27,58 @@ os.environ["LANGSMITH_ENDPOINT"] = 'https://api.smith.langchain.com'
 os.environ["LANGSMITH_PROJECT"] = "RAG_Chatbot"
 LANGSMITH_API_KEY = os.getenv("LANGSMITH_API_KEY")
 
-app = FastAPI()
+# Build clients and pools, load the search indexes and the tokenizer and prebuild the rag chain for every model
+warmup_steps = {
+    "storage": storage,
+    "tokenizer": get_encoding,
+    "http_client": http_client,
+    "http_async_client": http_async_client,
+    "ingestion_jobs": job_pool,
+    "ingestion_parse": parse_pool,
+    "embeddings": embedding_function,
+    "chroma": vector_store,
+    "search_indexes": search_indexes,
+    "rag_chains": lambda: warmup_rag_chains([model.value for model in ModelName])
+}
+
+# Requeue or fail ingestion jobs left behind by a previous run, once the warmup is done
+recovery_steps = {
+    "job_recovery": recover_interrupted_jobs
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in parallel, timing each step, failures are retried by /health/ready
+    await run_in_threadpool(warmup_components, warmup_steps)
+    await run_in_threadpool(warmup_components, recovery_steps)
+    # Repair documents left half deleted, when a reconcile interval is set
+    start_reconcile_schedule()
+    yield
+    stop_reconcile_schedule()
+    shutdown_ingestion_pools()
+    # Flush queued chat logs before the process exits
+    chat_log_writer.close()
+    await aclose_http_clients()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(router=router)
 
-@app.get("/")
-async def root():
-    content = """
-    <!DOCTYPE html>
-    <html>
-        <head>
-            <title>API Health Check</title>
-            <style>
-                body {
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    background-color: #f5f5f5;
-                    margin: 0;
-                    padding: 0;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    height: 100vh;
-                    color: #333;
-                }
-                .container {
-                    background-color: white;
-                    border-radius: 8px;
-                    box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-                    padding: 2rem;
-                    width: 80%;
-                    max-width: 700px;
-                }
-                h1 {
-                    color: #2c3e50;
-                    margin-bottom: 0.5rem;
-                    text-align: center;
-                }
-                .status {
-                    display: flex;
-                    align-items: center;
-                    justify-content: center;
-                    margin: 1.5rem 0;
-                }
-                .status-indicator {
-                    width: 15px;
-                    height: 15px;
-                    border-radius: 50%;
-                    background-color: #2ecc71;
-                    margin-right: 10px;
-                }
-                .info {
-                    background-color: #f8f9fa;
-                    border-radius: 4px;
-                    padding: 1rem;
-                    margin: 1rem 0;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>API Health Status</h1>
-                <div class="status">
-                    <div class="status-indicator"></div>
-                    <span>API is running properly</span>
-                </div>
-                <div class="info">
-                    <p><strong>Environment:</strong> Production</p>
-                    <p><strong>Status:</strong> Online</p>
-                    <p><strong>Last Check:</strong> <script>document.write(new Date().toLocaleString())</script></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+# Ready once every component warmed up, otherwise 503 with the components that are pending or failed
+@app.get("/health/ready")
+async def health_ready():
+    # Steps that failed are run again, so the worker recovers once the failing service is back
+    await run_in_threadpool(retry_failed_components, {**warmup_steps, **recovery_steps}, config.COMPONENT_RETRY_SECONDS)
+
+    components = {name: dict(status) for name, status in component_status.items()}
+    ready = all(status["status"] == "ready" for status in components.values())
+
+    return JSONResponse(
+        content={"status": "ready" if ready else "not_ready", "components": components},
+        status_code=200 if ready else 503
+    )
 
-    return HTMLResponse(content=content,status_code=200)
\ No newline at end of file
+# Stage latency, token and chunk histograms for Prometheus to scrape
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
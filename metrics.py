@@ -0,0 +1,187 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+import threading
+import time
+
+
+"""
+Request Metrics:
+1. Each request starts a RequestTimings, kept in a context variable so stages deep in retrieval
+   record into it without it being passed around, threads started by langchain copy the context and see it too
+2. with timed("stage") measures a stage with perf_counter and records it in the request timings
+   and in the rag_stage_seconds histogram, labelled with the operation of the request
+3. Token and chunk counts are recorded into their own histograms
+4. /metrics renders every metric in the Prometheus text format, the stages of a request are echoed in its Server-Timing header
+
+Metrics are plain counters under a lock, nothing here depends on the LangSmith tracing configured in config.py
+"""
+
+# Seconds, from sub-millisecond cache lookups to slow llm answers
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+CHUNK_BUCKETS = (0, 1, 2, 4, 8, 12, 16, 20, 32, 50, 100, 250, 500, 1000)
+
+registry = []
+
+
+def format_labels(labelnames: Tuple[str, ...], labels: Tuple[str, ...], extra: str = "") -> str:
+  pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, labels)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value: float) -> str:
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Histogram:
+  def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = labelnames
+    self.buckets = buckets
+    self._series: Dict[Tuple[str, ...], list] = {}
+    self._lock = threading.Lock()
+    registry.append(self)
+
+  def observe(self, value: float, *labels: str):
+    # Counts per bucket are kept non cumulative and summed when rendered
+    index = bisect_left(self.buckets, value)
+
+    with self._lock:
+      series = self._series.get(labels)
+      if series is None:
+        series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+      series[0][index] += 1
+      series[1] += value
+      series[2] += 1
+
+  def render(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+
+    with self._lock:
+      series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+
+    for labels, counts, total, count in series:
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        le = 'le="' + format_value(bound) + '"'
+        lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+      le = 'le="+Inf"'
+      lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {count}")
+      lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+      lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+
+    return lines
+
+class Counter:
+  def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = labelnames
+    self._values: Dict[Tuple[str, ...], float] = {}
+    self._lock = threading.Lock()
+    registry.append(self)
+
+  def inc(self, *labels: str, amount: float = 1):
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def render(self) -> List[str]:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+
+    with self._lock:
+      values = list(self._values.items())
+
+    lines.extend(f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}" for labels, value in values)
+    return lines
+
+
+stage_seconds = Histogram("rag_stage_seconds", "Time spent in each stage of a request", ("operation", "stage"))
+request_seconds = Histogram("rag_request_seconds", "Time spent handling a request", ("operation",))
+context_tokens = Histogram("rag_context_tokens", "Tokens of retrieved context sent to the llm", ("model",), TOKEN_BUCKETS)
+answer_tokens = Histogram("rag_answer_tokens", "Tokens of generated answers", ("model",), TOKEN_BUCKETS)
+history_tokens = Histogram("rag_history_tokens", "Tokens of chat history sent with a question", ("model",), TOKEN_BUCKETS)
+retrieved_chunks = Histogram("rag_retrieved_chunks", "Chunks at each retrieval step: candidates fused, reranked and packed", ("step",), CHUNK_BUCKETS)
+indexed_chunks = Counter("rag_indexed_chunks_total", "Chunks indexed, split by whether the embedding came from the cache", ("embedding",))
+context_chunks = Counter("rag_context_chunks_total", "Re-ranked chunks by what context packing did with them: packed whole, truncated or dropped", ("result",))
+answer_cache_results = Counter("rag_answer_cache_total", "Answer cache lookups by result", ("result",))
+llm_seconds = Histogram("rag_llm_seconds", "Latency of llm calls by provider, to the whole answer or to the first streamed token", ("provider", "kind"))
+llm_requests = Counter("rag_llm_requests_total", "Llm calls by provider and outcome, hedged and cancelled calls included", ("provider", "outcome"))
+time_to_first_token = Histogram("rag_time_to_first_token_seconds", "Time from a streamed chat request to its first answer token, cached answers included", ("model",))
+
+
+# Stages of one request, in the order they finished
+class RequestTimings:
+  def __init__(self, operation: str):
+    self.operation = operation
+    self.start = time.perf_counter()
+    self.stages: List[Tuple[str, float]] = []
+
+  def record(self, stage: str, seconds: float):
+    self.stages.append((stage, seconds))
+    stage_seconds.observe(seconds, self.operation, stage)
+
+  def total(self, stage: str) -> float:
+    return sum(seconds for name, seconds in self.stages if name == stage)
+
+  def finish(self) -> float:
+    elapsed = time.perf_counter() - self.start
+    request_seconds.observe(elapsed, self.operation)
+    return elapsed
+
+  # Server-Timing header value, durations in milliseconds, a stage run more than once is summed
+  def server_timing(self, include_total: bool = True) -> str:
+    totals: Dict[str, float] = {}
+    for stage, seconds in self.stages:
+      totals[stage] = totals.get(stage, 0.0) + seconds
+
+    entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items()]
+    if include_total:
+      entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+    return ", ".join(entries)
+
+  def as_dict(self) -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    for stage, seconds in self.stages:
+      totals[stage] = round(totals.get(stage, 0.0) + seconds * 1000, 2)
+    return totals
+
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+
+# Start timing a request and make it the current one
+def start_timings(operation: str) -> RequestTimings:
+  timings = RequestTimings(operation)
+  current_timings.set(timings)
+  return timings
+
+# Make timings the current request, for generators that run outside the context of the endpoint
+def use_timings(timings: RequestTimings):
+  current_timings.set(timings)
+
+# Time a stage of the current request, outside a request it is recorded under the given operation
+@contextmanager
+def timed(stage: str, operation: str = "background"):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record_stage(stage, time.perf_counter() - start, operation)
+
+# Record a stage measured elsewhere
+def record_stage(stage: str, seconds: float, operation: str = "background"):
+  timings = current_timings.get()
+
+  if timings is not None:
+    timings.record(stage, seconds)
+  else:
+    stage_seconds.observe(seconds, operation, stage)
+
+def render_metrics() -> str:
+  lines = []
+  for metric in registry:
+    lines.extend(metric.render())
+  return "\n".join(lines) + "\n"
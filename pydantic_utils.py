@@ -1,17 +1,30 @@
 from pydantic import BaseModel, Field
 from enum import Enum
 from datetime import datetime
+from typing import List, Optional
 
 # Models available
 class ModelName(str, Enum):
   llama = "llama-3.3-70b-versatile"
   GPT = "gpt-40"
+  
+  # Tokens of retrieved context packed into the prompt for this model
+  @property
+  def context_token_budget(self) -> int:
+    return CONTEXT_TOKEN_BUDGETS[self]
+
+CONTEXT_TOKEN_BUDGETS = {
+  ModelName.llama: 3000,
+  ModelName.GPT: 6000
+}
 
 # /chat QueryInput
 class QueryInput(BaseModel):
   question: str
   session_id: str = Field(default=None)
   model: ModelName = Field(default=ModelName.llama)
+  # Restrict retrieval to these documents, all documents when empty
+  file_ids: Optional[List[str]] = Field(default=None)
   
 # /chat QueryResponse
 class QueryResponse(BaseModel):
@@ -19,6 +32,13 @@ class QueryResponse(BaseModel):
   session_id: str
   model: ModelName
   
+# /chat/stream sources event
+class SourceDocument(BaseModel):
+  file_id: Optional[str] = None
+  source: Optional[str] = None
+  page: Optional[int] = None
+  content: str
+  
 # /list-doc Response
 class DocumentInfo(BaseModel):
   id : str
@@ -29,3 +49,24 @@ class DocumentInfo(BaseModel):
 class DeleteFileRequest(BaseModel):
   file_id: str
   
+# /delete-docs Request
+class DeleteFilesRequest(BaseModel):
+  file_ids: List[str] = Field(min_length=1)
+  
+# /jobs/{job_id} Response
+class JobStatus(BaseModel):
+  id: str
+  job_type: str
+  status: str
+  filename: str
+  file_id: str
+  pages_parsed: int = 0
+  chunks_total: int = 0
+  chunks_embedded: int = 0
+  chunks_stored: int = 0
+  chunks_unchanged: int = 0
+  chunks_deleted: int = 0
+  embedding_cache: Optional[dict] = None
+  error: Optional[str] = None
+  created_at: Optional[datetime] = None
+  updated_at: Optional[datetime] = None
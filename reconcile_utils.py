@@ -0,0 +1,87 @@
+from chroma_utils import get_indexed_file_ids, delete_documents
+from database import get_document_upload_dates, get_latest_job_records, delete_document_records
+from datetime import datetime, timedelta, timezone
+import threading
+import config
+
+reconcile_stats = {
+  "runs": 0,
+  "orphan_chunk_files": 0,
+  "orphan_records": 0,
+  "last_run": None
+}
+
+stop_event = threading.Event()
+
+
+"""
+Reconciling Chroma with the Document Store:
+1. File ids with chunks are read from Chroma first, then the document records,
+   so a file uploaded in between always has its record in the second read
+2. Chunks of a file without a document record were left by a delete or a failed upload cleanup that stopped half way,
+   they are deleted from Chroma
+3. A document record without chunks was left by a delete that failed after Chroma, it is deleted unless
+   - it was uploaded less than RECONCILE_GRACE_SECONDS ago, its chunks may still be on the way
+   - its latest ingestion job is queued or running
+   - its latest ingestion job completed without chunks, the file had no text
+4. Runs on demand from /reconcile and every RECONCILE_INTERVAL_SECONDS in the background when it is set
+"""
+
+# Find orphans on either side and repair them unless dry_run, returns what was found
+def reconcile_documents(dry_run: bool = False) -> dict:
+  indexed_file_ids = get_indexed_file_ids()
+  upload_dates = get_document_upload_dates()
+
+  orphan_chunk_files = sorted(indexed_file_ids - set(upload_dates))
+
+  grace_cutoff = datetime.now(timezone.utc) - timedelta(seconds=config.RECONCILE_GRACE_SECONDS)
+  candidates = [
+    file_id for file_id, upload_date in upload_dates.items()
+    if file_id not in indexed_file_ids and upload_date is not None and upload_date < grace_cutoff
+  ]
+
+  latest_jobs = get_latest_job_records(candidates)
+  orphan_records = []
+  for file_id in candidates:
+    job = latest_jobs.get(file_id)
+
+    if job and job.get("status") in ("queued", "running"):
+      continue
+    if job and job.get("status") == "completed" and not job.get("chunks_total"):
+      continue
+
+    orphan_records.append(file_id)
+
+  if not dry_run:
+    if orphan_chunk_files:
+      delete_documents(orphan_chunk_files)
+    if orphan_records:
+      delete_document_records(orphan_records)
+
+    reconcile_stats["runs"] += 1
+    reconcile_stats["orphan_chunk_files"] += len(orphan_chunk_files)
+    reconcile_stats["orphan_records"] += len(orphan_records)
+    reconcile_stats["last_run"] = datetime.now(timezone.utc).isoformat()
+
+  print(f"Reconciled {len(upload_dates)} document records with {len(indexed_file_ids)} indexed files: {len(orphan_chunk_files)} orphan chunk files, {len(orphan_records)} orphan records{' (dry run)' if dry_run else ''}")
+
+  return {
+    "dry_run": dry_run,
+    "orphan_chunk_files": orphan_chunk_files,
+    "orphan_records": orphan_records
+  }
+
+def run_reconcile_schedule():
+  while not stop_event.wait(config.RECONCILE_INTERVAL_SECONDS):
+    try:
+      reconcile_documents()
+    except Exception as e:
+      print(f"Error reconciling documents: {e}")
+
+# Start the background reconciliation, off unless RECONCILE_INTERVAL_SECONDS is set
+def start_reconcile_schedule():
+  if config.RECONCILE_INTERVAL_SECONDS > 0:
+    threading.Thread(target=run_reconcile_schedule, name="reconcile", daemon=True).start()
+
+def stop_reconcile_schedule():
+  stop_event.set()
@@ -0,0 +1,106 @@
+from langchain_core.documents import Document
+from typing import List
+import numpy as np
+
+
+"""
+Re-ranking Retrieved Chunks:
+1. Chunks with the same content are kept once
+2. Maximal marginal relevance picks up to k chunks, each maximising
+   lambda_mult * similarity to the question - (1 - lambda_mult) * highest similarity to a chunk already picked,
+   chunks far less relevant than the best one are left out so easy questions get a short context
+3. Picked chunks of the same file and page whose text ranges overlap or touch are merged into one,
+   so the splitter overlap is sent to the llm only once
+
+Kept free of the vector store so it can be benchmarked on its own
+"""
+
+def normalise_rows(matrix: np.ndarray) -> np.ndarray:
+  norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+  return matrix / np.where(norms == 0, 1, norms)
+
+# Returns the indices of the picked embeddings, in the order they were picked
+# Candidates less similar to the question than min_relevance times the best one are never picked
+def mmr_select(query_embedding: List[float], embeddings: List[List[float]], k: int, lambda_mult: float = 0.7, min_relevance: float = 0.0) -> List[int]:
+  if not len(embeddings):
+    return []
+
+  matrix = normalise_rows(np.asarray(embeddings, dtype=np.float32))
+  query = normalise_rows(np.asarray([query_embedding], dtype=np.float32))[0]
+
+  relevance = matrix @ query
+  similarity = matrix @ matrix.T
+
+  eligible = relevance >= min_relevance * relevance.max() if relevance.max() > 0 else np.ones(len(matrix), dtype=bool)
+
+  # Highest similarity of every candidate to the chunks picked so far
+  redundancy = np.zeros(len(matrix), dtype=np.float32)
+  picked = []
+
+  for _ in range(min(k, int(eligible.sum()))):
+    scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy if picked else relevance.copy()
+    scores[picked] = -np.inf
+    scores[~eligible] = -np.inf
+
+    best = int(np.argmax(scores))
+    redundancy = np.maximum(redundancy, similarity[best]) if picked else similarity[best].copy()
+    picked.append(best)
+
+  return picked
+
+# Keep the first chunk of every distinct content, returns their indices
+def dedupe_indices(docs: List[Document]) -> List[int]:
+  seen = set()
+  kept = []
+
+  for index, doc in enumerate(docs):
+    if doc.page_content not in seen:
+      seen.add(doc.page_content)
+      kept.append(index)
+
+  return kept
+
+# Merge chunks of the same file and page whose start_index ranges overlap or touch, keeping the rank of the first
+def merge_adjacent_chunks(docs: List[Document]) -> List[Document]:
+  groups = {}
+  for rank, doc in enumerate(docs):
+    if doc.metadata.get("start_index") is None:
+      groups[("unmerged", rank)] = [(rank, doc)]
+    else:
+      groups.setdefault((doc.metadata.get("file_id"), doc.metadata.get("page")), []).append((rank, doc))
+
+  merged = []
+  for members in groups.values():
+    members.sort(key=lambda member: member[1].metadata.get("start_index") or 0)
+    rank, current = members[0]
+    start = current.metadata.get("start_index") or 0
+    text = current.page_content
+
+    for next_rank, doc in members[1:]:
+      next_start = doc.metadata["start_index"]
+      end = start + len(text)
+
+      if next_start <= end:
+        text += doc.page_content[end - next_start:]
+        rank = min(rank, next_rank)
+      else:
+        merged.append((rank, Document(id=current.id, page_content=text, metadata=current.metadata)))
+        rank, current, start, text = next_rank, doc, next_start, doc.page_content
+
+    merged.append((rank, Document(id=current.id, page_content=text, metadata=current.metadata)))
+
+  return [doc for _, doc in sorted(merged, key=lambda item: item[0])]
+
+# Dedupe, pick up to k chunks with maximal marginal relevance and merge overlapping neighbours
+def rerank_chunks(
+  query_embedding: List[float],
+  docs: List[Document],
+  embeddings: List[List[float]],
+  k: int,
+  lambda_mult: float = 0.7,
+  min_relevance: float = 0.0
+) -> List[Document]:
+  kept = dedupe_indices(docs)
+  picked = mmr_select(query_embedding, [embeddings[index] for index in kept], k, lambda_mult, min_relevance)
+
+  return merge_adjacent_chunks([docs[kept[index]] for index in picked])
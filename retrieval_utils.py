@@ -0,0 +1,109 @@
+from langchain_core.documents import Document
+from chroma_utils import vector_store, bm25_index, vector_index, use_vector_index, embedding_function, ensure_search_indexes
+from rerank_utils import rerank_chunks
+from context_utils import pack_context
+from metrics import timed, context_tokens, context_chunks, retrieved_chunks
+from typing import Dict, List
+import config
+
+
+"""
+Hybrid Retrieval:
+1. Vector search returns the RETRIEVAL_CANDIDATES nearest chunks to the standalone question,
+   questions scoped to file_ids push the scope down to Chroma as a where filter.
+   With VECTOR_ENGINE=mmap the memory-mapped index in vector_index answers instead of Chroma
+2. The BM25 index returns the RETRIEVAL_CANDIDATES best lexical matches, catching exact identifiers, codes and rare names,
+   its file to chunk index limits scoped questions to the rows of those files
+3. Both rankings are fused with reciprocal rank fusion and the top RERANK_CANDIDATES chunks are kept
+4. The candidates are read back from Chroma with their stored embeddings, or their text from Chroma and embeddings from the memory-mapped index
+5. Maximal marginal relevance picks up to MAX_CONTEXT_CHUNKS of them and overlapping neighbours are merged (rerank_utils)
+6. The picked chunks are packed into the context token budget of the model (context_utils)
+
+Every step is timed into the stages of the current request (metrics), with the chunk count after fusion, reranking and packing
+"""
+
+# Fuse rankings of chunk ids, a chunk scores 1 / (rrf_k + rank) in every ranking it appears in
+def reciprocal_rank_fusion(rankings: List[List[str]], rrf_k: int = 60) -> List[str]:
+  scores: Dict[str, float] = {}
+
+  for ranking in rankings:
+    for rank, chunk_id in enumerate(ranking, start=1):
+      scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank)
+
+  return sorted(scores, key=scores.get, reverse=True)
+
+# Retrieve chunks for the standalone question, reusing its embedding when it was already computed
+def retrieve_documents(inputs: dict, token_budget: int) -> List[Document]:
+  with timed("retrieval"):
+    return search_documents(inputs, token_budget)
+
+def search_documents(inputs: dict, token_budget: int) -> List[Document]:
+  question = inputs.get("standalone_question") or inputs["input"]
+  query_embedding = inputs.get("query_embedding")
+  if query_embedding is None:
+    with timed("embed"):
+      query_embedding = embedding_function.embed_query(question)
+
+  # Scoped questions search only the chunks of the given files, each search applies the scope with its own file index
+  # so a file the BM25 index has not caught up with is still found by vector search
+  file_ids = inputs.get("file_ids")
+  where = {"file_id": {"$in": list(file_ids)}} if file_ids else None
+  n_results = config.RETRIEVAL_CANDIDATES
+
+  ensure_search_indexes()
+  bm25_index.reload_if_changed()
+
+  # Ids only, the text and embeddings of the fused candidates are read once below
+  with timed("vector_search"):
+    if use_vector_index:
+      rankings = [[chunk_id for chunk_id, _ in vector_index.search(query_embedding, k=n_results, file_ids=file_ids)]]
+    else:
+      nearest = vector_store._collection.query(query_embeddings=[query_embedding], n_results=n_results, where=where, include=["distances"])
+      rankings = [nearest["ids"][0]]
+
+  if config.HYBRID_RETRIEVAL:
+    with timed("bm25_search"):
+      rankings.append([chunk_id for chunk_id, _ in bm25_index.search(question, k=config.RETRIEVAL_CANDIDATES, file_ids=file_ids)])
+
+  candidate_ids = reciprocal_rank_fusion(rankings, rrf_k=config.RRF_K)[:config.RERANK_CANDIDATES]
+  retrieved_chunks.observe(len(candidate_ids), "candidates")
+  if not candidate_ids:
+    return []
+
+  with timed("candidate_fetch"):
+    if use_vector_index:
+      candidates = vector_store._collection.get(ids=candidate_ids, include=["documents", "metadatas"])
+      embeddings = vector_index.get_embeddings(candidates["ids"])
+    else:
+      candidates = vector_store._collection.get(ids=candidate_ids, include=["embeddings", "documents", "metadatas"])
+      embeddings = candidates["embeddings"]
+
+  rows = {
+    chunk_id: (Document(id=chunk_id, page_content=content, metadata=metadata or {}), embedding)
+    for chunk_id, content, metadata, embedding in zip(candidates["ids"], candidates["documents"], candidates["metadatas"], embeddings)
+    if embedding is not None
+  }
+
+  # A chunk deleted since the BM25 index was saved is skipped
+  ranked = [rows[chunk_id] for chunk_id in candidate_ids if chunk_id in rows]
+
+  with timed("rerank"):
+    reranked = rerank_chunks(
+      query_embedding,
+      [doc for doc, _ in ranked],
+      [embedding for _, embedding in ranked],
+      k=config.MAX_CONTEXT_CHUNKS,
+      lambda_mult=config.MMR_LAMBDA,
+      min_relevance=config.CONTEXT_MIN_RELEVANCE
+    )
+  retrieved_chunks.observe(len(reranked), "reranked")
+
+  with timed("context_pack"):
+    packed, report = pack_context(reranked, token_budget)
+  retrieved_chunks.observe(len(packed), "packed")
+  context_tokens.observe(report["tokens_used"], inputs.get("model", ""))
+  context_chunks.inc("packed", amount=report["chunks_packed"] - report["chunks_truncated"])
+  context_chunks.inc("truncated", amount=report["chunks_truncated"])
+  context_chunks.inc("dropped", amount=report["chunks_dropped"])
+
+  return packed
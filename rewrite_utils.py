@@ -0,0 +1,88 @@
+from langchain_utils import get_rewrite_chain
+from cache_utils import LRUTTLCache
+from typing import List
+import hashlib
+import re
+import config
+
+# Words that point back into the conversation, a question using one of them is rewritten
+REFERENCE_WORDS = {
+  "it", "its", "itself", "they", "them", "their", "theirs", "themselves",
+  "he", "him", "his", "she", "her", "hers",
+  "this", "that", "these", "those", "there", "then",
+  "above", "previous", "earlier", "former", "latter", "same", "such",
+  "one", "ones", "another", "other", "others", "else",
+  "also", "again", "more", "further", "too", "instead"
+}
+
+# Openings that continue the previous turn
+FOLLOW_UP_PREFIXES = ("and ", "but ", "so ", "or ", "what about", "how about", "why not")
+
+# Questions shorter than this rarely stand on their own ("why?", "explain more")
+MIN_SELF_CONTAINED_WORDS = 4
+
+WORD_PATTERN = re.compile(r"[a-z']+")
+
+# Recent rewrites keyed by model, question and the last answer it follows
+rewrite_memo = LRUTTLCache(max_entries=config.REWRITE_MEMO_MAX_ENTRIES, ttl_seconds=config.SESSION_CACHE_TTL_SECONDS)
+
+rewrite_stats = {
+  "requests": 0,
+  "rewrites": 0,
+  "skipped_first_turn": 0,
+  "skipped_self_contained": 0,
+  "memo_hits": 0
+}
+
+
+"""
+Question Rewrite Fast Path:
+1. A first question has no history to resolve, it is sent to the retriever as is
+2. A question with no reference words, no follow up opening and a few words of its own is treated as self-contained
+3. A follow up asked again after the same answer reuses the memoised rewrite
+4. Only the remaining questions pay for the rewrite llm call
+
+The heuristics err towards rewriting, a missed skip costs one llm call while a wrong skip hurts retrieval
+"""
+
+def is_self_contained(question: str) -> bool:
+  text = question.strip().lower()
+  words = WORD_PATTERN.findall(text)
+
+  if len(words) < MIN_SELF_CONTAINED_WORDS or text.startswith(FOLLOW_UP_PREFIXES):
+    return False
+
+  return not any(word in REFERENCE_WORDS for word in words)
+
+def memo_key(model: str, question: str, chat_history: List[dict]) -> str:
+  last_message = chat_history[-1]["content"] if chat_history else ""
+  return hashlib.sha256(f"{model}\0{question.strip().lower()}\0{last_message}".encode("utf-8")).hexdigest()
+
+# Standalone question for retrieval, the rewrite llm call is only made when the question may depend on history
+async def arewrite_question(model: str, question: str, chat_history: List[dict]) -> str:
+  rewrite_stats["requests"] += 1
+
+  if not chat_history:
+    rewrite_stats["skipped_first_turn"] += 1
+    return question
+
+  if is_self_contained(question):
+    rewrite_stats["skipped_self_contained"] += 1
+    return question
+
+  key = memo_key(model, question, chat_history)
+  standalone_question = rewrite_memo.get(key)
+
+  if standalone_question is not None:
+    rewrite_stats["memo_hits"] += 1
+    return standalone_question
+
+  standalone_question = await get_rewrite_chain(model).ainvoke({"input": question, "chat_history": chat_history})
+  rewrite_memo.set(key, standalone_question)
+  rewrite_stats["rewrites"] += 1
+
+  return standalone_question
+
+def get_rewrite_stats():
+  avoided = rewrite_stats["requests"] - rewrite_stats["rewrites"]
+  return {**rewrite_stats, "rewrites_avoided": avoided}
@@ -0,0 +1,255 @@
+from langchain_core.callbacks import CallbackManager
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic_utils import ModelName
+from metrics import llm_seconds, llm_requests
+from collections import deque
+from contextlib import suppress
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+import threading
+import asyncio
+import time
+import os
+import config
+
+
+"""
+Llm Routing:
+1. Every model is served by its own provider first, the other provider is the alternate when its api key is set
+2. Every call to a provider has a deadline, LLM_DEADLINE_SECONDS_GROQ or LLM_DEADLINE_SECONDS_OPENAI,
+   for a streamed answer the deadline is on the first token
+3. With LLM_FALLBACK a call that fails or misses its deadline is sent to the alternate provider
+4. With LLM_HEDGING a second request goes to the alternate provider once the first has taken longer than
+   the p95 latency of its provider, the first to succeed wins and the other request is cancelled
+5. Latencies of the recent calls to each provider set the hedge delay, a provider failing LLM_FAILURE_THRESHOLD
+   calls in a row is tried last for LLM_COOLDOWN_SECONDS. Latency never reorders providers, the alternate serves another model
+6. Calls to the provider clients run as child runs of the routed model, so callbacks and traces follow them
+"""
+
+# Provider serving each model, clients send the GPT option as "gpt-40" and it is served by gpt-4o
+MODEL_PROVIDERS = {ModelName.llama.value: "groq", ModelName.GPT.value: "openai", "gpt-4o": "openai"}
+PROVIDER_MODELS = {"groq": ModelName.llama.value, "openai": "gpt-4o"}
+PROVIDER_API_KEYS = {"groq": "GROQ_API_KEY", "openai": "OPENAI_API_KEY"}
+PROVIDER_DEADLINES = {"groq": config.LLM_DEADLINE_SECONDS_GROQ, "openai": config.LLM_DEADLINE_SECONDS_OPENAI}
+
+
+# Recent latencies and outcomes of one provider, kind is "invoke" for a whole answer or "first_token" for a stream
+class ProviderStats:
+  def __init__(self, name: str, window: int):
+    self.name = name
+    self.latencies = {"invoke": deque(maxlen=window), "first_token": deque(maxlen=window)}
+    self.counts = {"success": 0, "error": 0, "timeout": 0, "cancelled": 0, "hedged": 0, "hedge_wins": 0}
+    self.consecutive_failures = 0
+    self.unhealthy_until = 0.0
+    self._lock = threading.Lock()
+
+  def record_success(self, kind: str, seconds: float):
+    with self._lock:
+      self.latencies[kind].append(seconds)
+      self.counts["success"] += 1
+      self.consecutive_failures = 0
+    llm_seconds.observe(seconds, self.name, kind)
+    llm_requests.inc(self.name, "success")
+
+  def record_failure(self, outcome: str):
+    with self._lock:
+      self.counts[outcome] += 1
+      self.consecutive_failures += 1
+      if self.consecutive_failures >= config.LLM_FAILURE_THRESHOLD:
+        self.unhealthy_until = time.monotonic() + config.LLM_COOLDOWN_SECONDS
+    llm_requests.inc(self.name, outcome)
+
+  def record(self, outcome: str):
+    with self._lock:
+      self.counts[outcome] += 1
+    llm_requests.inc(self.name, outcome)
+
+  def healthy(self) -> bool:
+    return time.monotonic() >= self.unhealthy_until
+
+  # None until enough calls were seen
+  def p95(self, kind: str) -> Optional[float]:
+    with self._lock:
+      latencies = sorted(self.latencies[kind])
+
+    if len(latencies) < config.LLM_LATENCY_MIN_SAMPLES:
+      return None
+    return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+  def stats(self):
+    p95 = {kind: self.p95(kind) for kind in self.latencies}
+    return {
+      **self.counts,
+      "healthy": self.healthy(),
+      "p95_ms": {kind: round(seconds * 1000, 1) if seconds is not None else None for kind, seconds in p95.items()}
+    }
+
+class ModelRouter:
+  def __init__(self):
+    self.providers = {name: ProviderStats(name, config.LLM_LATENCY_WINDOW) for name in PROVIDER_MODELS}
+
+  # The provider of the model and the alternate one if it can be used, an unknown model goes to Groq like before
+  def providers_for(self, model: str) -> List[str]:
+    primary = MODEL_PROVIDERS.get(model, "groq")
+    providers = [primary]
+
+    if config.LLM_FALLBACK or config.LLM_HEDGING:
+      providers.extend(
+        provider for provider in PROVIDER_MODELS
+        if provider != primary and os.getenv(PROVIDER_API_KEYS[provider])
+      )
+    return providers
+
+  # Model id sent to the provider
+  def model_id(self, model: str, provider: str) -> str:
+    return PROVIDER_MODELS[provider] if model in MODEL_PROVIDERS else model
+
+  def deadline(self, provider: str) -> float:
+    return PROVIDER_DEADLINES[provider]
+
+  # Healthy providers first, keeping their order so the requested model answers while its provider is healthy
+  def order(self, providers: List[str]) -> List[str]:
+    return sorted(providers, key=lambda provider: not self.providers[provider].healthy())
+
+  # Wait the p95 latency of the provider before hedging, bounded by LLM_HEDGE_MIN_DELAY_SECONDS and the deadline
+  def hedge_delay(self, provider: str, kind: str) -> float:
+    p95 = self.providers[provider].p95(kind)
+    delay = config.LLM_HEDGE_DELAY_SECONDS if p95 is None else p95
+    return min(max(delay, config.LLM_HEDGE_MIN_DELAY_SECONDS), self.deadline(provider))
+
+  # Run call on the providers in order, hedging or falling back to the next one, returns the winning provider and its result
+  async def run(self, providers: List[str], call: Callable[[str], Any], kind: str):
+    queue = self.order(providers)
+    primary = queue[0]
+    tasks = {}
+    last_error = None
+
+    def launch(provider: str, hedged: bool = False):
+      task = asyncio.ensure_future(asyncio.wait_for(call(provider), self.deadline(provider)))
+      tasks[task] = (provider, time.perf_counter(), hedged)
+      if hedged:
+        self.providers[provider].record("hedged")
+
+    launch(queue.pop(0))
+    hedge_at = time.perf_counter() + self.hedge_delay(primary, kind)
+
+    try:
+      while tasks:
+        timeout = max(hedge_at - time.perf_counter(), 0.0) if config.LLM_HEDGING and queue else None
+        done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+        if not done:
+          launch(queue.pop(0), hedged=True)
+          continue
+
+        for task in done:
+          provider, start, hedged = tasks.pop(task)
+
+          try:
+            result = task.result()
+          except Exception as e:
+            timed_out = isinstance(e, asyncio.TimeoutError)
+            self.providers[provider].record_failure("timeout" if timed_out else "error")
+            print(f"Llm call to {provider} {'missed its deadline' if timed_out else f'failed: {e}'}")
+            last_error = e
+
+            # Fall back right away unless a hedged request is still running
+            if queue and not tasks:
+              launch(queue.pop(0))
+            continue
+
+          self.providers[provider].record_success(kind, time.perf_counter() - start)
+          if hedged:
+            self.providers[provider].record("hedge_wins")
+          return provider, result
+
+      raise last_error
+
+    finally:
+      # Cancel the request that lost and wait for its connection to be released
+      for task, (provider, _, _) in tasks.items():
+        task.cancel()
+        self.providers[provider].record("cancelled")
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+  def stats(self):
+    return {
+      "fallback": config.LLM_FALLBACK,
+      "hedging": config.LLM_HEDGING,
+      "providers": {name: provider.stats() for name, provider in self.providers.items()}
+    }
+
+model_router = ModelRouter()
+
+# Config for a call to a provider client, a child of the routed run when there is one.
+# Llm run managers have no get_child, the child manager is built the way ParentRunManager.get_child builds it
+def child_config(run_manager) -> dict:
+  if not run_manager:
+    return {}
+
+  callbacks = CallbackManager(handlers=[], parent_run_id=run_manager.run_id)
+  callbacks.set_handlers(run_manager.inheritable_handlers)
+  callbacks.add_tags(run_manager.inheritable_tags)
+  callbacks.add_metadata(run_manager.inheritable_metadata)
+  return {"callbacks": callbacks}
+
+
+# Chat model over the clients of every provider of a model, routed by model_router
+class RoutedChatModel(BaseChatModel):
+  model: str
+  routes: Dict[str, Any]
+
+  @property
+  def _llm_type(self) -> str:
+    return "routed"
+
+  # Without an event loop the providers are only tried in order, each client has its deadline as request timeout
+  def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+    last_error = None
+
+    for provider in model_router.order(list(self.routes)):
+      start = time.perf_counter()
+      try:
+        message = self.routes[provider].invoke(messages, config=child_config(run_manager), stop=stop, **kwargs)
+      except Exception as e:
+        model_router.providers[provider].record_failure("error")
+        print(f"Llm call to {provider} failed: {e}")
+        last_error = e
+        continue
+
+      model_router.providers[provider].record_success("invoke", time.perf_counter() - start)
+      return ChatResult(generations=[ChatGeneration(message=message)])
+
+    raise last_error
+
+  async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+    _, message = await model_router.run(
+      list(self.routes),
+      lambda provider: self.routes[provider].ainvoke(messages, config=child_config(run_manager), stop=stop, **kwargs),
+      kind="invoke"
+    )
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  # Hedged on the first token, the stream that sends it first is kept and the others are closed.
+  # BaseChatModel.astream reports the tokens of the routed run itself and passes no run_manager,
+  # the provider streams then run under the config of the enclosing runnable
+  async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+    streams = {}
+
+    async def first_chunk(provider: str):
+      stream = streams[provider] = self.routes[provider].astream(messages, config=child_config(run_manager), stop=stop, **kwargs)
+      return await anext(stream, None)
+
+    try:
+      provider, chunk = await model_router.run(list(self.routes), first_chunk, kind="first_token")
+
+      if chunk is not None:
+        yield ChatGenerationChunk(message=chunk)
+        async for chunk in streams[provider]:
+          yield ChatGenerationChunk(message=chunk)
+
+    finally:
+      for stream in streams.values():
+        with suppress(Exception):
+          await stream.aclose()
@@ -0,0 +1,551 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+import threading
+import sqlite3
+import asyncio
+import queue
+import json
+import uuid
+import os
+import config
+
+
+"""
+Storage Backends:
+Chat logs, session summaries, document records and ingestion jobs are stored through one StorageBackend.
+database.py wraps it with error handling, the session cache and the document index cache.
+
+The firestore backend keeps everything in Firestore collections and needs the Firebase credential.
+The sqlite backend keeps everything in one local file in WAL mode, for single node deployments:
+1. Readers never wait on the writer, so history reads stay local and sub-millisecond
+2. Connections come from a fixed pool shared by every thread, each one used by one thread at a time
+3. Chat logs are indexed on (session_id, created_at), documents on upload_date and jobs on status and file_id
+4. Async reads and writes run in a thread on a pooled connection, so a checkpoint or a lock held by
+   another process never blocks the event loop
+
+Timestamps are timezone aware UTC datetimes on both backends.
+"""
+
+class StorageBackend(ABC):
+  name = "base"
+
+  # Chat logs, an entry without created_at is stamped by the backend
+  @abstractmethod
+  def add_chat_logs(self, entries: List[dict]):
+    ...
+
+  # Chat log entries of a session, oldest first
+  @abstractmethod
+  def get_chat_logs(self, session_id: str) -> List[dict]:
+    ...
+
+  async def aadd_chat_logs(self, entries: List[dict]):
+    await asyncio.to_thread(self.add_chat_logs, entries)
+
+  async def aget_chat_logs(self, session_id: str) -> List[dict]:
+    return await asyncio.to_thread(self.get_chat_logs, session_id)
+
+  # Rolling summaries of sessions
+  @abstractmethod
+  async def aget_session_summary(self, session_id: str) -> Optional[dict]:
+    ...
+
+  @abstractmethod
+  async def aset_session_summary(self, session_id: str, summary: str, summarized_messages: int):
+    ...
+
+  # Document records, returned as {"id", "filename", "upload_timestamp"}
+  @abstractmethod
+  def insert_document(self, filename: str) -> str:
+    ...
+
+  @abstractmethod
+  def get_document(self, file_id: str) -> Optional[dict]:
+    ...
+
+  @abstractmethod
+  def update_document(self, file_id: str, filename: str):
+    ...
+
+  @abstractmethod
+  def delete_documents(self, file_ids: List[str]):
+    ...
+
+  # Every document record, newest first
+  @abstractmethod
+  def list_documents(self) -> List[dict]:
+    ...
+
+  @abstractmethod
+  def get_document_upload_dates(self) -> Dict[str, Optional[datetime]]:
+    ...
+
+  # Ingestion jobs, returned as {"id", **job fields}
+  @abstractmethod
+  def insert_job(self, job_data: dict) -> str:
+    ...
+
+  @abstractmethod
+  def update_job(self, job_id: str, fields: dict):
+    ...
+
+  @abstractmethod
+  def get_job(self, job_id: str) -> Optional[dict]:
+    ...
+
+  @abstractmethod
+  def get_unfinished_jobs(self) -> List[dict]:
+    ...
+
+  # Hand a job over to new_owner if it is still held by expected_owner, returns whether it was claimed
+  @abstractmethod
+  def claim_job(self, job_id: str, expected_owner: str, new_owner: str) -> bool:
+    ...
+
+  # Most recent job of each file
+  @abstractmethod
+  def get_latest_jobs(self, file_ids: List[str]) -> Dict[str, dict]:
+    ...
+
+  def stats(self):
+    return {"backend": self.name}
+
+
+def utc_epoch() -> datetime:
+  return datetime.min.replace(tzinfo=timezone.utc)
+
+def latest_by_created_at(jobs) -> Dict[str, dict]:
+  latest = {}
+  for job in jobs:
+    current = latest.get(job["file_id"])
+    if current is None or (job.get("created_at") or utc_epoch()) > (current.get("created_at") or utc_epoch()):
+      latest[job["file_id"]] = job
+
+  return latest
+
+
+# Everything in Firestore collections
+class FirestoreStorageBackend(StorageBackend):
+  name = "firestore"
+
+  # Firestore limits on writes per batch and values per 'in' filter
+  BATCH_SIZE = 500
+  IN_LIMIT = 30
+
+  def __init__(self, credentials_path: str):
+    import firebase_admin
+    from firebase_admin import credentials, firestore, firestore_async
+
+    # The app survives a failed client init, a retry reuses it
+    try:
+      firebase_admin.get_app()
+    except ValueError:
+      firebase_admin.initialize_app(credentials.Certificate(credentials_path))
+    self.firestore = firestore
+    self.db = firestore.client()
+    self.async_db = firestore_async.client()
+
+  def stamped(self, entry: dict) -> dict:
+    return entry if entry.get("created_at") is not None else {**entry, "created_at": self.firestore.SERVER_TIMESTAMP}
+
+  def add_chat_logs(self, entries):
+    # One entry is a plain add, several go in one batched write
+    logs_ref = self.db.collection('chat_logs')
+    if len(entries) == 1:
+      logs_ref.add(self.stamped(entries[0]))
+      return
+
+    batch = self.db.batch()
+    for entry in entries:
+      batch.set(logs_ref.document(), self.stamped(entry))
+    batch.commit()
+
+  def get_chat_logs(self, session_id):
+    # Query the collection by session id in the order of timestamps
+    query = self.db.collection('chat_logs').where('session_id', '==', session_id).order_by('created_at')
+    return [doc.to_dict() for doc in query.stream()]
+
+  async def aadd_chat_logs(self, entries):
+    logs_ref = self.async_db.collection('chat_logs')
+    if len(entries) == 1:
+      await logs_ref.add(self.stamped(entries[0]))
+      return
+
+    batch = self.async_db.batch()
+    for entry in entries:
+      batch.set(logs_ref.document(), self.stamped(entry))
+    await batch.commit()
+
+  async def aget_chat_logs(self, session_id):
+    query = self.async_db.collection('chat_logs').where('session_id', '==', session_id).order_by('created_at')
+    return [doc.to_dict() async for doc in query.stream()]
+
+  async def aget_session_summary(self, session_id):
+    snapshot = await self.async_db.collection('session_summaries').document(session_id).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+  async def aset_session_summary(self, session_id, summary, summarized_messages):
+    await self.async_db.collection('session_summaries').document(session_id).set({
+      "summary": summary,
+      "summarized_messages": summarized_messages,
+      "updated_at": self.firestore.SERVER_TIMESTAMP
+    })
+
+  @staticmethod
+  def document_info(snapshot) -> dict:
+    doc_data = snapshot.to_dict()
+    return {
+      'id': snapshot.id,
+      'filename': doc_data.get('filename'),
+      'upload_timestamp': doc_data.get('upload_date')
+    }
+
+  def insert_document(self, filename):
+    doc_ref = self.db.collection('document_store').document()
+    doc_ref.set({
+      "filename": filename,
+      "upload_date": self.firestore.SERVER_TIMESTAMP
+    })
+    return doc_ref.id
+
+  def get_document(self, file_id):
+    snapshot = self.db.collection('document_store').document(file_id).get()
+    return self.document_info(snapshot) if snapshot.exists else None
+
+  def update_document(self, file_id, filename):
+    self.db.collection('document_store').document(file_id).update({
+      "filename": filename,
+      "upload_date": self.firestore.SERVER_TIMESTAMP
+    })
+
+  def delete_documents(self, file_ids):
+    docs_ref = self.db.collection('document_store')
+
+    for start in range(0, len(file_ids), self.BATCH_SIZE):
+      batch = self.db.batch()
+      for file_id in file_ids[start:start + self.BATCH_SIZE]:
+        batch.delete(docs_ref.document(file_id))
+      batch.commit()
+
+  def list_documents(self):
+    docs_ref = self.db.collection('document_store').order_by('upload_date', direction=self.firestore.Query.DESCENDING)
+    return [self.document_info(doc) for doc in docs_ref.stream()]
+
+  def get_document_upload_dates(self):
+    query = self.db.collection('document_store').select(['upload_date'])
+    return {doc.id: doc.to_dict().get('upload_date') for doc in query.stream()}
+
+  def insert_job(self, job_data):
+    doc_ref = self.db.collection('ingestion_jobs').document()
+    doc_ref.set({
+      **job_data,
+      "created_at": self.firestore.SERVER_TIMESTAMP,
+      "updated_at": self.firestore.SERVER_TIMESTAMP
+    })
+    return doc_ref.id
+
+  def update_job(self, job_id, fields):
+    self.db.collection('ingestion_jobs').document(job_id).update({**fields, "updated_at": self.firestore.SERVER_TIMESTAMP})
+
+  def get_job(self, job_id):
+    snapshot = self.db.collection('ingestion_jobs').document(job_id).get()
+    return {"id": snapshot.id, **snapshot.to_dict()} if snapshot.exists else None
+
+  def get_unfinished_jobs(self):
+    query = self.db.collection('ingestion_jobs').where('status', 'in', ['queued', 'running'])
+    return [{"id": doc.id, **doc.to_dict()} for doc in query.stream()]
+
+  def claim_job(self, job_id, expected_owner, new_owner):
+    doc_ref = self.db.collection('ingestion_jobs').document(job_id)
+
+    @self.firestore.transactional
+    def claim(transaction):
+      snapshot = doc_ref.get(transaction=transaction)
+
+      if not snapshot.exists or snapshot.get('owner') != expected_owner:
+        return False
+
+      transaction.update(doc_ref, {"owner": new_owner, "updated_at": self.firestore.SERVER_TIMESTAMP})
+      return True
+
+    return claim(self.db.transaction())
+
+  def get_latest_jobs(self, file_ids):
+    jobs = []
+    for start in range(0, len(file_ids), self.IN_LIMIT):
+      query = self.db.collection('ingestion_jobs').where('file_id', 'in', file_ids[start:start + self.IN_LIMIT])
+      jobs.extend({"id": doc.id, **doc.to_dict()} for doc in query.stream())
+
+    return latest_by_created_at(jobs)
+
+
+# Everything in one local SQLite file in WAL mode
+class SQLiteStorageBackend(StorageBackend):
+  name = "sqlite"
+
+  SCHEMA = """
+  CREATE TABLE IF NOT EXISTS chat_logs (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    user_query TEXT NOT NULL,
+    llm_response TEXT NOT NULL,
+    model TEXT,
+    time_to_first_token_ms REAL,
+    created_at TEXT NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS chat_logs_session ON chat_logs (session_id, created_at);
+
+  CREATE TABLE IF NOT EXISTS session_summaries (
+    session_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    summarized_messages INTEGER NOT NULL,
+    updated_at TEXT NOT NULL
+  );
+
+  CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    upload_date TEXT NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS documents_upload_date ON documents (upload_date);
+
+  CREATE TABLE IF NOT EXISTS ingestion_jobs (
+    id TEXT PRIMARY KEY,
+    file_id TEXT,
+    status TEXT,
+    owner TEXT,
+    data TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS ingestion_jobs_status ON ingestion_jobs (status);
+  CREATE INDEX IF NOT EXISTS ingestion_jobs_file ON ingestion_jobs (file_id, created_at);
+  """
+
+  # Job fields kept in their own columns so they can be queried, the rest is stored as json
+  JOB_COLUMNS = ("file_id", "status", "owner")
+
+  # Fixed width UTC timestamps sort in time order as text
+  TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f+00:00"
+
+  def __init__(self, path: str, pool_size: int):
+    self.path = path
+    self.pool_size = pool_size
+    self.pool = queue.Queue()
+    self._write_lock = threading.Lock()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    for _ in range(pool_size):
+      self.pool.put(self.connect())
+
+    with self.connection() as conn:
+      conn.executescript(self.SCHEMA)
+
+  def connect(self) -> sqlite3.Connection:
+    conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+  @contextmanager
+  def connection(self):
+    conn = self.pool.get()
+    try:
+      yield conn
+    finally:
+      self.pool.put(conn)
+
+  # One write transaction at a time in this process, other processes wait on the database lock
+  @contextmanager
+  def transaction(self):
+    with self._write_lock, self.connection() as conn:
+      conn.execute("BEGIN IMMEDIATE")
+      try:
+        yield conn
+      except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+      conn.execute("COMMIT")
+
+  @classmethod
+  def format_time(cls, value: Optional[datetime] = None) -> str:
+    value = value or datetime.now(timezone.utc)
+    if value.tzinfo is None:
+      value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime(cls.TIME_FORMAT)
+
+  @staticmethod
+  def parse_time(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+  def add_chat_logs(self, entries):
+    rows = [(
+      entry["session_id"],
+      entry["user_query"],
+      entry["llm_response"],
+      entry.get("model"),
+      entry.get("time_to_first_token_ms"),
+      self.format_time(entry.get("created_at"))
+    ) for entry in entries]
+
+    with self.transaction() as conn:
+      conn.executemany(
+        "INSERT INTO chat_logs (session_id, user_query, llm_response, model, time_to_first_token_ms, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+      )
+
+  def select_chat_logs(self, conn, session_id):
+    rows = conn.execute(
+      "SELECT session_id, user_query, llm_response, model, time_to_first_token_ms, created_at FROM chat_logs WHERE session_id = ? ORDER BY created_at, id",
+      (session_id,)
+    ).fetchall()
+
+    return [{**dict(row), "created_at": self.parse_time(row["created_at"])} for row in rows]
+
+  def get_chat_logs(self, session_id):
+    with self.connection() as conn:
+      return self.select_chat_logs(conn, session_id)
+
+  async def aget_chat_logs(self, session_id):
+    return await asyncio.to_thread(self.get_chat_logs, session_id)
+
+  def get_session_summary(self, session_id):
+    with self.connection() as conn:
+      row = conn.execute("SELECT summary, summarized_messages, updated_at FROM session_summaries WHERE session_id = ?", (session_id,)).fetchone()
+
+    return {**dict(row), "updated_at": self.parse_time(row["updated_at"])} if row else None
+
+  async def aget_session_summary(self, session_id):
+    return await asyncio.to_thread(self.get_session_summary, session_id)
+
+  def set_session_summary(self, session_id, summary, summarized_messages):
+    with self.transaction() as conn:
+      conn.execute(
+        "INSERT OR REPLACE INTO session_summaries (session_id, summary, summarized_messages, updated_at) VALUES (?, ?, ?, ?)",
+        (session_id, summary, summarized_messages, self.format_time())
+      )
+
+  async def aset_session_summary(self, session_id, summary, summarized_messages):
+    await asyncio.to_thread(self.set_session_summary, session_id, summary, summarized_messages)
+
+  def document_info(self, row) -> dict:
+    return {"id": row["id"], "filename": row["filename"], "upload_timestamp": self.parse_time(row["upload_date"])}
+
+  def insert_document(self, filename):
+    file_id = uuid.uuid4().hex
+    with self.transaction() as conn:
+      conn.execute("INSERT INTO documents (id, filename, upload_date) VALUES (?, ?, ?)", (file_id, filename, self.format_time()))
+    return file_id
+
+  def get_document(self, file_id):
+    with self.connection() as conn:
+      row = conn.execute("SELECT id, filename, upload_date FROM documents WHERE id = ?", (file_id,)).fetchone()
+    return self.document_info(row) if row else None
+
+  def update_document(self, file_id, filename):
+    with self.transaction() as conn:
+      updated = conn.execute("UPDATE documents SET filename = ?, upload_date = ? WHERE id = ?", (filename, self.format_time(), file_id)).rowcount
+
+    # Same as a Firestore update of a missing document
+    if not updated:
+      raise KeyError(f"No document {file_id}")
+
+  def delete_documents(self, file_ids):
+    with self.transaction() as conn:
+      conn.executemany("DELETE FROM documents WHERE id = ?", [(file_id,) for file_id in file_ids])
+
+  def list_documents(self):
+    with self.connection() as conn:
+      rows = conn.execute("SELECT id, filename, upload_date FROM documents ORDER BY upload_date DESC").fetchall()
+    return [self.document_info(row) for row in rows]
+
+  def get_document_upload_dates(self):
+    with self.connection() as conn:
+      rows = conn.execute("SELECT id, upload_date FROM documents").fetchall()
+    return {row["id"]: self.parse_time(row["upload_date"]) for row in rows}
+
+  def job_info(self, row) -> dict:
+    return {
+      "id": row["id"],
+      **json.loads(row["data"]),
+      **{column: row[column] for column in self.JOB_COLUMNS if row[column] is not None},
+      "created_at": self.parse_time(row["created_at"]),
+      "updated_at": self.parse_time(row["updated_at"])
+    }
+
+  def insert_job(self, job_data):
+    job_id = uuid.uuid4().hex
+    now = self.format_time()
+    data = {key: value for key, value in job_data.items() if key not in self.JOB_COLUMNS}
+
+    with self.transaction() as conn:
+      conn.execute(
+        "INSERT INTO ingestion_jobs (id, file_id, status, owner, data, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (job_id, *[job_data.get(column) for column in self.JOB_COLUMNS], json.dumps(data, default=str), now, now)
+      )
+    return job_id
+
+  def update_job(self, job_id, fields):
+    with self.transaction() as conn:
+      row = conn.execute("SELECT data FROM ingestion_jobs WHERE id = ?", (job_id,)).fetchone()
+      if row is None:
+        raise KeyError(f"No ingestion job {job_id}")
+
+      data = {**json.loads(row["data"]), **{key: value for key, value in fields.items() if key not in self.JOB_COLUMNS}}
+      columns = [column for column in self.JOB_COLUMNS if column in fields]
+      assignments = "".join(f", {column} = ?" for column in columns)
+
+      conn.execute(
+        f"UPDATE ingestion_jobs SET data = ?, updated_at = ?{assignments} WHERE id = ?",
+        (json.dumps(data, default=str), self.format_time(), *[fields[column] for column in columns], job_id)
+      )
+
+  def get_job(self, job_id):
+    with self.connection() as conn:
+      row = conn.execute("SELECT * FROM ingestion_jobs WHERE id = ?", (job_id,)).fetchone()
+    return self.job_info(row) if row else None
+
+  def get_unfinished_jobs(self):
+    with self.connection() as conn:
+      rows = conn.execute("SELECT * FROM ingestion_jobs WHERE status IN ('queued', 'running')").fetchall()
+    return [self.job_info(row) for row in rows]
+
+  def claim_job(self, job_id, expected_owner, new_owner):
+    with self.transaction() as conn:
+      return conn.execute(
+        "UPDATE ingestion_jobs SET owner = ?, updated_at = ? WHERE id = ? AND owner IS ?",
+        (new_owner, self.format_time(), job_id, expected_owner)
+      ).rowcount == 1
+
+  def get_latest_jobs(self, file_ids):
+    if not file_ids:
+      return {}
+
+    jobs = []
+    with self.connection() as conn:
+      # SQLite allows at most 999 parameters per statement on older builds
+      for start in range(0, len(file_ids), 900):
+        batch = file_ids[start:start + 900]
+        rows = conn.execute(f"SELECT * FROM ingestion_jobs WHERE file_id IN ({', '.join('?' * len(batch))})", batch).fetchall()
+        jobs.extend(self.job_info(row) for row in rows)
+
+    return latest_by_created_at(jobs)
+
+  def stats(self):
+    return {**super().stats(), "path": self.path, "pool_size": self.pool_size}
+
+
+def create_storage(backend: str) -> StorageBackend:
+  if backend == "sqlite":
+    return SQLiteStorageBackend(path=config.SQLITE_PATH, pool_size=config.SQLITE_POOL_SIZE)
+
+  if backend == "firestore":
+    return FirestoreStorageBackend(credentials_path=config.FIREBASE_CREDENTIALS_PATH)
+
+  raise ValueError(f"Unknown storage backend: {backend}, expected firestore or sqlite")
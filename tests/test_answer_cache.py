@@ -0,0 +1,44 @@
+"""
+Semantic answer cache:
+Entries of other corpus versions are purged once when the corpus version changes, lookups in between leave the cache alone,
+and answers finished after the version changed are not stored.
+
+python -m pytest tests
+"""
+import sys
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from answer_cache import SemanticAnswerCache
+
+
+def store(cache: SemanticAnswerCache, corpus_version: int, embedding: list, answer: str):
+  cache.store(("model", None, corpus_version), embedding, answer, [], 100.0)
+
+def test_stale_entries_are_purged_once_per_corpus_version(monkeypatch):
+  cache = SemanticAnswerCache(max_entries=100, threshold=0.9)
+  cache.purge_stale(1)
+  store(cache, 1, [1.0, 0.0], "first")
+  store(cache, 1, [0.0, 1.0], "second")
+
+  # Lookups against the same version do not walk the scopes
+  removed = []
+  remove = cache._remove
+  monkeypatch.setattr(cache, "_remove", lambda entry_id: removed.append(entry_id) or remove(entry_id))
+  for _ in range(5):
+    cache.purge_stale(1)
+    assert cache.lookup(("model", None, 1), [1.0, 0.1])["answer"] == "first"
+  assert removed == []
+
+  cache.purge_stale(2)
+  assert len(removed) == 2
+  assert cache.stats()["entries"] == 0
+  assert cache.lookup(("model", None, 1), [1.0, 0.1]) is None
+
+  # A request that read version 1 before the upload finishes after it, its answer is not kept
+  store(cache, 1, [1.0, 0.0], "late")
+  store(cache, 2, [1.0, 0.0], "current")
+  assert cache.stats()["entries"] == 1
+  assert cache.lookup(("model", None, 2), [1.0, 0.1])["answer"] == "current"
@@ -0,0 +1,194 @@
+"""
+BM25 index:
+Changes saved by one BM25Index reach another one sharing the directory through the change log, snapshots and
+log compaction lose nothing a concurrent writer appends, and scores match BM25 computed by brute force.
+
+python -m pytest tests
+"""
+from langchain_core.documents import Document
+from collections import Counter
+import numpy as np
+import threading
+import random
+import math
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import bm25_index
+from bm25_index import BM25Index, tokenize
+
+VOCABULARY = [f"term{i}" for i in range(300)] + ["invoice", "refund", "ERR-4021"]
+
+
+def make_chunk(chunk_id: str, file_id: str, text: str) -> Document:
+  return Document(id=chunk_id, page_content=text, metadata={"file_id": file_id})
+
+def make_chunks(count: int, files: int, seed: int = 0) -> list:
+  rng = random.Random(seed)
+  # Zipf-like term frequencies so some terms are common and most are rare
+  weights = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+  return [
+    make_chunk(f"chunk{i}", f"file{i % files}", " ".join(rng.choices(VOCABULARY, weights, k=rng.randint(20, 120))))
+    for i in range(count)
+  ]
+
+def index_path(tmp_path) -> str:
+  return str(tmp_path / "bm25_index.pkl")
+
+def ids(results) -> set:
+  return {chunk_id for chunk_id, _ in results}
+
+def test_changes_saved_by_one_index_are_replayed_by_another(tmp_path):
+  writer = BM25Index(index_path(tmp_path))
+  reader = BM25Index(index_path(tmp_path))
+  assert not reader.load()
+
+  writer.add([
+    make_chunk("a1", "fileA", "refund policy for annual plans"),
+    make_chunk("a2", "fileA", "invoice ERR-4021 explained"),
+    make_chunk("b1", "fileB", "refund requests take five days")
+  ])
+  writer.save()
+
+  assert reader.load()
+  assert ids(reader.search("refund", 10)) == {"a1", "b1"}
+  assert ids(reader.search("4021", 10)) == {"a2"}
+
+  # Only the records appended since the last read are replayed
+  offset = reader.stats()["log_bytes"]
+  writer.remove(["a1"])
+  writer.add([make_chunk("b2", "fileB", "refund for a duplicate invoice")])
+  writer.save()
+  reader.reload_if_changed()
+
+  assert reader.stats()["log_bytes"] > offset
+  assert ids(reader.search("refund", 10)) == {"b1", "b2"}
+
+  writer.remove_files(["fileB"])
+  writer.save()
+  reader.reload_if_changed()
+
+  assert ids(reader.search("refund", 10)) == set()
+  assert ids(reader.search("invoice", 10)) == {"a2"}
+  assert len(reader) == len(writer) == 1
+
+  # A new index loading from scratch sees the same state
+  fresh = BM25Index(index_path(tmp_path))
+  assert fresh.load()
+  assert fresh.search("invoice", 10) == reader.search("invoice", 10)
+
+def test_unsaved_changes_stay_on_top_of_replayed_ones(tmp_path):
+  first = BM25Index(index_path(tmp_path))
+  second = BM25Index(index_path(tmp_path))
+
+  first.add([make_chunk("a1", "fileA", "refund policy")])
+  first.save()
+
+  second.load()
+  second.add([make_chunk("b1", "fileB", "refund window")])
+  first.remove(["a1"])
+  first.save()
+
+  # Saving takes the writer lock and replays what first appended before adding its own records
+  second.save()
+  assert ids(second.search("refund", 10)) == {"b1"}
+
+  first.reload_if_changed()
+  assert ids(first.search("refund", 10)) == {"b1"}
+
+def test_snapshots_and_log_compaction_keep_changes_of_a_concurrent_writer(tmp_path, monkeypatch):
+  # Every save folds the log into a new snapshot generation
+  monkeypatch.setattr(bm25_index, "COMPACT_LOG_MIN_BYTES", 0)
+  monkeypatch.setattr(bm25_index, "COMPACT_LOG_RATIO", 0)
+
+  writers = {"a": BM25Index(index_path(tmp_path)), "b": BM25Index(index_path(tmp_path))}
+  for writer in writers.values():
+    writer.load()
+
+  errors = []
+  def append(name: str):
+    try:
+      writer = writers[name]
+      for i in range(60):
+        writer.add([make_chunk(f"{name}{i}", f"file{name}", f"shared words and unique{name}{i}")])
+        if i % 3 == 0:
+          writer.remove([f"{name}{i - 1}"])
+        writer.save()
+    except Exception as e:
+      errors.append(e)
+
+  threads = [threading.Thread(target=append, args=(name,)) for name in writers]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert not errors
+
+  expected = {f"{name}{i}" for name in writers for i in range(60)} - {f"{name}{i - 1}" for name in writers for i in range(0, 60, 3)}
+
+  fresh = BM25Index(index_path(tmp_path))
+  assert fresh.load()
+  assert fresh.stats()["log_bytes"] == 0
+  assert ids(fresh.search("shared", 1000)) == expected
+
+  for writer in writers.values():
+    writer.reload_if_changed()
+    assert ids(writer.search("shared", 1000)) == expected
+
+  # Old generations of the log are removed once their snapshot is replaced
+  assert [name for name in os.listdir(tmp_path) if name.endswith(".log")] == []
+
+
+# BM25 over the live chunks, the way the index defines it
+def brute_force_scores(chunks: list, query: str, file_ids, k1: float = 1.5, b: float = 0.75) -> dict:
+  counts = {chunk.id: Counter(tokenize(chunk.page_content)) for chunk in chunks}
+  lengths = {chunk_id: sum(chunk_counts.values()) for chunk_id, chunk_counts in counts.items()}
+  avg_length = sum(lengths.values()) / len(lengths)
+
+  scores = {}
+  for chunk in chunks:
+    if file_ids is not None and chunk.metadata["file_id"] not in file_ids:
+      continue
+
+    score = 0.0
+    for term in set(tokenize(query)):
+      frequency = counts[chunk.id][term]
+      if not frequency:
+        continue
+      document_frequency = sum(1 for chunk_counts in counts.values() if chunk_counts[term])
+      idf = math.log(1 + (len(chunks) - document_frequency + 0.5) / (document_frequency + 0.5))
+      score += idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * lengths[chunk.id] / avg_length))
+
+    if score > 0:
+      scores[chunk.id] = score
+
+  return scores
+
+@pytest.mark.parametrize("file_ids", [None, ["file3"], ["file1", "file4"], [f"file{i}" for i in range(12)]])
+@pytest.mark.parametrize("query", ["term0 term1", "term0 term40 term250", "refund ERR-4021", "term7"])
+def test_scoped_search_matches_brute_force_scoring(tmp_path, query, file_ids):
+  chunks = make_chunks(2000, 20)
+  index = BM25Index(index_path(tmp_path))
+  index.add(chunks)
+
+  # Removed chunks stay in the postings until compaction, they must be neither scored nor counted in document frequencies
+  removed = {chunk.id for chunk in chunks[::7]}
+  index.remove(removed)
+  assert index.stats()["dead_rows"] == len(removed)
+  chunks = [chunk for chunk in chunks if chunk.id not in removed]
+
+  expected = brute_force_scores(chunks, query, file_ids)
+  top_expected = sorted(expected.values(), reverse=True)[:20]
+  results = index.search(query, 20, file_ids=file_ids)
+
+  assert len(results) == len(top_expected)
+  np.testing.assert_allclose([score for _, score in results], top_expected, rtol=1e-4)
+  for chunk_id, score in results:
+    assert score == pytest.approx(expected[chunk_id], rel=1e-4)
+
+  index.compact()
+  np.testing.assert_allclose([score for _, score in index.search(query, 20, file_ids=file_ids)], top_expected, rtol=1e-4)
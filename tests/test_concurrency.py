@@ -0,0 +1,138 @@
+"""
+Concurrency of /chat:
+The app runs in process with a fake llm, fake embeddings over an empty Chroma store and fake chat log storage
+that only wait a simulated latency.
+Overlapping requests must wait on those latencies together,
+so REQUESTS of them finish in about the time of one instead of REQUESTS times as long.
+
+python -m pytest tests
+"""
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.embeddings import Embeddings
+from unittest import mock
+import asyncio
+import time
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+REQUESTS = 8
+LLM_LATENCY = 0.5
+EMBEDDING_LATENCY = 0.05
+STORAGE_LATENCY = 0.05
+
+# Overlapping requests may take this many times one request, run one after the other they take REQUESTS times
+MAX_SLOWDOWN = 2.0
+
+
+# Stands in for ChatGroq and ChatOpenAI, the blocking call sleeps so a sync call on the event loop shows up
+class FakeChatModel(BaseChatModel):
+  latency: float = LLM_LATENCY
+
+  @property
+  def _llm_type(self) -> str:
+    return "fake-chat"
+
+  def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+    time.sleep(self.latency)
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content="fake answer"))])
+
+  async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+    await asyncio.sleep(self.latency)
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content="fake answer"))])
+
+# Stands in for OpenAIEmbeddings, vectors are derived from the text so no request leaves the process
+class FakeEmbeddings(Embeddings):
+  def __init__(self, **kwargs):
+    self.model = "fake-embedding"
+
+  def embed(self, text: str) -> list:
+    return [float(ord(char)) for char in text[:8].ljust(8)]
+
+  def embed_documents(self, texts):
+    time.sleep(EMBEDDING_LATENCY)
+    return [self.embed(text) for text in texts]
+
+  def embed_query(self, text):
+    time.sleep(EMBEDDING_LATENCY)
+    return self.embed(text)
+
+  async def aembed_documents(self, texts):
+    await asyncio.sleep(EMBEDDING_LATENCY)
+    return [self.embed(text) for text in texts]
+
+  async def aembed_query(self, text):
+    await asyncio.sleep(EMBEDDING_LATENCY)
+    return self.embed(text)
+
+async def fake_aget_chat_history(session_id):
+  await asyncio.sleep(STORAGE_LATENCY)
+  return []
+
+async def fake_ainsert_chat_logs(session_id, user_query, llm_response, model):
+  await asyncio.sleep(STORAGE_LATENCY)
+
+
+# Fake the Firebase clients, the llm classes and the embeddings before the app modules build them, then swap in the stand-ins
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+  import firebase_admin
+  import langchain_groq
+  import langchain_openai
+  from firebase_admin import credentials, firestore, firestore_async
+
+  with pytest.MonkeyPatch.context() as patch:
+    patch.setenv("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY", "test"))
+    patch.setenv("GROQ_API_KEY", os.getenv("GROQ_API_KEY", "test"))
+    patch.setenv("LANGCHAIN_TRACING_V2", "false")
+    patch.setattr(credentials, "Certificate", mock.MagicMock())
+    patch.setattr(firebase_admin, "initialize_app", mock.MagicMock())
+    patch.setattr(firestore, "client", mock.MagicMock())
+    patch.setattr(firestore_async, "client", mock.MagicMock())
+    patch.setattr(langchain_groq, "ChatGroq", FakeChatModel)
+    patch.setattr(langchain_openai, "ChatOpenAI", FakeChatModel)
+    patch.setattr(langchain_openai, "OpenAIEmbeddings", FakeEmbeddings)
+
+    # Chroma lives under the working directory
+    patch.chdir(tmp_path_factory.mktemp("concurrency"))
+
+    import main
+    import backend
+
+    # main switches LangSmith tracing on when imported
+    patch.setenv("LANGSMITH_TRACING_V2", "false")
+
+    patch.setattr(backend, "aget_chat_history", fake_aget_chat_history)
+    patch.setattr(backend, "ainsert_chat_logs", fake_ainsert_chat_logs)
+
+    yield main.app
+
+def test_overlapping_chat_requests_finish_in_about_the_time_of_one(app):
+  import httpx
+
+  async def run():
+    async with app.router.lifespan_context(app):
+      async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=None) as client:
+        async def chat(question: str) -> float:
+          start = time.perf_counter()
+          response = await client.post("/chatbot/chat", json={"question": question})
+          assert response.status_code == 200, response.text
+          assert response.json()["answer"]
+          return time.perf_counter() - start
+
+        await chat("warm up the app")
+        single = await chat("how long does a single request take")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(chat(f"overlapping question number {i}") for i in range(REQUESTS)))
+        return single, time.perf_counter() - start
+
+  single, overlapped = asyncio.run(run())
+
+  assert single >= LLM_LATENCY
+  assert overlapped < single * MAX_SLOWDOWN, f"{REQUESTS} overlapping requests took {overlapped:.2f}s, one took {single:.2f}s"
@@ -0,0 +1,82 @@
+"""
+History compaction:
+The prompt history is the summary followed by the window of recent turns and must stay within HISTORY_TOKEN_BUDGET,
+however long the session, the stored summary or the turns still waiting to be summarized get.
+
+python -m pytest tests
+"""
+import asyncio
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import config
+import history_utils
+from token_utils import count_message_tokens
+
+
+def make_turns(turns: int, words: int) -> list:
+  messages = []
+  for turn in range(turns):
+    messages.append({"role": "human", "content": f"question {turn} " + "word " * words})
+    messages.append({"role": "ai", "content": f"answer {turn} " + "word " * words})
+  return messages
+
+def compact(monkeypatch, messages: list, summary: str, summarized_messages: int):
+  async def fake_get_session_summary(session_id):
+    return {"summary": summary, "summarized_messages": summarized_messages}
+
+  monkeypatch.setattr(history_utils, "get_session_summary", fake_get_session_summary)
+  return asyncio.run(history_utils.compact_chat_history("session", messages))
+
+def test_compacted_history_is_the_summary_and_the_window(monkeypatch):
+  messages = make_turns(20, 20)
+  compacted, compaction = compact(monkeypatch, messages, "the user asked about invoices", 10)
+
+  assert compacted[0]["role"] == "system"
+  assert "the user asked about invoices" in compacted[0]["content"]
+  assert compacted[1:] == messages[compaction["window_start"]:]
+  assert len(compacted) - 1 <= config.HISTORY_MAX_TURNS * 2
+  assert compaction["pending"] == messages[10:compaction["window_start"]]
+
+@pytest.mark.parametrize("summary_words", [0, 50, 5000])
+@pytest.mark.parametrize("turn_words", [5, 200, 3000])
+def test_compacted_history_stays_within_the_token_budget(monkeypatch, summary_words, turn_words):
+  messages = make_turns(50, turn_words)
+  compacted, compaction = compact(monkeypatch, messages, "summary " * summary_words, 0)
+
+  assert count_message_tokens(compacted) <= config.HISTORY_TOKEN_BUDGET
+  assert compaction["history_tokens_after"] == count_message_tokens(compacted)
+
+def test_pending_turns_beyond_one_summary_call_are_dropped_oldest_first(monkeypatch):
+  # A session whose summary updates kept failing, nothing is summarized yet
+  messages = make_turns(200, 50)
+  compacted, compaction = compact(monkeypatch, messages, "", 0)
+
+  assert count_message_tokens(compaction["pending"]) <= config.HISTORY_TOKEN_BUDGET
+  assert compaction["pending"] == messages[compaction["window_start"] - len(compaction["pending"]):compaction["window_start"]]
+  assert compacted == messages[compaction["window_start"]:]
+
+def test_summary_update_covers_every_message_before_the_window(monkeypatch):
+  messages = make_turns(200, 50)
+  compacted, compaction = compact(monkeypatch, messages, "", 0)
+  stored = {}
+
+  class FakeSummaryChain:
+    async def ainvoke(self, inputs):
+      return f"summary of {len(inputs['new_lines'])} characters"
+
+  async def fake_aupsert_session_summary(session_id, summary, summarized_messages):
+    stored.update(summary=summary, summarized_messages=summarized_messages)
+    return True
+
+  monkeypatch.setattr(history_utils, "get_summary_chain", lambda model: FakeSummaryChain())
+  monkeypatch.setattr(history_utils, "aupsert_session_summary", fake_aupsert_session_summary)
+  asyncio.run(history_utils.update_session_summary("session", "model", compaction))
+
+  assert stored["summary"].startswith("summary of")
+  assert stored["summarized_messages"] == compaction["window_start"]
+  history_utils.summary_cache.delete("session")
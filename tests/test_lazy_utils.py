@@ -0,0 +1,73 @@
+"""
+Lazy initialisation:
+A LazySingleton is built on first use only, and warmup steps that failed are run again by retry_failed_components,
+at most once every retry interval, so the components they record become ready once the failing service is back.
+
+python -m pytest tests
+"""
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import lazy_utils
+from lazy_utils import LazySingleton, component_status, retry_failed_components, warmup_components
+
+
+# Components recorded by a test are dropped afterwards so /health/ready of the app under test never sees them
+@pytest.fixture(autouse=True)
+def drop_test_components():
+  yield
+  for name in [name for name in component_status if name.startswith("test_lazy_")]:
+    del component_status[name]
+
+# Fails the first `failures` calls, like a service that is down at startup
+class FlakyFactory:
+  def __init__(self, failures: int):
+    self.failures = failures
+    self.calls = 0
+
+  def __call__(self):
+    self.calls += 1
+    if self.calls <= self.failures:
+      raise ConnectionError("service unavailable")
+    return {"calls": self.calls}
+
+def test_singleton_is_built_on_first_use_only():
+  factory = FlakyFactory(failures=0)
+  singleton = LazySingleton("test_lazy_first_use", factory)
+
+  assert singleton.built() is None
+  assert component_status["test_lazy_first_use"]["status"] == "pending"
+
+  assert singleton.get() is singleton.get()
+  assert singleton.built() == {"calls": 1}
+  assert component_status["test_lazy_first_use"]["status"] == "ready"
+
+def test_failed_steps_are_retried_at_most_once_per_interval(monkeypatch):
+  monkeypatch.setattr(lazy_utils, "last_retry", {"at": None})
+  singleton_factory = FlakyFactory(failures=2)
+  step_factory = FlakyFactory(failures=1)
+  steps = {
+    "test_lazy_singleton_step": LazySingleton("test_lazy_singleton_step", singleton_factory),
+    "test_lazy_function_step": step_factory,
+    "test_lazy_healthy_step": lambda: None
+  }
+
+  warmup_components(steps)
+  assert [component_status[name]["status"] for name in steps] == ["failed", "failed", "ready"]
+
+  # The function step recovers, the singleton fails once more, the healthy step is not run again
+  retry_failed_components(steps, retry_seconds=3600)
+  assert [component_status[name]["status"] for name in steps] == ["failed", "ready", "ready"]
+  assert (singleton_factory.calls, step_factory.calls) == (2, 2)
+
+  # Within the retry interval nothing runs
+  retry_failed_components(steps, retry_seconds=3600)
+  assert singleton_factory.calls == 2
+
+  retry_failed_components(steps, retry_seconds=0)
+  assert component_status["test_lazy_singleton_step"]["status"] == "ready"
+  assert singleton_factory.calls == 3
@@ -0,0 +1,189 @@
+"""
+Write-behind chat logs:
+ChatLogWriter flushes once flush_size entries are queued or every flush_interval seconds, keeps every session in order,
+spills entries it cannot write to a file replayed by the next writer, and flushes what is left on close.
+A history read from the database merges the entries of the session still waiting in the writer.
+
+python -m pytest tests
+"""
+from datetime import datetime, timedelta, timezone
+import threading
+import time
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from log_writer import ChatLogWriter
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def make_entry(session_id: str, turn: int) -> dict:
+  return {
+    "session_id": session_id,
+    "user_query": f"question {turn}",
+    "llm_response": f"answer {turn}",
+    "model": "fake",
+    "created_at": START + timedelta(seconds=turn)
+  }
+
+# Records every batch, failing the calls listed in fail_calls
+class FakeStorage:
+  def __init__(self, fail_calls=()):
+    self.batches = []
+    self.calls = 0
+    self.fail_calls = set(fail_calls)
+    self.written = threading.Event()
+
+  def write_batch(self, entries):
+    self.calls += 1
+    if self.calls in self.fail_calls:
+      raise ConnectionError("storage unavailable")
+
+    self.batches.append(list(entries))
+    self.written.set()
+
+  @property
+  def entries(self):
+    return [entry for batch in self.batches for entry in batch]
+
+@pytest.fixture
+def spill_path(tmp_path):
+  return str(tmp_path / "chat_log_spill.jsonl")
+
+def test_flushes_once_flush_size_entries_are_queued(spill_path):
+  storage = FakeStorage()
+  writer = ChatLogWriter(storage.write_batch, flush_size=3, flush_interval=60, spill_path=spill_path)
+
+  writer.enqueue(make_entry("a", 0))
+  writer.enqueue(make_entry("a", 1))
+  assert not storage.written.wait(0.3)
+
+  writer.enqueue(make_entry("a", 2))
+  assert storage.written.wait(5)
+  assert [len(batch) for batch in storage.batches] == [3]
+
+  writer.close()
+
+def test_flushes_every_flush_interval(spill_path):
+  storage = FakeStorage()
+  writer = ChatLogWriter(storage.write_batch, flush_size=100, flush_interval=0.2, spill_path=spill_path)
+
+  start = time.perf_counter()
+  writer.enqueue(make_entry("a", 0))
+  assert storage.written.wait(5)
+  assert time.perf_counter() - start < 2
+  assert storage.entries == [make_entry("a", 0)]
+
+  writer.close()
+
+def test_sessions_keep_their_order_through_failed_flushes(spill_path):
+  # The second write fails, its entries go back to the front of the queue
+  storage = FakeStorage(fail_calls={2})
+  writer = ChatLogWriter(storage.write_batch, flush_size=1000, flush_interval=60, spill_path=spill_path)
+
+  for turn in range(30):
+    writer.enqueue(make_entry(f"session{turn % 3}", turn))
+    if turn % 7 == 6:
+      writer.flush()
+
+  writer.close()
+
+  assert len(storage.entries) == 30
+  for session in ("session0", "session1", "session2"):
+    turns = [entry["user_query"] for entry in storage.entries if entry["session_id"] == session]
+    assert turns == [f"question {turn}" for turn in range(30) if f"session{turn % 3}" == session]
+
+def test_failed_writes_spill_to_file_and_are_replayed_on_startup(spill_path):
+  storage = FakeStorage(fail_calls=range(1, 100))
+  writer = ChatLogWriter(storage.write_batch, flush_size=1000, flush_interval=60, durability="spill", spill_path=spill_path)
+
+  for turn in range(5):
+    writer.enqueue(make_entry("a", turn))
+  writer.flush()
+  writer.enqueue(make_entry("a", 5))
+  writer.close()
+
+  assert storage.entries == []
+  assert writer.stats()["entries_spilled"] == 6
+  with open(spill_path) as f:
+    assert len(f.readlines()) == 6
+
+  # The next process writes the spilled entries before anything it queues itself
+  storage = FakeStorage()
+  writer = ChatLogWriter(storage.write_batch, flush_size=1000, flush_interval=60, durability="spill", spill_path=spill_path)
+  writer.enqueue(make_entry("a", 6))
+  writer.flush()
+
+  assert storage.entries == [make_entry("a", turn) for turn in range(7)]
+  assert not os.path.exists(spill_path)
+
+  writer.close()
+
+def test_close_flushes_queued_entries(spill_path):
+  storage = FakeStorage()
+  writer = ChatLogWriter(storage.write_batch, flush_size=1000, flush_interval=60, spill_path=spill_path)
+
+  writer.enqueue(make_entry("a", 0))
+  writer.enqueue(make_entry("b", 1))
+  writer.close()
+
+  assert storage.entries == [make_entry("a", 0), make_entry("b", 1)]
+  assert not os.path.exists(spill_path)
+
+def test_pending_entries_include_queued_and_in_flight_entries(spill_path):
+  release = threading.Event()
+  writing = threading.Event()
+
+  def slow_write_batch(entries):
+    writing.set()
+    release.wait(5)
+
+  writer = ChatLogWriter(slow_write_batch, flush_size=1000, flush_interval=60, spill_path=spill_path)
+  writer.enqueue(make_entry("a", 0))
+  writer.enqueue(make_entry("b", 1))
+
+  flush = threading.Thread(target=writer.flush)
+  flush.start()
+  assert writing.wait(5)
+  writer.enqueue(make_entry("a", 2))
+
+  assert writer.pending_entries("a") == [make_entry("a", 0), make_entry("a", 2)]
+  assert writer.pending_entries("b") == [make_entry("b", 1)]
+
+  release.set()
+  flush.join()
+  assert writer.pending_entries("a") == [make_entry("a", 2)]
+
+  writer.close()
+
+def test_history_read_merges_entries_still_queued(spill_path, monkeypatch):
+  import database
+
+  class StoredLogs:
+    def __init__(self, logs):
+      self.logs = logs
+
+    def get_chat_logs(self, session_id):
+      return [log for log in self.logs if log["session_id"] == session_id]
+
+    async def aget_chat_logs(self, session_id):
+      return self.get_chat_logs(session_id)
+
+  writer = ChatLogWriter(lambda entries: None, flush_size=1000, flush_interval=60, spill_path=spill_path)
+  # Turn 2 is queued and was also flushed while the history was read, it is kept once
+  for turn in (2, 3):
+    writer.enqueue(make_entry("merge-session", turn))
+
+  monkeypatch.setattr(database, "chat_log_writer", writer)
+  monkeypatch.setattr(database, "storage", StoredLogs([make_entry("merge-session", turn) for turn in range(3)]))
+  database.session_cache.delete("merge-session")
+
+  messages = database.get_chat_history("merge-session")
+  assert [message["content"] for message in messages if message["role"] == "human"] == [f"question {turn}" for turn in range(4)]
+
+  database.session_cache.delete("merge-session")
+  writer.close()
@@ -0,0 +1,151 @@
+"""
+SQLite storage:
+SQLiteStorageBackend creates its schema in a fresh file, returns chat logs in created_at order, keeps session summaries,
+ingestion jobs and document records, and its document listing pages through DocumentIndexCache with cursors.
+
+python -m pytest tests
+"""
+from datetime import datetime, timedelta, timezone
+import sqlite3
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from storage_utils import SQLiteStorageBackend, StorageBackend, create_storage
+from document_index import DocumentIndexCache, InvalidCursor
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def storage(tmp_path):
+  return SQLiteStorageBackend(path=str(tmp_path / "data" / "storage.db"), pool_size=2)
+
+def make_log(session_id: str, turn: int, created_at: datetime) -> dict:
+  return {
+    "session_id": session_id,
+    "user_query": f"question {turn}",
+    "llm_response": f"answer {turn}",
+    "model": "fake",
+    "created_at": created_at
+  }
+
+def test_schema_is_created_in_a_new_file(storage):
+  assert os.path.exists(storage.path)
+
+  conn = sqlite3.connect(storage.path)
+  tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+  journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+  conn.close()
+
+  assert {"chat_logs", "session_summaries", "documents", "ingestion_jobs"} <= tables
+  assert journal_mode == "wal"
+
+  # Opening the same file again keeps what is stored
+  storage.add_chat_logs([make_log("a", 0, START)])
+  assert len(SQLiteStorageBackend(path=storage.path, pool_size=1).get_chat_logs("a")) == 1
+
+def test_chat_logs_are_returned_in_created_at_order(storage):
+  # Written out of order, in two batches, with a naive timestamp read as UTC
+  storage.add_chat_logs([make_log("a", 2, START + timedelta(seconds=2)), make_log("b", 0, START)])
+  storage.add_chat_logs([
+    make_log("a", 0, START.replace(tzinfo=None)),
+    make_log("a", 1, (START + timedelta(seconds=1)).astimezone(timezone(timedelta(hours=5))))
+  ])
+
+  logs = storage.get_chat_logs("a")
+  assert [log["user_query"] for log in logs] == ["question 0", "question 1", "question 2"]
+  assert [log["created_at"] for log in logs] == [START + timedelta(seconds=turn) for turn in range(3)]
+  assert logs[0]["time_to_first_token_ms"] is None
+  assert storage.get_chat_logs("missing") == []
+
+def test_session_summaries(storage):
+  assert storage.get_session_summary("a") is None
+
+  storage.set_session_summary("a", "first summary", 4)
+  storage.set_session_summary("a", "second summary", 10)
+
+  summary = storage.get_session_summary("a")
+  assert (summary["summary"], summary["summarized_messages"]) == ("second summary", 10)
+  assert summary["updated_at"].tzinfo is not None
+
+def test_jobs(storage):
+  first = storage.insert_job({"file_id": "file1", "status": "queued", "owner": "worker1", "filename": "a.pdf"})
+  second = storage.insert_job({"file_id": "file1", "status": "queued", "owner": "worker1", "filename": "a.pdf"})
+  other = storage.insert_job({"file_id": "file2", "status": "queued", "filename": "b.pdf"})
+
+  storage.update_job(first, {"status": "failed", "error": "parse error"})
+  job = storage.get_job(first)
+  assert (job["status"], job["error"], job["filename"], job["owner"]) == ("failed", "parse error", "a.pdf", "worker1")
+  assert storage.get_job("missing") is None
+  with pytest.raises(KeyError):
+    storage.update_job("missing", {"status": "done"})
+
+  assert {job["id"] for job in storage.get_unfinished_jobs()} == {second, other}
+
+  # Only the caller that still sees the expected owner takes the job
+  assert storage.claim_job(second, "worker1", "worker2")
+  assert not storage.claim_job(second, "worker1", "worker3")
+  assert storage.claim_job(other, None, "worker2")
+  assert storage.get_job(second)["owner"] == "worker2"
+
+  latest = storage.get_latest_jobs(["file1", "file2", "file3"])
+  assert {file_id: job["id"] for file_id, job in latest.items()} == {"file1": second, "file2": other}
+  assert storage.get_latest_jobs([]) == {}
+
+def test_documents(storage):
+  file_id = storage.insert_document("report.pdf")
+  assert storage.get_document(file_id)["filename"] == "report.pdf"
+
+  storage.update_document(file_id, "report-v2.pdf")
+  assert storage.get_document(file_id)["filename"] == "report-v2.pdf"
+  assert set(storage.get_document_upload_dates()) == {file_id}
+  with pytest.raises(KeyError):
+    storage.update_document("missing", "missing.pdf")
+
+  storage.delete_documents([file_id, "missing"])
+  assert storage.get_document(file_id) is None
+  assert storage.list_documents() == []
+
+def test_document_listing_pages_with_cursors(storage):
+  file_ids = [storage.insert_document(f"file{i}.pdf") for i in range(23)]
+  index = DocumentIndexCache(load=storage.list_documents, ttl_seconds=60)
+
+  listing = [doc["id"] for doc in storage.list_documents()]
+  assert listing == [doc["id"] for doc in sorted(storage.list_documents(), key=DocumentIndexCache.sort_key)]
+  assert set(listing) == set(file_ids)
+
+  pages = []
+  cursor = None
+  while True:
+    docs, cursor, _ = index.page(5, cursor)
+    pages.append([doc["id"] for doc in docs])
+    if cursor is None:
+      break
+
+  assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+  assert [file_id for page in pages for file_id in page] == listing
+
+  # A listing reloaded with the same content keeps its ETags
+  first_etag = index.page(5)[2]
+  index.invalidate()
+  assert index.page(5)[2] == first_etag
+
+  # A page still starts after the last document seen when that document was deleted in between
+  docs, cursor, _ = index.page(5)
+  storage.delete_documents([docs[-1]["id"]])
+  index.invalidate()
+  assert [doc["id"] for doc in index.page(5, cursor)[0]] == listing[5:10]
+
+  with pytest.raises(InvalidCursor):
+    index.page(5, "not a cursor")
+
+def test_backends_are_abstract_and_unknown_backends_are_rejected():
+  with pytest.raises(TypeError):
+    StorageBackend()
+
+  with pytest.raises(ValueError):
+    create_storage("postgres")
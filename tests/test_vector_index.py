@@ -0,0 +1,134 @@
+"""
+Memory-mapped vector index:
+An index written by one MmapVectorIndex reopens with the same rows, adds, removals and compaction keep search right,
+and int8, float16 and IVF search find nearly the same neighbours as exact float32 search.
+
+python -m pytest tests
+"""
+import numpy as np
+import sys
+import os
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from vector_index import MmapVectorIndex
+
+DIMENSIONS = 64
+
+
+# Rows cluster around topics, the way chunks of the same documents do
+def make_embeddings(count: int, dimensions: int = DIMENSIONS, clusters: int = 40, seed: int = 0) -> np.ndarray:
+  rng = np.random.default_rng(seed)
+  centres = rng.normal(size=(clusters, dimensions)).astype(np.float32)
+  embeddings = centres[rng.integers(0, clusters, count)] + 0.6 * rng.normal(size=(count, dimensions)).astype(np.float32)
+  return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def make_queries(embeddings: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+  rng = np.random.default_rng(seed)
+  queries = embeddings[rng.integers(0, len(embeddings), count)] + 0.3 * rng.normal(size=(count, embeddings.shape[1])).astype(np.float32) / np.sqrt(embeddings.shape[1])
+  return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def chunk_ids(count: int, prefix: str = "chunk") -> list:
+  return [f"{prefix}{i}" for i in range(count)]
+
+def metadatas(count: int, files: int = 10) -> list:
+  return [{"file_id": f"file{i % files}", "page": i % 7, "start_index": i * 100} for i in range(count)]
+
+def build(directory, embeddings: np.ndarray, **options) -> MmapVectorIndex:
+  index = MmapVectorIndex(str(directory), **options)
+  index.add(chunk_ids(len(embeddings)), embeddings, metadatas(len(embeddings)))
+  return index
+
+def exact_top(embeddings: np.ndarray, query: np.ndarray, k: int, rows=None) -> list:
+  rows = np.arange(len(embeddings)) if rows is None else np.asarray(rows)
+  scores = embeddings[rows] @ query
+  return [f"chunk{row}" for row in rows[np.argsort(-scores)[:k]]]
+
+def recall(index: MmapVectorIndex, embeddings: np.ndarray, queries: np.ndarray, k: int) -> float:
+  found = [len(set(exact_top(embeddings, query, k)) & {chunk_id for chunk_id, _ in index.search(query, k)}) / k for query in queries]
+  return float(np.mean(found))
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_index_reopens_with_the_same_rows(tmp_path, dtype):
+  embeddings = make_embeddings(500)
+  index = build(tmp_path, embeddings, dtype=dtype)
+  index.maintain(corpus_version=3)
+
+  reopened = MmapVectorIndex(str(tmp_path), dtype=dtype)
+  assert reopened.load()
+  assert len(reopened) == 500
+  assert reopened.matches_dtype()
+  assert reopened.manifest["corpus_version"] == 3
+  assert reopened.stats()["dimensions"] == DIMENSIONS
+
+  stored = np.array(reopened.get_embeddings(chunk_ids(500)))
+  np.testing.assert_allclose(stored, embeddings, atol=0.01)
+
+  for query in make_queries(embeddings, 10):
+    assert reopened.search(query, 5) == index.search(query, 5)
+
+  assert MmapVectorIndex(str(tmp_path), dtype="float16" if dtype == "int8" else "int8").load()
+  assert not MmapVectorIndex(str(tmp_path / "missing")).load()
+
+def test_adds_removals_and_compaction(tmp_path):
+  embeddings = make_embeddings(400)
+  index = build(tmp_path, embeddings)
+
+  # A chunk added again replaces its row
+  index.add(["chunk0"], embeddings[1:2], [{"file_id": "file0"}])
+  assert len(index) == 400
+  assert index.stats()["dead_rows"] == 1
+  assert {chunk_id for chunk_id, _ in index.search(embeddings[1], 2)} == {"chunk0", "chunk1"}
+
+  index.remove(["chunk2", "chunk3", "unknown"])
+  index.remove_files(["file9"])
+  removed = {"chunk2", "chunk3"} | {f"chunk{i}" for i in range(9, 400, 10)}
+  assert len(index) == 400 - len(removed)
+
+  for query in make_queries(embeddings, 20):
+    assert not {chunk_id for chunk_id, _ in index.search(query, 50)} & removed
+    assert not {chunk_id for chunk_id, _ in index.search(query, 50, file_ids=["file9"])}
+
+  # Another worker sees the removals through the manifest
+  reader = MmapVectorIndex(str(tmp_path))
+  reader.load()
+  assert len(reader) == len(index)
+
+  # Compaction rewrites the live rows to a new generation and drops the old files, results stay the same
+  index.remove(chunk_ids(100))
+  queries = make_queries(embeddings, 20)
+  before = [[chunk_id for chunk_id, _ in index.search(query, 10)] for query in queries]
+  generation = index.manifest["generation"]
+  index.maintain()
+
+  assert index.manifest["generation"] == generation + 1
+  assert index.stats()["rows"] == len(index) == 400 - len(removed | set(chunk_ids(100)))
+  assert not [name for name in os.listdir(tmp_path) if name.endswith(f".{generation}.bin")]
+
+  reader.reload_if_changed()
+  assert [[chunk_id for chunk_id, _ in reader.search(query, 10)] for query in queries] == before
+
+def test_scoped_search_is_exact_within_the_files(tmp_path):
+  embeddings = make_embeddings(1000)
+  index = build(tmp_path, embeddings, dtype="float16")
+  rows = [row for row in range(1000) if row % 10 in (2, 5)]
+
+  for query in make_queries(embeddings, 20):
+    assert [chunk_id for chunk_id, _ in index.search(query, 10, file_ids=["file2", "file5"])] == exact_top(embeddings, query, 10, rows)
+
+@pytest.mark.parametrize("dtype, ivf, min_recall", [
+  ("float16", False, 0.99),
+  ("int8", False, 0.95),
+  ("int8", True, 0.9)
+])
+def test_recall_against_exact_float32_search(tmp_path, dtype, ivf, min_recall):
+  embeddings = make_embeddings(4000)
+  index = build(tmp_path, embeddings, dtype=dtype, ivf=ivf)
+  index.maintain()
+
+  if ivf:
+    assert index.stats()["ivf_lists"] > 1
+
+  assert recall(index, embeddings, make_queries(embeddings, 100), 10) >= min_recall
@@ -0,0 +1,38 @@
+from functools import lru_cache
+from typing import List
+
+# Tokens added per chat message for role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+# tiktoken is an optional dependency, fall back to a character estimate when it or its encoding file is unavailable
+# The encoding file may be downloaded on first use, the app lifespan loads it in a warmup thread so no request blocks the event loop on it
+@lru_cache(maxsize=1)
+def get_encoding():
+  try:
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+  except Exception as e:
+    print(f"tiktoken unavailable, estimating token counts from characters: {e}")
+    return None
+
+def count_tokens(text: str) -> int:
+  encoding = get_encoding()
+
+  if encoding is None:
+    return (len(text) + 3) // 4
+
+  return len(encoding.encode(text, disallowed_special=()))
+
+# Count tokens of chat history messages in {"role", "content"} format
+def count_message_tokens(messages: List[dict]) -> int:
+  return sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+# Cut text to at most max_tokens tokens
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+  encoding = get_encoding()
+
+  if encoding is None:
+    return text[:max_tokens * 4]
+
+  return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
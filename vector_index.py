@@ -0,0 +1,451 @@
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import threading
+import json
+import os
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Rows converted to float32 at a time, small enough for the conversion buffer to stay in cache
+BLOCK_ROWS = 256
+
+# Rewrite the files once this share of rows has been removed
+COMPACT_DEAD_RATIO = 0.25
+
+# Rows per IVF list needed before partitioning pays off, and rows sampled per list to train it
+IVF_MIN_ROWS_PER_LIST = 39
+IVF_TRAIN_ROWS_PER_LIST = 256
+IVF_TRAIN_ITERATIONS = 10
+
+# Fixed width byte strings, chunk ids are sha256 hex digests
+ID_DTYPE = "S64"
+
+
+"""
+Memory-Mapped Vector Index:
+1. Embeddings are normalised and stored as rows of a float16 or int8 matrix in a flat file,
+   int8 rows keep a float32 scale so scores are scale * (row . query)
+2. Sidecar files hold the chunk id, file id, page and start_index of every row and whether it is still alive
+3. Files are memory-mapped read only, so every worker process shares the same pages of the OS page cache
+4. Exact search scores all rows, or the rows of the scoped files, in small blocks with numpy
+5. IVF mode partitions rows with spherical k-means and only scores the lists of the nearest centroids
+6. Writers append rows under a file lock and publish them by rewriting the manifest,
+   readers remap when the manifest changes. Removed rows are marked dead and dropped on compaction
+
+Chroma stays the document store, this index only answers which chunk ids are nearest
+"""
+
+class MmapVectorIndex:
+  SIDECARS = {
+    "ids": ID_DTYPE,
+    "files": ID_DTYPE,
+    "pages": np.int32,
+    "starts": np.int32,
+    "alive": np.uint8,
+    "lists": np.int32,
+    "scales": np.float32
+  }
+
+  def __init__(self, directory: str, dtype: str = "int8", ivf: bool = False, ivf_lists: int = 0, ivf_probe: int = 8):
+    if dtype not in ("int8", "float16"):
+      raise ValueError(f"Unsupported vector index dtype: {dtype}")
+
+    self.directory = directory
+    self.dtype = dtype
+    self.ivf = ivf
+    self.ivf_lists = ivf_lists
+    self.ivf_probe = ivf_probe
+
+    self.manifest_path = os.path.join(directory, "manifest.json")
+    self._lock = threading.RLock()
+    self._manifest_mtime = None
+    self._reset()
+
+  def _reset(self):
+    self.manifest = {"dimensions": 0, "dtype": self.dtype, "count": 0, "dead": 0, "generation": 0, "trained_count": 0, "corpus_version": None}
+    self._maps = {}
+    self._centroids = None
+    self._rows = None
+    self._file_rows = None
+    self._ivf_rows = None
+
+  def __len__(self):
+    return self.manifest["count"] - self.manifest["dead"]
+
+  def _path(self, name: str, generation: Optional[int] = None) -> str:
+    generation = self.manifest["generation"] if generation is None else generation
+    return os.path.join(self.directory, f"{name}.{generation}.bin")
+
+  def _row_dtype(self):
+    return np.dtype((np.int8 if self.manifest["dtype"] == "int8" else np.float16, (self.manifest["dimensions"],)))
+
+  def _file_dtypes(self) -> Dict[str, np.dtype]:
+    return {"vectors": self._row_dtype(), **{name: np.dtype(dtype) for name, dtype in self.SIDECARS.items()}}
+
+  # Map the files of the current manifest, rows past count belong to an unfinished write and are ignored
+  def _map_files(self, keep_rows: bool = False):
+    count = self.manifest["count"]
+    self._maps = {}
+
+    if count:
+      for name, dtype in self._file_dtypes().items():
+        self._maps[name] = np.memmap(self._path(name), dtype=dtype, mode="r", shape=(count,))
+
+    centroids_path = os.path.join(self.directory, f"centroids.{self.manifest['generation']}.npy")
+    self._centroids = np.load(centroids_path) if self.manifest["trained_count"] and os.path.exists(centroids_path) else None
+
+    # Lookups are rebuilt on first use, the chunk id lookup survives appends made by this process
+    if not keep_rows:
+      self._rows = None
+    self._file_rows = None
+    self._ivf_rows = None
+
+  # Returns False if there is no index on disk
+  def load(self) -> bool:
+    with self._lock:
+      try:
+        mtime = os.stat(self.manifest_path).st_mtime_ns
+        with open(self.manifest_path) as f:
+          manifest = json.load(f)
+      except FileNotFoundError:
+        return False
+
+      self._reset()
+      self.manifest = manifest
+      self._manifest_mtime = mtime
+      self._map_files()
+
+      return True
+
+  # Pick up rows written by another worker process
+  def reload_if_changed(self):
+    try:
+      mtime = os.stat(self.manifest_path).st_mtime_ns
+    except FileNotFoundError:
+      return
+
+    if mtime != self._manifest_mtime:
+      self.load()
+
+  def _write_manifest(self, keep_rows: bool = False):
+    temp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+      json.dump(self.manifest, f)
+    os.replace(temp_path, self.manifest_path)
+
+    self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+    self._map_files(keep_rows)
+
+  # One writer at a time across threads and worker processes, working on the latest manifest
+  @contextmanager
+  def _writing(self):
+    with self._lock:
+      os.makedirs(self.directory, exist_ok=True)
+
+      with open(os.path.join(self.directory, "lock"), "w") as lock_file:
+        if fcntl:
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+          self.reload_if_changed()
+          yield
+        finally:
+          if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  # An index written with another dtype has to be rebuilt
+  def matches_dtype(self) -> bool:
+    return self.manifest["dtype"] == self.dtype
+
+  def clear(self):
+    with self._writing():
+      old_generation = self.manifest["generation"]
+      self._reset()
+      self.manifest["generation"] = old_generation + 1
+      self._write_manifest()
+      self._remove_generation(old_generation)
+
+  def _remove_generation(self, generation: int):
+    paths = [self._path(name, generation) for name in self._file_dtypes()]
+    paths.append(os.path.join(self.directory, f"centroids.{generation}.npy"))
+
+    for path in paths:
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+  @staticmethod
+  def normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+  # Stored form of normalised float32 rows, returns the rows and their scales
+  def _quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if self.manifest["dtype"] == "float16":
+      return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+  def _nearest_lists(self, vectors: np.ndarray) -> np.ndarray:
+    if self._centroids is None:
+      return np.full(len(vectors), -1, dtype=np.int32)
+
+    return np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+
+  def _row_lookup(self) -> Dict[bytes, int]:
+    if self._rows is None:
+      ids = self._maps["ids"].tolist() if self.manifest["count"] else []
+      self._rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+
+    return self._rows
+
+  # Append chunks with their embeddings, a chunk id stored before is replaced
+  def add(self, chunk_ids: List[str], embeddings, metadatas: List[dict]):
+    if not len(chunk_ids):
+      return
+
+    vectors = self.normalise(np.asarray(embeddings, dtype=np.float32))
+
+    with self._writing():
+      if not self.manifest["dimensions"]:
+        self.manifest["dimensions"] = vectors.shape[1]
+      elif vectors.shape[1] != self.manifest["dimensions"]:
+        raise ValueError(f"Embeddings have {vectors.shape[1]} dimensions, the vector index has {self.manifest['dimensions']}")
+
+      keys = [chunk_id.encode() for chunk_id in chunk_ids]
+      self._mark_dead([self._row_lookup().get(key) for key in keys])
+
+      rows, scales = self._quantize(vectors)
+      columns = {
+        "vectors": rows,
+        "scales": scales,
+        "ids": np.array(keys, dtype=ID_DTYPE),
+        "files": np.array([str(metadata.get("file_id", "")).encode() for metadata in metadatas], dtype=ID_DTYPE),
+        "pages": np.array([metadata.get("page") or 0 for metadata in metadatas], dtype=np.int32),
+        "starts": np.array([metadata.get("start_index") or 0 for metadata in metadatas], dtype=np.int32),
+        "alive": np.ones(len(keys), dtype=np.uint8),
+        "lists": self._nearest_lists(vectors)
+      }
+
+      count = self.manifest["count"]
+      for name, dtype in self._file_dtypes().items():
+        with open(self._path(name), "ab") as f:
+          # Drop rows of a write that never reached the manifest
+          f.truncate(count * dtype.itemsize)
+          f.write(np.ascontiguousarray(columns[name], dtype=dtype.base if name == "vectors" else dtype).tobytes())
+
+      lookup = self._row_lookup()
+      lookup.update(zip(keys, range(count, count + len(keys))))
+
+      self.manifest["count"] = count + len(keys)
+      self._write_manifest(keep_rows=True)
+
+  def _mark_dead(self, rows: List[Optional[int]]):
+    rows = sorted({row for row in rows if row is not None})
+    if not rows:
+      return
+
+    alive = np.memmap(self._path("alive"), dtype=np.uint8, mode="r+", shape=(self.manifest["count"],))
+    rows = np.array(rows)
+    newly_dead = int(alive[rows].sum())
+    alive[rows] = 0
+    alive.flush()
+    del alive
+
+    self.manifest["dead"] += newly_dead
+
+  def remove(self, chunk_ids: List[str]):
+    with self._writing():
+      if not self.manifest["count"]:
+        return
+
+      lookup = self._row_lookup()
+      self._mark_dead([lookup.get(chunk_id.encode()) for chunk_id in chunk_ids])
+      self._write_manifest(keep_rows=True)
+
+  def remove_files(self, file_ids: List[str]):
+    with self._writing():
+      if not self.manifest["count"]:
+        return
+
+      self._mark_dead(self._scope_rows(file_ids).tolist())
+      self._write_manifest(keep_rows=True)
+
+  # Compact and (re)train IVF lists when needed, then record the corpus version the index reflects
+  def maintain(self, corpus_version: Optional[int] = None):
+    with self._writing():
+      if self.manifest["count"] and self.manifest["dead"] >= COMPACT_DEAD_RATIO * self.manifest["count"]:
+        self._rewrite()
+
+      live_rows = self.manifest["count"] - self.manifest["dead"]
+      if self.ivf and live_rows >= 2 * max(self.manifest["trained_count"], IVF_MIN_ROWS_PER_LIST):
+        self._rewrite(train=True)
+
+      self.manifest["corpus_version"] = corpus_version
+      self._write_manifest()
+
+  # Write live rows to a new generation of files, optionally training IVF lists on them
+  def _rewrite(self, train: bool = False):
+    alive_rows = np.flatnonzero(self._maps["alive"]) if self.manifest["count"] else np.array([], dtype=np.int64)
+    generation = self.manifest["generation"] + 1
+
+    centroids = self._train(alive_rows) if train else self._centroids
+    old_maps = self._maps
+
+    for name, dtype in self._file_dtypes().items():
+      with open(self._path(name, generation), "wb") as f:
+        for start in range(0, len(alive_rows), BLOCK_ROWS * 64):
+          block = alive_rows[start:start + BLOCK_ROWS * 64]
+
+          if name == "lists" and train:
+            column = np.argmax(self._dequantize(old_maps, block) @ centroids.T, axis=1).astype(np.int32)
+          else:
+            column = np.asarray(old_maps[name][block])
+
+          f.write(np.ascontiguousarray(column).tobytes())
+
+    if centroids is not None:
+      np.save(os.path.join(self.directory, f"centroids.{generation}.npy"), centroids)
+
+    old_generation = self.manifest["generation"]
+    self.manifest.update(generation=generation, count=len(alive_rows), dead=0)
+    if train:
+      self.manifest["trained_count"] = len(alive_rows)
+    self._write_manifest()
+
+    # Readers still holding the old maps keep them until they remap
+    self._remove_generation(old_generation)
+
+  # Spherical k-means over a sample of rows
+  def _train(self, rows: np.ndarray) -> np.ndarray:
+    lists = self.ivf_lists or max(1, int(np.sqrt(len(rows))))
+    lists = min(lists, max(1, len(rows) // IVF_MIN_ROWS_PER_LIST))
+
+    rng = np.random.default_rng(0)
+    sample = rows if len(rows) <= lists * IVF_TRAIN_ROWS_PER_LIST else np.sort(rng.choice(rows, lists * IVF_TRAIN_ROWS_PER_LIST, replace=False))
+    vectors = self.normalise(self._dequantize(self._maps, sample))
+
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)]
+    for _ in range(IVF_TRAIN_ITERATIONS):
+      assignment = np.argmax(vectors @ centroids.T, axis=1)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assignment, vectors)
+
+      # Empty lists restart from a random sample row
+      empty = np.flatnonzero(np.bincount(assignment, minlength=lists) == 0)
+      sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+      centroids = self.normalise(sums)
+
+    print(f"Trained {lists} IVF lists on {len(sample)} of {len(rows)} rows")
+    return centroids.astype(np.float32)
+
+  def _dequantize(self, maps: dict, rows: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(maps["vectors"][rows], dtype=np.float32)
+    return vectors * np.asarray(maps["scales"][rows])[:, None]
+
+  # Stored embeddings of chunks, rows of unknown chunks are None
+  def get_embeddings(self, chunk_ids: List[str]) -> List[Optional[np.ndarray]]:
+    with self._lock:
+      if not self.manifest["count"]:
+        return [None] * len(chunk_ids)
+
+      lookup = self._row_lookup()
+      rows = [lookup.get(chunk_id.encode()) for chunk_id in chunk_ids]
+      known = [row for row in rows if row is not None]
+      vectors = dict(zip(known, self._dequantize(self._maps, np.array(known, dtype=np.int64)))) if known else {}
+
+      return [vectors.get(row) for row in rows]
+
+  # Sorted rows of the files, grouped once per mapping of the files
+  def _scope_rows(self, file_ids: List[str]) -> np.ndarray:
+    if self._file_rows is None:
+      files = np.asarray(self._maps["files"])
+      order = np.argsort(files, kind="stable")
+      keys, starts = np.unique(files[order], return_index=True)
+      self._file_rows = dict(zip(keys.tolist(), np.split(order, starts[1:])))
+
+    groups = [self._file_rows.get(str(file_id).encode()) for file_id in set(file_ids)]
+    groups = [group for group in groups if group is not None]
+
+    return np.sort(np.concatenate(groups)) if groups else np.array([], dtype=np.int64)
+
+  # Rows of the IVF lists nearest to the query
+  def _probe_rows(self, query: np.ndarray) -> np.ndarray:
+    if self._ivf_rows is None:
+      lists = np.asarray(self._maps["lists"])
+      order = np.argsort(lists, kind="stable")
+      bounds = np.searchsorted(lists[order], np.arange(len(self._centroids) + 1))
+      self._ivf_rows = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+
+    probe = np.argsort(-(self._centroids @ query))[:self.ivf_probe]
+    return np.sort(np.concatenate([self._ivf_rows[i] for i in probe]))
+
+  # Scores of rows (all rows when None) against a normalised query, block by block
+  def _score(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+    vectors = self._maps["vectors"]
+    total = self.manifest["count"] if rows is None else len(rows)
+    scores = np.empty(total, dtype=np.float32)
+    buffer = np.empty((BLOCK_ROWS, self.manifest["dimensions"]), dtype=np.float32)
+
+    for start in range(0, total, BLOCK_ROWS):
+      stop = min(start + BLOCK_ROWS, total)
+      block = vectors[start:stop] if rows is None else vectors[rows[start:stop]]
+      np.copyto(buffer[:stop - start], block, casting="unsafe")
+      np.dot(buffer[:stop - start], query, out=scores[start:stop])
+
+    if self.manifest["dtype"] == "int8":
+      scores *= self._maps["scales"] if rows is None else self._maps["scales"][rows]
+
+    return scores
+
+  # Returns (chunk_id, cosine similarity) pairs of the k nearest chunks, only chunks of file_ids when given
+  def search(self, query_embedding: List[float], k: int, file_ids: Optional[List[str]] = None) -> List[Tuple[str, float]]:
+    self.reload_if_changed()
+
+    with self._lock:
+      if not self.manifest["count"]:
+        return []
+
+      query = self.normalise(np.asarray([query_embedding], dtype=np.float32))[0]
+
+      if file_ids:
+        rows = self._scope_rows(file_ids)
+      elif self.ivf and self._centroids is not None:
+        rows = self._probe_rows(query)
+      else:
+        rows = None
+
+      if rows is not None and not len(rows):
+        return []
+
+      scores = self._score(query, rows)
+      alive = self._maps["alive"] if rows is None else self._maps["alive"][rows]
+      scores = np.where(alive == 1, scores, -np.inf)
+
+      k = min(k, len(scores))
+      top = np.argpartition(-scores, k - 1)[:k]
+      top = top[np.argsort(-scores[top])]
+      top_rows = top if rows is None else rows[top]
+
+      return [
+        (chunk_id.decode(), float(scores[i]))
+        for chunk_id, i in zip(self._maps["ids"][top_rows], top)
+        if np.isfinite(scores[i])
+      ]
+
+  def stats(self):
+    return {
+      "rows": self.manifest["count"],
+      "dead_rows": self.manifest["dead"],
+      "dtype": self.manifest["dtype"],
+      "dimensions": self.manifest["dimensions"],
+      "ivf_lists": 0 if self._centroids is None else len(self._centroids),
+      "size_mb": round(sum(os.path.getsize(self._path(name)) for name in self._file_dtypes() if os.path.exists(self._path(name))) / (1024 * 1024), 2)
+    }